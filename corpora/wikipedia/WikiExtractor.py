@@ -58,23 +58,36 @@ from __future__ import unicode_literals, division
 
 import sys
 import argparse
+import bisect
 import bz2
 import codecs
-import cgi
+import collections
 import fileinput
+import glob
+import gzip
+import heapq
+import itertools
 import logging
+import marshal
 import os.path
 import re  # TODO use regex when it will be standard
+import signal
+import sqlite3
+import struct
+import tempfile
+import threading
 import time
 import json
-from io import StringIO
-from multiprocessing import Queue, Process, Value, cpu_count
+import zlib
+from io import StringIO, BytesIO
+from multiprocessing import Queue, Process, Value, Array, Condition, Lock, Pipe, Pool, cpu_count
 from timeit import default_timer
 
 
 PY2 = sys.version_info[0] == 2
 # Python 2.7 compatibiity
 if PY2:
+    import Queue as queue
     from urllib import quote
     from htmlentitydefs import name2codepoint
     from itertools import izip as zip, izip_longest as zip_longest
@@ -92,12 +105,18 @@ if PY2:
         def __eq__ (self, other):
             return self.__dict__ == other.__dict__
 else:
+    import queue
     from urllib.parse import quote
     from html.entities import name2codepoint
     from itertools import zip_longest
     from types import SimpleNamespace
     text_type = str
 
+try:
+    import lzma
+except ImportError:
+    lzma = None             # Python 2
+
 
 # ===========================================================================
 
@@ -185,6 +204,33 @@ options = SimpleNamespace(
     # cache of parser templates
     # FIXME: sharing this with a Manager slows down.
     templateCache = {},
+    # parsed templates persisted in the template store, if any
+    parsedTemplates = None,
+    # LRUCache of template expansions, one in each extract process
+    expansionCache = None,
+    # StageTimes of each extract process, if timing the stages
+    stageTimes = None,
+    # where to write the stage times as JSON, or None to log them
+    stage_times_file = None,
+    # TemplateProfile of each extract process, if profiling templates
+    templateProfile = None,
+    # number of templates listed in the profile report
+    template_profile = 0,
+    # PageStore of the pages extracted by previous runs, if incremental
+    pageStore = None,
+    # Whether to output just the text of the body of pages, for counting
+    # words, skipping the formatting of sections, lists and documents
+    plain_tokens = False,
+
+    # JSONL file of pipeline snapshots, and their period in seconds
+    telemetry_file = None,
+    telemetry_interval = 10.0,
+    # max pages sent to an extract process at once
+    batch_size = 100,
+    # seconds of CPU allowed to extract a page with templates, 0 for no limit
+    page_budget = 0,
+    # Whether to write article containers, indexed by page id
+    container = False,
 
     # Elements to ignore/discard
 
@@ -207,6 +253,8 @@ options = SimpleNamespace(
 ##
 # Keys for Template and Module namespaces
 templateKeys = set(['10', '828'])
+# Key of the article namespace, the only one extracted
+articleKeys = set(['0'])
 
 ##
 # Regex for identifying disambig pages
@@ -340,7 +388,7 @@ def unescape(text):
                     return chr(int(code))
             else:  # named entity
                 return chr(name2codepoint[code])
-        except:
+        except Exception:
             return text  # leave as is
 
     return re.sub("&#?(\w+);", fixup, text)
@@ -384,6 +432,8 @@ bold = re.compile(r"'''(.*?)'''")
 italic_quote = re.compile(r"''\"([^\"]*?)\"''")
 italic = re.compile(r"''(.*?)''")
 quote_quote = re.compile(r'""([^"]*?)""')
+# bold/italic/quote markup, dropped in plain mode
+quotes = re.compile(r"''+")
 
 # Matches space
 spaces = re.compile(r' {2,}')
@@ -401,21 +451,93 @@ class Template(list):
     """
 
     @classmethod
-    def parse(cls, body):
+    def parse(cls, body, index=None, offset=0):
+        """
+        :param index: a :class:`BraceIndex` of a text containing body at
+        :param offset:, if any.
+        """
         tpl = Template()
         # we must handle nesting, s.a.
         # {{{1|{{PAGENAME}}}
         # {{{italics|{{{italic|}}}
         # {{#if:{{{{{#if:{{{nominee|}}}|nominee|candidate}}|}}}|
         #
+        if index is None:
+            index = BraceIndex(body)
+            offset = 0
         start = 0
-        for s, e in findMatchingBraces(body, 3):
+        for s, e in findMatchingBraces(body, 3, index, offset):
             tpl.append(TemplateText(body[start:s]))
-            tpl.append(TemplateArg(body[s + 3:e - 3]))
+            tpl.append(TemplateArg(body[s + 3:e - 3], index, offset + s + 3))
             start = e
         tpl.append(TemplateText(body[start:]))  # leftover
         return tpl
 
+    @classmethod
+    def load(cls, data):
+        """
+        Rebuilds a template from the nested lists of :meth:`dump`.
+        """
+        tpl = Template()
+        for item in data:
+            if isinstance(item, tuple):
+                arg = TemplateArg.__new__(TemplateArg)
+                arg.name = Template.load(item[0])
+                arg.default = Template.load(item[1]) if item[1] is not None else None
+                tpl.append(arg)
+            else:
+                tpl.append(TemplateText(item))
+        return tpl
+
+    def dump(self):
+        """
+        :return: the parsed template as nested lists of strings, which
+        marshal serializes compactly: a TemplateArg becomes a (name, default)
+        pair.
+        """
+        return [(x.name.dump(), x.default.dump() if x.default is not None else None)
+                if isinstance(x, TemplateArg) else text_type(x)
+                for x in self]
+
+
+    # flat substitution plan, see compile()
+    plan = None
+
+    def compile(self):
+        """
+        Compiles the template into a flat substitution plan: a list of texts
+        and of tuples (name, nameTemplate, default, defaultTemplate) for its
+        parameters. The name and the default are already evaluated when
+        they are literal text, which needs no substitution nor expansion,
+        leaving only the others to evaluate on each instantiation.
+        """
+        plan = []
+        for item in self:
+            if isinstance(item, TemplateArg):
+                name = item.name.literal()
+                if item.default:
+                    default = item.default.literal()
+                else:
+                    default = None
+                plan.append((name, item.name, default, item.default))
+            elif plan and not isinstance(plan[-1], tuple):
+                plan[-1] += item
+            else:
+                plan.append(text_type(item))
+        self.plan = plan
+        return plan
+
+    def literal(self):
+        """
+        :return: the text of the template if it has no parameters and no
+        templates, hence evaluates to itself, else None.
+        """
+        if any(isinstance(item, TemplateArg) for item in self):
+            return None
+        text = ''.join(self)
+        if '{{' in text:
+            return None
+        return text
 
     def subst(self, params, extractor, depth=0):
         # We perform parameter substitutions recursively.
@@ -436,9 +558,32 @@ class Template(list):
 
         if depth > extractor.maxParameterRecursionLevels:
             extractor.recursion_exceeded_3_errs += 1
+            if options.templateProfile is not None:
+                options.templateProfile.limitHit()
             return ''
 
-        return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
+        if (depth == extractor.maxParameterRecursionLevels or
+                extractor.frame.depth >= extractor.maxTemplateRecursionLevels):
+            # even literal names and defaults hit the recursion limits
+            return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
+
+        res = []
+        for step in self.plan or self.compile():
+            if not isinstance(step, tuple):
+                res.append(step)
+                continue
+            name, nameTemplate, default, defaultTemplate = step
+            if name is None:
+                # the parameter name itself might contain templates
+                name = extractor.transform(nameTemplate.subst(params, extractor, depth + 1))
+            if name in params:
+                res.append(params[name])  # use parameter value specified in template invocation
+            elif default is not None:
+                res.append(default)
+            elif defaultTemplate:  # use the default value
+                defaultValue = defaultTemplate.subst(params, extractor, depth + 1)
+                res.append(extractor.transform(defaultValue))
+        return ''.join(res)
 
     def __str__(self):
         return ''.join([text_type(x) for x in self])
@@ -458,9 +603,11 @@ class TemplateArg(object):
     Has a name and a default value, both of which are Templates.
     """
 
-    def __init__(self, parameter):
+    def __init__(self, parameter, index=None, offset=0):
         """
         :param parameter: the parts of a tplarg.
+        :param index: a :class:`BraceIndex` of a text containing parameter at
+        :param offset:, if any.
         """
         # the parameter name itself might contain templates, e.g.:
         #   appointe{{#if:{{{appointer14|}}}|r|d}}14|
@@ -470,11 +617,13 @@ class TemplateArg(object):
         # ignored, and an equals sign in the first part is treated as plain text.
         # logging.debug('TemplateArg %s', parameter)
 
-        parts = splitParts(parameter)
-        self.name = Template.parse(parts[0])
-        if len(parts) > 1:
+        bounds = partBounds(parameter, index, offset)
+        s, e = bounds[0]
+        self.name = Template.parse(parameter[s:e], index, offset + s)
+        if len(bounds) > 1:
             # This parameter has a default value
-            self.default = Template.parse(parts[1])
+            s, e = bounds[1]
+            self.default = Template.parse(parameter[s:e], index, offset + s)
         else:
             self.default = None
 
@@ -533,6 +682,154 @@ class Frame(object):
 
 # ======================================================================
 
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least recently used entries.
+    Users count its hits, misses and the values they could not store.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value  # most recently used
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed}
+
+
+class StageTimes(object):
+    """
+    Durations of the stages of extraction, as a histogram per stage: the
+    number of pages taking less than 1, 2, 4, 8... microseconds.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, function, *args):
+        """
+        :return: function(*args), counting its duration in :param stage:.
+        """
+        start = default_timer()
+        result = function(*args)
+        seconds = default_timer() - start
+        times = self.stages.get(stage)
+        if times is None:
+            times = self.stages[stage] = {'count': 0, 'seconds': 0.0, 'histogram': {}}
+        times['count'] += 1
+        times['seconds'] += seconds
+        bound = 1 << int(seconds * 1e6).bit_length()
+        histogram = times['histogram']
+        histogram[bound] = histogram.get(bound, 0) + 1
+        return result
+
+    def stats(self):
+        return self.stages
+
+
+class TemplateProfile(object):
+    """
+    Time spent expanding each template and parser function, by name:
+    inclusive and exclusive of the templates expanded within them, with
+    their number of calls and of recursion limits hit within them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # [name, start, time in nested calls] of the calls being expanded
+        self.stack = []
+        # number of the calls being expanded by name
+        self.active = collections.Counter()
+
+    def entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = {'calls': 0, 'inclusive': 0.0,
+                                          'exclusive': 0.0, 'limit_hits': 0}
+        return entry
+
+    def enter(self):
+        """Starts timing a call, named by :meth:`name` once its title is known."""
+        self.stack.append([None, default_timer(), 0.0])
+
+    def name(self, name):
+        self.stack[-1][0] = name
+        self.active[name] += 1
+
+    def leave(self):
+        name, start, nested = self.stack.pop()
+        elapsed = default_timer() - start
+        if name is None:
+            # magic words and missing templates count as their caller
+            elapsed = nested
+        else:
+            entry = self.entry(name)
+            entry['calls'] += 1
+            entry['exclusive'] += elapsed - nested
+            self.active[name] -= 1
+            if not self.active[name]:
+                # the outermost of recursive calls includes the others
+                entry['inclusive'] += elapsed
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def limitHit(self):
+        """Counts a recursion limit hit in the innermost named call."""
+        for name, start, nested in reversed(self.stack):
+            if name is not None:
+                break
+        else:
+            name = '(page)'
+        self.entry(name)['limit_hits'] += 1
+
+    def stats(self):
+        return self.entries
+
+
+def histogram_percentile(histogram, fraction):
+    """
+    :return: the upper bound in microseconds of the bucket of :param histogram:
+    holding the given :param fraction: of its counts.
+    """
+    bounds = sorted(histogram, key=int)
+    rank = fraction * sum(histogram.values())
+    seen = 0
+    for bound in bounds:
+        seen += histogram[bound]
+        if seen >= rank:
+            return int(bound)
+    return int(bounds[-1]) if bounds else 0
+
+
+def merge_stats(total, stats):
+    """
+    Adds into :param total: the counters in the nested dicts of :param stats:.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+# ======================================================================
+
 substWords = 'subst:|safesubst:'
 
 class Extractor(object):
@@ -555,6 +852,14 @@ class Extractor(object):
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        # magic words and frame lookups, on which an expansion depends
+        self.contextLookups = 0
+        # deepest frame pushed, to know how deep a memoized expansion goes
+        self.deepestFrame = 0
+
+    def errorCount(self):
+        return (self.template_title_errs + self.recursion_exceeded_1_errs +
+                self.recursion_exceeded_2_errs + self.recursion_exceeded_3_errs)
 
     def write_output(self, out, text):
         """
@@ -643,9 +948,24 @@ class Extractor(object):
         # $dom = $this->preprocessToDom( $text, $flag );
         # $text = $frame->expand( $dom );
         #
-        text = self.transform(text)
-        text = self.wiki2text(text)
-        text = compact(self.clean(text))
+        paragraphs = compactPlain if options.plain_tokens else compact
+        stages = options.stageTimes
+        if stages is None:
+            text = self.transform(text)
+            text = self.wiki2text(text)
+            text = paragraphs(self.clean(text))
+        else:
+            text = stages.time('transform', self.transform, text)
+            text = stages.time('wiki2text', self.wiki2text, text)
+            text = stages.time('clean', self.clean, text)
+            text = stages.time('compact', paragraphs, text)
+        if options.plain_tokens:
+            # just the body, without the title nor the document wrapper
+            if sum(len(line) for line in text) >= options.min_text_length:
+                for line in text:
+                    out.write(line)
+                    out.write('\n')
+            return
         # from zwChan
         text = [title_str] + text
 
@@ -663,28 +983,31 @@ class Extractor(object):
                          self.title, self.id, *errs)
 
 
-    def transform(self, wikitext):
+    def transform(self, wikitext, index=None, offset=0):
         """
         Transforms wiki markup.
         @see https://www.mediawiki.org/wiki/Help:Formatting
+        :param index: a :class:`BraceIndex` of a text containing wikitext at
+        :param offset:, if any.
         """
         # look for matching <nowiki>...</nowiki>
-        res = ''
+        res = []
         cur = 0
         for m in nowiki.finditer(wikitext, cur):
-            res += self.transform1(wikitext[cur:m.start()]) + wikitext[m.start():m.end()]
+            res.append(self.transform1(wikitext[cur:m.start()], index, offset + cur))
+            res.append(wikitext[m.start():m.end()])
             cur = m.end()
         # leftover
-        res += self.transform1(wikitext[cur:])
-        return res
+        res.append(self.transform1(wikitext[cur:], index, offset + cur))
+        return ''.join(res)
 
 
-    def transform1(self, text):
+    def transform1(self, text, index=None, offset=0):
         """Transform text not containing <nowiki>"""
         if options.expand_templates:
             # expand templates
             # See: http://www.mediawiki.org/wiki/Help:Templates
-            return self.expand(text)
+            return self.expand(text, index, offset)
         else:
             # Drop transclusions (template, parser functions)
             return dropNested(text, r'{{', r'}}')
@@ -712,7 +1035,9 @@ class Extractor(object):
             text = dropNested(text, r'{\|', r'\|}')
 
         # Handle bold/italic/quote
-        if options.toHTML:
+        if options.plain_tokens:
+            text = quotes.sub('', text)
+        elif options.toHTML:
             text = bold_italic.sub(r'<b>\1</b>', text)
             text = bold.sub(r'<b>\1</b>', text)
             text = italic.sub(r'<i>\1</i>', text)
@@ -737,13 +1062,14 @@ class Extractor(object):
         # ############### Process HTML ###############
 
         # turn into HTML, except for the content of <syntaxhighlight>
-        res = ''
+        res = []
         cur = 0
         for m in syntaxhighlight.finditer(text):
-            res += unescape(text[cur:m.start()]) + m.group(1)
+            res.append(unescape(text[cur:m.start()]))
+            res.append(m.group(1))
             cur = m.end()
-        text = res + unescape(text[cur:])
-        return text
+        res.append(unescape(text[cur:]))
+        return ''.join(res)
 
 
     def clean(self, text):
@@ -751,35 +1077,20 @@ class Extractor(object):
         Removes irrelevant parts from :param: text.
         """
 
-        # Collect spans
-        spans = []
-        # Drop HTML comments
-        for m in comment.finditer(text):
-            spans.append((m.start(), m.end()))
-
-        # Drop self-closing tags
-        for pattern in selfClosing_tag_patterns:
-            for m in pattern.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Drop ignored tags
-        for left, right in options.ignored_tag_patterns:
-            for m in left.finditer(text):
-                spans.append((m.start(), m.end()))
-            for m in right.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Bulk remove all spans
-        text = dropSpans(spans, text)
-
-        # Drop discarded elements
-        for tag in options.discardElements:
-            text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        # Drop HTML comments, self-closing tags, ignored tags and discarded
+        # elements, in a single scan
+        text = tagStripper().strip(text)
 
         if not options.toHTML:
             # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
             text = unescape(text)
 
+        if options.plain_tokens:
+            # the rest only formats the text: drop placeholders
+            for pattern, placeholder in placeholder_tag_patterns:
+                text = pattern.sub(' ', text)
+            return text
+
         # Expand placeholders
         for pattern, placeholder in placeholder_tag_patterns:
             index = 1
@@ -822,9 +1133,12 @@ class Extractor(object):
     reOpen = re.compile('(?<!{){{(?!{)', re.DOTALL)
 
 
-    def expand(self, wikitext):
+    def expand(self, wikitext, index=None, offset=0):
         """
         :param wikitext: the text to be expanded.
+        :param index: a :class:`BraceIndex` of a text containing wikitext at
+        :param offset:, if any: templates nested in wikitext are then found
+        on it, rather than by scanning their text again at each level.
 
         Templates are frequently nested. Occasionally, parsing mistakes may
         cause template insertion to enter an infinite loop, for instance when
@@ -845,22 +1159,38 @@ class Extractor(object):
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
         # https://it.wikipedia.org/wiki/Speciale:EspandiTemplate
 
-        res = ''
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            if options.templateProfile is not None:
+                options.templateProfile.limitHit()
+            return ''
 
         # logging.debug('%*s<expand', self.frame.depth, '')
 
+        if '{{' not in wikitext:
+            return wikitext
+        if index is None:
+            index = BraceIndex(wikitext)
+            offset = 0
+        profile = options.templateProfile
+        res = []
         cur = 0
         # look for matching {{...}}
-        for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+        for s, e in findMatchingBraces(wikitext, 2, index, offset):
+            res.append(wikitext[cur:s])
+            if profile is None:
+                res.append(self.expandTemplate(wikitext[s + 2:e - 2], index, offset + s + 2))
+            else:
+                profile.enter()
+                try:
+                    res.append(self.expandTemplate(wikitext[s + 2:e - 2], index, offset + s + 2))
+                finally:
+                    profile.leave()
             cur = e
         # leftover
-        res += wikitext[cur:]
+        res.append(wikitext[cur:])
         # logging.debug('%*sexpand> %s', self.frame.depth, '', res)
-        return res
+        return ''.join(res)
 
 
     def templateParams(self, parameters):
@@ -932,9 +1262,11 @@ class Extractor(object):
         return templateParams
 
 
-    def expandTemplate(self, body):
+    def expandTemplate(self, body, index=None, offset=0):
         """Expands template invocation.
         :param body: the parts of a template.
+        :param index: a :class:`BraceIndex` of a text containing body at
+        :param offset:, if any.
 
         :see http://meta.wikimedia.org/wiki/Help:Expansion for an explanation
         of the process.
@@ -979,14 +1311,21 @@ class Extractor(object):
 
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_2_errs += 1
+            if options.templateProfile is not None:
+                options.templateProfile.limitHit()
             # logging.debug('%*sEXPAND> %s', self.frame.depth, '', body)
             return ''
 
         logging.debug('%*sEXPAND %s', self.frame.depth, '', body)
-        parts = splitParts(body)
+        if index is None:
+            index = BraceIndex(body)
+            offset = 0
+        bounds = partBounds(body, index, offset)
+        parts = [body[s:e] for s, e in bounds]
         # title is the portion before the first |
         title = parts[0].strip()
-        title = self.expand(title)
+        titleStart = offset + len(parts[0]) - len(parts[0].lstrip())
+        title = self.expand(title, index, titleStart)
 
         # SUBST
         # Apply the template tag to parameters without
@@ -999,6 +1338,8 @@ class Extractor(object):
             subst = True
 
         if title in self.magicWords.values:
+            if title != '!':
+                self.contextLookups += 1
             ret = self.magicWords[title]
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, ret)
             return ret
@@ -1020,6 +1361,8 @@ class Extractor(object):
         if colon > 1:
             funct = title[:colon]
             parts[0] = title[colon + 1:].strip()  # side-effect (parts[0] not used later)
+            if options.templateProfile is not None:
+                options.templateProfile.name(funct.strip().lower())
             # arguments after first are not evaluated
             ret = callParserFunction(funct, parts, self)
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', funct, ret)
@@ -1038,7 +1381,7 @@ class Extractor(object):
         if title in options.templateCache:
             template = options.templateCache[title]
         elif title in options.templates:
-            template = Template.parse(options.templates[title])
+            template = parse_template(title)
             # add it to cache
             options.templateCache[title] = template
             del options.templates[title]
@@ -1046,6 +1389,8 @@ class Extractor(object):
             # The page being included could not be identified
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, '')
             return ''
+        if options.templateProfile is not None:
+            options.templateProfile.name(title)
 
         logging.debug('%*sTEMPLATE %s: %s', self.frame.depth, '', title, template)
 
@@ -1086,30 +1431,75 @@ class Extractor(object):
             # Evaluate parameters, since they may contain templates, including
             # the symbol "=".
             # {{#ifexpr: {{{1}}} = 1 }}
-            params = [self.transform(p) for p in params]
+            params = [self.transform(p, index, offset + s)
+                      for p, (s, e) in zip(params, bounds[1:])]
 
         # build a dict of name-values for the parameter values
         params = self.templateParams(params)
 
+        # Expansions are memoized, unless they depend on the page through
+        # magic words or the frame: e.g. {{nbsp}} or {{convert|2|km}} but not
+        # {{PAGENAME}}. An entry records how many frames deep the expansion
+        # went, so it is only reused where it stays within the recursion limit.
+        cache = options.expansionCache
+        if cache is not None and not subst:
+            key = (title, tuple(sorted(params.items())))
+            cached = cache.get(key)
+            if cached is not None and self.frame.depth + cached[1] < self.maxTemplateRecursionLevels:
+                cache.hits += 1
+                value, span = cached
+                self.deepestFrame = max(self.deepestFrame, self.frame.depth + span)
+                return value
+            cache.misses += 1
+            lookups = self.contextLookups
+            errors = self.errorCount()
+            outerDeepest = self.deepestFrame
+            self.deepestFrame = 0
+
         # Perform parameter substitution.
         # Extend frame before subst, since there may be recursion in default
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
         # 21637542 in enwiki.
         self.frame = self.frame.push(title, params)
+        self.deepestFrame = max(self.deepestFrame, self.frame.depth)
         instantiated = template.subst(params, self)
         value = self.transform(instantiated)
         self.frame = self.frame.pop()
+
+        if cache is not None and not subst:
+            if self.contextLookups == lookups and self.errorCount() == errors:
+                cache.put(key, (value, self.deepestFrame - self.frame.depth))
+            else:
+                cache.bypassed += 1
+            self.deepestFrame = max(outerDeepest, self.deepestFrame)
         logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
         return value
 
 
+def parse_template(title):
+    """
+    Parses the body of the template :param title:, unless the store of
+    parsed templates already has it from an earlier run or another process.
+    """
+    parsed = options.parsedTemplates
+    if parsed is None:
+        return Template.parse(options.templates[title])
+    template = parsed.get(title)
+    if template is None:
+        template = Template.parse(options.templates[title])
+        parsed.add(title, template)
+    return template
+
+
 # ----------------------------------------------------------------------
 # parameter handling
 
 
-def splitParts(paramsList):
+def splitParts(paramsList, index=None, offset=0):
     """
     :param paramsList: the parts of a template or tplarg.
+    :param index: a :class:`BraceIndex` of a text containing paramsList at
+    :param offset:, if any.
 
     Split template parameters at the separator "|".
     separator "=".
@@ -1144,45 +1534,100 @@ def splitParts(paramsList):
     # and tpl parameters like:
     #    ||[[Category:People|{{#if:A|A|{{PAGENAME}}}}]]
 
+    return [paramsList[s:e] for s, e in partBounds(paramsList, index, offset)]
+
+
+def partBounds(paramsList, index=None, offset=0):
+    """
+    :return: the (start, end) positions of the parts of :param paramsList:,
+    as split by :func:`splitParts`.
+    """
     sep = '|'
-    parameters = []
+    bounds = []
     cur = 0
-
-    for s, e in findMatchingBraces(paramsList):
-        par = paramsList[cur:s].split(sep)
-        if par:
-            if parameters:
-                # portion before | belongs to previous parameter
-                parameters[-1] += par[0]
-                if len(par) > 1:
-                    # rest are new parameters
-                    parameters.extend(par[1:])
-            else:
-                parameters = par
-        elif not parameters:
-            parameters = ['']  # create first param
-        # add span to last previous parameter
-        parameters[-1] += paramsList[s:e]
+    start = 0
+    for s, e in findMatchingBraces(paramsList, 0, index, offset):
+        # a separator within a span belongs to the span
+        sepPos = paramsList.find(sep, cur, s)
+        while sepPos >= 0:
+            bounds.append((start, sepPos))
+            start = sepPos + 1
+            sepPos = paramsList.find(sep, start, s)
         cur = e
     # leftover
-    par = paramsList[cur:].split(sep)
-    if par:
-        if parameters:
-            # portion before | belongs to previous parameter
-            parameters[-1] += par[0]
-            if len(par) > 1:
-                # rest are new parameters
-                parameters.extend(par[1:])
-        else:
-            parameters = par
+    sepPos = paramsList.find(sep, cur)
+    while sepPos >= 0:
+        bounds.append((start, sepPos))
+        start = sepPos + 1
+        sepPos = paramsList.find(sep, start)
+    bounds.append((start, len(paramsList)))
+
+    # logging.debug('splitParts %s %s\nparams: %s', sep, paramsList, text_type(bounds))
+    return bounds
 
-    # logging.debug('splitParts %s %s\nparams: %s', sep, paramsList, text_type(parameters))
-    return parameters
+
+class BraceIndex(object):
+    """
+    The runs of braces and brackets ({{, }}, [[, ]] or longer) in a text,
+    found with a single scan. Templates, tplargs and links within any part
+    of the text are then matched on the runs, without scanning the part
+    again: expansion recurses from a template into its parts and parameters,
+    which would otherwise be rescanned once for each level of nesting.
+    """
+
+    runRE = re.compile(r'{{2,}|}{2,}|\[{2,}|]{2,}')
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = []
+        self.ends = []
+        self.chars = []
+        for m in self.runRE.finditer(text):
+            self.starts.append(m.start())
+            self.ends.append(m.end())
+            self.chars.append(text[m.start()])
+
+    def runs(self, start, end):
+        """
+        :return: the runs within text[start:end], cut at its bounds, as
+        triples (start, end, char) of positions relative to :param start:.
+        """
+        i = bisect.bisect_right(self.ends, start)
+        starts = self.starts
+        ends = self.ends
+        while i < len(starts) and starts[i] < end:
+            s = max(starts[i], start)
+            e = min(ends[i], end)
+            if e - s >= 2:
+                yield s - start, e - start, self.chars[i]
+            i += 1
+
+    def links(self, start, end):
+        """
+        :return: the spans of the balanced [[...]] within text[start:end], as
+        found by :func:`findBalanced`, relative to :param start:.
+        """
+        depth = 0
+        for s, e, char in self.runs(start, end):
+            if char == '[':
+                if not depth:
+                    linkStart = s
+                depth += (e - s) // 2
+            elif char == ']' and depth:
+                # ]] left over after closing the outermost link are plain text
+                closes = (e - s) // 2
+                if closes >= depth:
+                    yield linkStart, s + 2 * depth
+                    depth = 0
+                else:
+                    depth -= closes
 
 
-def findMatchingBraces(text, ldelim=0):
+def findMatchingBraces(text, ldelim=0, index=None, offset=0):
     """
     :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
+    :param index: a :class:`BraceIndex` of a text containing text at
+    :param offset:, if any.
     """
     # Parsing is done with respect to pairs of double braces {{..}} delimiting
     # a template, and pairs of triple braces {{{..}}} delimiting a tplarg.
@@ -1219,31 +1664,39 @@ def findMatchingBraces(text, ldelim=0):
     # as well as expressions with stray }:
     #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
 
+    if index is None:
+        runs = ((m.start(), m.end(), m.group()[0])
+                for m in BraceIndex.runRE.finditer(text))
+    else:
+        runs = index.runs(offset, offset + len(text))
+    # both searches move forward from the end of the last run, so they can
+    # share one iterator over the runs
     if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
+        opening = '{'  # at least ldelim
+        following = '{}'
     else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
+        opening = '{['
+        following = '{}[]'
+    minOpen = ldelim or 2
 
-    cur = 0
     while True:
-        m1 = reOpen.search(text, cur)
-        if not m1:
+        for start, end, brac in runs:
+            if brac in opening and end - start >= minOpen:
+                break
+        else:
             return
-        lmatch = m1.end() - m1.start()
-        if m1.group()[0] == '{':
+        lmatch = end - start
+        if brac == '{':
             stack = [lmatch]  # stack of opening braces lengths
         else:
             stack = [-lmatch]  # negative means [
-        end = m1.end()
         while True:
-            m2 = reNext.search(text, end)
-            if not m2:
+            for s, end, brac in runs:
+                if brac in following:
+                    break
+            else:
                 return  # unbalanced
-            end = m2.end()
-            brac = m2.group()[0]
-            lmatch = m2.end() - m2.start()
+            lmatch = end - s
 
             if brac == '{':
                 stack.append(lmatch)
@@ -1261,13 +1714,11 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(openCount - lmatch)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 elif len(stack) == 1 and 0 < stack[0] < ldelim:
                     # ambiguous {{{{{ }}} }}
-                    #yield m1.start() + stack[0], end
-                    cur = end
+                    #yield start + stack[0], end
                     break
             elif brac == '[':  # [[
                 stack.append(-lmatch)
@@ -1283,11 +1734,9 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(lmatch - openCount)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 # unmatched ]] are discarded
-                cur = end
 
 
 def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
@@ -1730,50 +2179,285 @@ def normalizeNamespace(ns):
 # https://github.com/Wikia/app/blob/dev/extensions/ParserFunctions/ParserFunctions_body.php
 
 
-class Infix:
-    """Infix operators.
-    The calling sequence for the infix is:
-      x |op| y
+from math import floor, ceil, pi, e, trunc, exp, log as ln, sin, cos, tan, asin, acos, atan, \
+    fmod, sqrt, isinf, isnan
+
+
+class ExprError(ValueError):
+    """An expression of #expr or #ifexpr that cannot be evaluated."""
+
+
+def exprDivide(x, y):
+    if y == 0:
+        raise ExprError('Division by zero')
+    return x / y
+
+
+def exprMod(x, y):
+    # PHP %: on integers, with the sign of the dividend
+    x, y = int(x), int(y)
+    if y == 0:
+        raise ExprError('Division by zero')
+    return float(fmod(x, y))
+
+
+def exprFmod(x, y):
+    if y == 0:
+        raise ExprError('Division by zero')
+    return fmod(x, y)
+
+
+def exprPow(x, y):
+    try:
+        value = x ** y
+    except (ZeroDivisionError, OverflowError):
+        return float('inf')
+    except ValueError:
+        value = None
+    if not isinstance(value, float):
+        # a fractional power of a negative number
+        raise ExprError('Result is not a number')
+    return value
+
+
+def exprRound(x, digits):
+    # PHP rounds half away from zero
+    scale = 10.0 ** int(digits)
+    return (floor(abs(x) * scale + 0.5) / scale) * (1 if x >= 0 else -1)
+
+
+def exprDomain(function, low=None, high=None, strict=False):
+    """
+    :return: :param function: raising ExprError outside [low, high], or
+    ]low, high] if :param strict:.
+    """
+    def checked(x):
+        if (low is not None and (x < low or strict and x == low) or
+                high is not None and x > high):
+            raise ExprError('Invalid argument for %s' % function.__name__)
+        return function(x)
+    return checked
+
+
+def exprInteger(function):
+    """
+    :return: :param function: rounding to an integer, returning a float as
+    the other operators do, and inf and nan unchanged.
     """
+    def rounded(x):
+        if isinf(x) or isnan(x):
+            return x
+        return float(function(x))
+    return rounded
+
+
+# operator: (precedence, function), after MediaWiki's ExprParser
+exprUnary = {
+    '-': (10, lambda x: -x),
+    '+': (10, lambda x: x),
+    'not': (9, lambda x: float(x == 0)),
+    'sin': (9, sin),
+    'cos': (9, cos),
+    'tan': (9, tan),
+    'asin': (9, exprDomain(asin, -1, 1)),
+    'acos': (9, exprDomain(acos, -1, 1)),
+    'atan': (9, atan),
+    'exp': (9, exp),
+    'ln': (9, exprDomain(ln, 0, strict=True)),
+    'abs': (9, abs),
+    'floor': (9, exprInteger(floor)),
+    'ceil': (9, exprInteger(ceil)),
+    'trunc': (9, exprInteger(trunc)),
+    'sqrt': (9, exprDomain(sqrt, 0)),
+}
+
+exprBinary = {
+    'e': (10, lambda x, y: x * exprPow(10.0, y)),
+    '^': (8, exprPow),
+    '*': (7, lambda x, y: x * y),
+    '/': (7, exprDivide),
+    'div': (7, exprDivide),
+    'mod': (7, exprMod),
+    'fmod': (7, exprFmod),
+    '+': (6, lambda x, y: x + y),
+    '-': (6, lambda x, y: x - y),
+    'round': (5, exprRound),
+    '=': (4, lambda x, y: float(x == y)),
+    '<>': (4, lambda x, y: float(x != y)),
+    '!=': (4, lambda x, y: float(x != y)),
+    '<': (4, lambda x, y: float(x < y)),
+    '>': (4, lambda x, y: float(x > y)),
+    '<=': (4, lambda x, y: float(x <= y)),
+    '>=': (4, lambda x, y: float(x >= y)),
+    'and': (3, lambda x, y: float(x != 0 and y != 0)),
+    'or': (2, lambda x, y: float(x != 0 or y != 0)),
+}
+
+exprConstants = {'e': e, 'pi': pi}
 
-    def __init__(self, function):
-        self.function = function
+exprTokenRE = re.compile(r'\s*(?:([0-9.]+)|([A-Za-z]+)|(<>|!=|<=|>=|[-+*/^()=<>])|(\S))')
 
-    def __ror__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
+# Expressions are expanded from the XML text of the dump, where < and > are
+# escaped. MediaWiki also reads the entities &lt;, &gt; and &minus;, and the
+# minus sign, as operators: those entities are escaped once more in the dump.
+exprEntityRE = re.compile('&(?:amp;)?(lt|gt|minus);|\u2212')
+exprEntities = {'lt': '<', 'gt': '>'}
 
-    def __or__(self, other):
-        return self.function(other)
 
-    def __rlshift__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
+def compileExpr(expr):
+    """
+    Compiles the MediaWiki expression :param expr: into a program for
+    :func:`runExpr`: a list in postfix order of numbers and of pairs
+    (arity, function).
+    :raise ExprError: if the expression is malformed.
+    """
+    expr = exprEntityRE.sub(lambda m: exprEntities.get(m.group(1), '-'), expr)
+    program = []
+    operators = []  # (precedence, arity, function), or None for (
+
+    def reduce(precedence):
+        # apply the pending operators binding at least as tightly
+        while operators and operators[-1] is not None and operators[-1][0] >= precedence:
+            program.append(operators.pop()[1:])
+
+    expectOperand = True
+    for number, word, symbol, other in exprTokenRE.findall(expr):
+        if other:
+            raise ExprError('Unrecognized punctuation character "%s"' % other)
+        if word:
+            word = word.lower()
+            if word in exprConstants and (expectOperand or word != 'e'):
+                number = exprConstants[word]
+                symbol = None
+            elif word not in exprUnary and word not in exprBinary:
+                raise ExprError('Unrecognized word "%s"' % word)
+            else:
+                symbol = word
+        if number:
+            if not expectOperand:
+                raise ExprError('Unexpected number')
+            if not isinstance(number, float):
+                try:
+                    number = float(number)
+                except ValueError:
+                    # PHP (float): the longest numeric prefix, 0 if none
+                    number = float(re.match(r'\d*(?:\.\d+)?', number).group() or 0)
+            program.append(number)
+            expectOperand = False
+        elif symbol == '(':
+            if not expectOperand:
+                raise ExprError('Unexpected ( operator')
+            operators.append(None)
+        elif symbol == ')':
+            if expectOperand:
+                raise ExprError('Unexpected ) operator')
+            reduce(-1)
+            if not operators:
+                raise ExprError('Unexpected closing bracket')
+            operators.pop()
+        elif expectOperand:
+            if symbol not in exprUnary:
+                raise ExprError('Unexpected %s operator' % symbol)
+            precedence, function = exprUnary[symbol]
+            operators.append((precedence, 1, function))
+        else:
+            if symbol not in exprBinary:
+                raise ExprError('Unexpected %s operator' % symbol)
+            precedence, function = exprBinary[symbol]
+            reduce(precedence)
+            operators.append((precedence, 2, function))
+            expectOperand = True
+    if expectOperand and (program or operators):
+        raise ExprError('Missing operand')
+    reduce(-1)
+    if operators:
+        raise ExprError('Unclosed bracket')
+    return program
+
+
+def runExpr(program):
+    """
+    :return: the value of a program from :func:`compileExpr`, or None for
+    the empty expression.
+    """
+    stack = []
+    for step in program:
+        if isinstance(step, float):
+            stack.append(step)
+        elif step[0] == 1:
+            stack.append(step[1](stack.pop()))
+        else:
+            y = stack.pop()
+            stack.append(step[1](stack.pop(), y))
+    return float(stack[0]) if stack else None
 
-    def __rshift__(self, other):
-        return self.function(other)
 
-    def __call__(self, value1, value2):
-        return self.function(value1, value2)
+def formatNumber(value):
+    """Formats :param value: as PHP prints floats."""
+    if isnan(value) or isinf(value):
+        return ('-' if value < 0 else '') + ('NAN' if isnan(value) else 'INF')
+    if value == int(value) and abs(value) < 1e15:
+        return '%d' % value
+    text = '%.14G' % value
+    if 'E' in text:
+        mantissa, exponent = text.split('E')
+        if '.' not in mantissa:
+            mantissa += '.0'
+        text = '%sE%+d' % (mantissa, int(exponent))
+    return text
 
 
-ROUND = Infix(lambda x, y: round(x, y))
+# Results of the expressions evaluated by this process
+exprCache = LRUCache(10000)
 
 
-from math import floor, ceil, pi, e, trunc, exp, log as ln, sin, cos, tan, asin, acos, atan
+def evalExpr(expr):
+    """
+    Evaluates the MediaWiki expression :param expr:.
+    See https://www.mediawiki.org/wiki/Help:Extension:ParserFunctions##expr
+    :return: the value formatted as text, '' for the empty expression.
+    :raise ExprError: if it cannot be evaluated.
+    """
+    cached = exprCache.get(expr)
+    if cached is None:
+        exprCache.misses += 1
+        try:
+            value = runExpr(compileExpr(expr))
+            cached = formatNumber(value) if value is not None else ''
+        except ExprError as err:
+            cached = err
+        except (ValueError, OverflowError) as err:
+            cached = ExprError(text_type(err))
+        exprCache.put(expr, cached)
+    else:
+        exprCache.hits += 1
+    if isinstance(cached, ExprError):
+        raise cached
+    return cached
 
 
-def sharp_expr(extr, expr):
-    """Tries converting a lua expr into a Python expr."""
+def sharp_expr(extr, expr, *rest):
     try:
         expr = extr.expand(expr)
-        expr = re.sub('(?<![!<>])=', '==', expr) # negative lookbehind
-        expr = re.sub('mod', '%', expr)          # no \b here
-        expr = re.sub('\bdiv\b', '/', expr)
-        expr = re.sub('\bround\b', '|ROUND|', expr)
-        return text_type(eval(expr))
-    except:
+        return evalExpr(expr.strip())
+    except ExprError as err:
+        logging.debug('Expression error: %s: %s', err, expr)
         return '<span class="error">%s</span>' % expr
 
 
+def sharp_ifexpr(extr, expr, valueIfTrue='', valueIfFalse='', *rest):
+    try:
+        value = evalExpr(extr.expand(expr).strip())
+    except ExprError as err:
+        # the error message of MediaWiki is not article text
+        logging.debug('Expression error: %s: %s', err, expr)
+        return ''
+    # a non-zero number is true
+    if value and value != '0':
+        return extr.expand(valueIfTrue.strip())
+    return extr.expand(valueIfFalse.strip())
+
+
 def sharp_if(extr, testValue, valueIfTrue, valueIfFalse=None, *args):
     # In theory, we should evaluate the first argument here,
     # but it was evaluated while evaluating part[0] in expandTemplate().
@@ -1879,7 +2563,7 @@ parserFunctions = {
 
     '#iferror': sharp_iferror,
 
-    '#ifexpr': lambda *args: '',  # not supported
+    '#ifexpr': sharp_ifexpr,
 
     '#ifexist': lambda extr, title, ifex, ifnex: extr.expand(ifnex), # assuming title is not present
 
@@ -1936,6 +2620,7 @@ def callParserFunction(functionName, args, extractor):
                 if not templateTitle:
                     logging.warn("Template with empty title")
                 params = None
+                extractor.contextLookups += 1
                 frame = extractor.frame
                 while frame:
                     if frame.title == templateTitle:
@@ -1951,7 +2636,7 @@ def callParserFunction(functionName, args, extractor):
         if functionName in parserFunctions:
             # branching functions use the extractor to selectively evaluate args
             return parserFunctions[functionName](extractor, *args)
-    except:
+    except Exception:
         return ""  # FIXME: fix errors
     return ""
 
@@ -1974,21 +2659,20 @@ def callParserFunction(functionName, args, extractor):
 reNoinclude = re.compile(r'<noinclude>(?:.*?)</noinclude>', re.DOTALL)
 reIncludeonly = re.compile(r'<includeonly>|</includeonly>', re.DOTALL)
 
-def define_template(title, page):
+def template_definition(page):
     """
-    Adds a template defined in the :param page:.
+    Cleans up the template defined in the :param page: for inclusion.
+    :return: ('redirect', target), ('template', text), or None if there is
+    nothing to include.
     @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
     """
-    # title = normalizeTitle(title)
-
     # sanity check (empty template, e.g. Template:Crude Oil Prices))
-    if not page: return
+    if not page: return None
 
     # check for redirects
     m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', page[0], re.IGNORECASE)
     if m:
-        options.redirects[title] = m.group(1)  # normalizeTitle(m.group(1))
-        return
+        return 'redirect', m.group(1)  # normalizeTitle(m.group(1))
 
     text = unescape(''.join(page))
 
@@ -2019,9 +2703,381 @@ def define_template(title, page):
         text = reIncludeonly.sub('', text)
 
     if text:
+        return 'template', text
+    return None
+
+
+def add_template(title, definition):
+    """
+    Adds to the templates the :param definition: of :param title:, as
+    returned by template_definition().
+    """
+    if not definition:
+        return
+    kind, value = definition
+    if kind == 'redirect':
+        options.redirects[title] = value
+    else:
         if title in options.templates:
             logging.warn('Redefining: %s', title)
-        options.templates[title] = text
+        options.templates[title] = value
+
+
+def define_template(title, page):
+    """
+    Adds a template defined in the :param page:.
+    """
+    # title = normalizeTitle(title)
+    add_template(title, template_definition(page))
+
+
+def template_definitions(texts):
+    """
+    :return: the template_definition() of each of :param texts:, in order.
+    Runs in the template loading processes.
+    """
+    return [template_definition(text) for text in texts]
+
+
+def part_template_pages(part_file):
+    """
+    Collects the template and module pages of one dump part.
+    Runs in the template loading processes.
+    :return: (id, title, ns, page, definition) of each page, in order.
+    """
+    input = fileinput.FileInput(part_file, openhook=fileinput.hook_compressed)
+    pages = [(id, title, ns, page, template_definition(''.join(page)))
+             for id, title, ns, page in template_pages(input)]
+    input.close()
+    return pages
+
+
+# ----------------------------------------------------------------------
+# Compiled template store
+
+class TemplateStore(object):
+    """
+    Read-only mapping over one table of a compiled template store: a SQLite
+    database holding template and module bodies, already cleaned by
+    define_template(), and template redirects.
+    The database is opened on first access in each process and bodies are
+    fetched by title when expanded, so a store replaces options.templates or
+    options.redirects without reading them all into memory.
+    The database is memory mapped: all the processes reading it share the
+    same pages of the OS cache.
+    Lookups, including those of missing titles, are cached in each process:
+    most expansions look up a redirect that does not exist.
+    """
+
+    mmapSize = 1 << 32
+    cacheSize = 10000
+    missing = object()              # cached lookup of a missing title
+
+    def __init__(self, path, table):
+        """
+        :param path: the SQLite database.
+        :param table: 'templates' or 'redirects'.
+        """
+        self.path = path
+        self.table = table
+        self.db = None
+        self.pid = None
+        self.cache = LRUCache(self.cacheSize)
+
+    def __getstate__(self):
+        # connections are not shared with the extract processes
+        return {'path': self.path, 'table': self.table, 'db': None, 'pid': None,
+                'cache': LRUCache(self.cacheSize)}
+
+    def connection(self):
+        # a forked process must not use the connection of its parent
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA query_only = ON')
+            self.db.execute('PRAGMA mmap_size = %d' % self.mmapSize)
+            self.pid = os.getpid()
+        return self.db
+
+    def get(self, title, default=None):
+        body = self.cache.get(title)
+        if body is None:
+            row = self.connection().execute(
+                'SELECT body FROM %s WHERE title = ?' % self.table, (title,)).fetchone()
+            body = row[0] if row else self.missing
+            self.cache.put(title, body)
+        return default if body is self.missing else body
+
+    def __getitem__(self, title):
+        body = self.get(title)
+        if body is None:
+            raise KeyError(title)
+        return body
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def __delitem__(self, title):
+        # bodies stay on disk: only the parsed template is kept in memory
+        self.cache.entries.pop(title, None)
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+
+class ParsedTemplateStore(object):
+    """
+    Parsed templates persisted in the 'parsed' table of a template store, so
+    that each template is parsed once across processes and across runs.
+    Templates are serialized with marshal from :meth:`Template.dump`.
+    Each process buffers the templates it parses and adds them to the store
+    in batches.
+    """
+
+    flushSize = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+        self.pending = []
+
+    def __getstate__(self):
+        return {'path': self.path, 'db': None, 'pid': None, 'pending': []}
+
+    def connection(self):
+        # a forked process must not use the connection of its parent
+        if self.db is None or self.pid != os.getpid():
+            # wait for the other processes adding templates
+            self.db = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            self.pid = os.getpid()
+            self.pending = []
+        return self.db
+
+    def get(self, title):
+        row = self.connection().execute(
+            'SELECT body FROM parsed WHERE title = ?', (title,)).fetchone()
+        if row:
+            try:
+                return Template.load(marshal.loads(bytes(row[0])))
+            except (EOFError, ValueError, TypeError):
+                # written by another Python version: parse it again
+                logging.debug('Unreadable parsed template: %s', title)
+        return None
+
+    def add(self, title, template):
+        self.pending.append((title, sqlite3.Binary(marshal.dumps(template.dump()))))
+        if len(self.pending) >= self.flushSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        db = self.connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO parsed VALUES (?, ?)', self.pending)
+        logging.debug('Stored %d parsed templates', len(self.pending))
+        self.pending = []
+
+
+def save_template_store(path):
+    """
+    Compile options.templates and options.redirects into the template store
+    at :param path:, together with the template and module namespaces.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    for table in ('templates', 'redirects', 'meta'):
+        db.execute('CREATE TABLE %s (title TEXT PRIMARY KEY, body TEXT) WITHOUT ROWID' % table)
+    db.execute('CREATE TABLE parsed (title TEXT PRIMARY KEY, body BLOB) WITHOUT ROWID')
+    db.executemany('INSERT INTO templates VALUES (?, ?)', options.templates.items())
+    db.executemany('INSERT INTO redirects VALUES (?, ?)', options.redirects.items())
+    db.executemany('INSERT INTO meta VALUES (?, ?)',
+                   [('templateNamespace', options.templateNamespace),
+                    ('moduleNamespace', options.moduleNamespace)])
+    db.commit()
+    db.close()
+    os.rename(tmp_path, path)
+    logging.info("Compiled %d templates into '%s'", len(options.templates), path)
+
+
+def open_template_store(path):
+    """
+    Use the template store at :param path: for options.templates and
+    options.redirects.
+    """
+    options.templates = TemplateStore(path, 'templates')
+    options.redirects = TemplateStore(path, 'redirects')
+    options.parsedTemplates = ParsedTemplateStore(path)
+    db = options.parsedTemplates.connection()
+    # readers proceed while the extract processes add parsed templates
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS parsed (title TEXT PRIMARY KEY, body BLOB) WITHOUT ROWID')
+    meta = dict(db.execute('SELECT title, body FROM meta'))
+    if not options.templateNamespace:
+        options.templateNamespace = meta['templateNamespace']
+    if not options.moduleNamespace:
+        options.moduleNamespace = meta['moduleNamespace']
+    options.templatePrefix = options.templateNamespace + ':'
+    options.modulePrefix = options.moduleNamespace + ':'
+
+
+def share_templates():
+    """
+    Move the template definitions loaded in memory into a temporary template
+    store, so that the extract processes look them up in a shared read-only
+    database instead of each getting its own copy of options.templates.
+    :return: the path of the temporary store, to remove when done.
+    """
+    fd, path = tempfile.mkstemp(prefix='templates-', suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    try:
+        save_template_store(path)
+        # drop the dicts: the extract processes only inherit the store
+        open_template_store(path)
+    except BaseException:
+        remove_template_store(path)
+        raise
+    return path
+
+
+def remove_template_store(path):
+    """
+    Remove the template store at :param path: with its WAL files, or what
+    was saved of it.
+    """
+    for name in (path, path + '-wal', path + '-shm', path + '.tmp'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+# ----------------------------------------------------------------------
+# Incremental extraction
+
+class PageStore(object):
+    """
+    The extracted text of each page, keyed by page id, with the revision it
+    was extracted from, in a SQLite database kept across runs.
+    An incremental run reuses the text of the pages whose revision did not
+    change since the previous run, instead of extracting them again.
+    Texts are stored compressed with zlib. Each process buffers the texts it
+    extracts and adds them to the store in batches.
+    """
+
+    flushSize = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+        self.pending = []
+        self.reused = 0
+        self.extracted = 0
+
+    def __getstate__(self):
+        return {'path': self.path, 'db': None, 'pid': None, 'pending': [],
+                'reused': 0, 'extracted': 0}
+
+    def connection(self):
+        # a forked process must not use the connection of its parent
+        if self.db is None or self.pid != os.getpid():
+            # wait for the other processes adding pages
+            self.db = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            self.db.execute('PRAGMA synchronous = NORMAL')
+            self.pid = os.getpid()
+            self.pending = []
+        return self.db
+
+    def lookup(self, pages):
+        """
+        :param pages: a batch of (id, revid, title, page).
+        :return: a dict of the stored text of the pages of the batch whose
+        revision is unchanged, by page id.
+        """
+        ids = [page[0] for page in pages]
+        rows = self.connection().execute(
+            'SELECT id, revid, text FROM pages WHERE id IN (%s)' % ','.join('?' * len(ids)),
+            ids)
+        revids = dict((page[0], page[1]) for page in pages)
+        texts = {}
+        for id, revid, text in rows:
+            if revids[id] == revid:
+                texts[id] = zlib.decompress(text).decode('utf-8')
+        self.reused += len(texts)
+        return texts
+
+    def add(self, id, revid, text):
+        self.extracted += 1
+        data = zlib.compress(text.encode('utf-8'), 1)
+        self.pending.append((id, revid, sqlite3.Binary(data)))
+        if len(self.pending) >= self.flushSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        db = self.connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', self.pending)
+        logging.debug('Stored %d pages', len(self.pending))
+        self.pending = []
+
+    def stats(self):
+        return {'reused': self.reused, 'extracted': self.extracted}
+
+
+def extraction_fingerprint():
+    """
+    :return: the options on which the text extracted from a page depends,
+    besides its revision, as a string.
+    """
+    settings = dict(
+        version=version,
+        urlbase=options.urlbase,
+        keep_tables=options.keep_tables,
+        keepLinks=options.keepLinks,
+        keepSections=options.keepSections,
+        keepLists=options.keepLists,
+        toHTML=options.toHTML,
+        write_json=options.write_json,
+        plain_tokens=options.plain_tokens,
+        expand_templates=options.expand_templates,
+        escape_doc=options.escape_doc,
+        print_revision=options.print_revision,
+        min_text_length=options.min_text_length,
+        acceptedNamespaces=sorted(options.acceptedNamespaces),
+        discardElements=sorted(options.discardElements),
+        ignoredTags=[left.pattern for left, right in options.ignored_tag_patterns],
+    )
+    return json.dumps(settings, sort_keys=True)
+
+
+def open_page_store(path):
+    """
+    Use the page store at :param path: for incremental extraction, creating
+    it if needed. Stored pages extracted with other options are dropped.
+    """
+    store = PageStore(path)
+    db = store.connection()
+    # readers proceed while the extract processes add pages
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS pages (id TEXT PRIMARY KEY, revid TEXT, text BLOB) WITHOUT ROWID')
+    db.execute('CREATE TABLE IF NOT EXISTS meta (title TEXT PRIMARY KEY, body TEXT) WITHOUT ROWID')
+    fingerprint = extraction_fingerprint()
+    row = db.execute("SELECT body FROM meta WHERE title = 'options'").fetchone()
+    if row and row[0] != fingerprint:
+        logging.warning("Page store '%s' was extracted with other options: extracting all pages again", path)
+        with db:
+            db.execute('DELETE FROM pages')
+    with db:
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('options', ?)", (fingerprint,))
+    logging.info("Using page store '%s' with %d pages",
+                 path, db.execute('SELECT COUNT(*) FROM pages').fetchone()[0])
+    options.pageStore = store
 
 
 # ----------------------------------------------------------------------
@@ -2032,20 +3088,35 @@ def dropNested(text, openDelim, closeDelim):
     """
     openRE = re.compile(openDelim, re.IGNORECASE)
     closeRE = re.compile(closeDelim, re.IGNORECASE)
-    # partition text in separate blocks { } { }
+    spans = nestedSpans(lambda pos: openRE.search(text, pos),
+                        lambda pos: closeRE.search(text, pos))
+    if not spans:
+        return text
+    # collect text outside partitions
+    return dropSpans(spans, text)
+
+
+def nestedSpans(openSearch, closeSearch):
+    """
+    Partitions a text in separate blocks { } { } of nested expressions.
+    :param openSearch: returns the first match of the opening delimiter
+    from a position of the text, like re.search().
+    :param closeSearch: the same for the closing delimiter.
+    :return: pairs (s, e) for each block.
+    """
     spans = []                  # pairs (s, e) for each partition
     nest = 0                    # nesting level
-    start = openRE.search(text, 0)
+    start = openSearch(0)
     if not start:
-        return text
-    end = closeRE.search(text, start.end())
+        return spans
+    end = closeSearch(start.end())
     next = start
     while end:
-        next = openRE.search(text, next.end())
+        next = openSearch(next.end())
         if not next:            # termination
             while nest:         # close all pending
                 nest -= 1
-                end0 = closeRE.search(text, end.end())
+                end0 = closeSearch(end.end())
                 if end0:
                     end = end0
                 else:
@@ -2058,7 +3129,7 @@ def dropNested(text, openDelim, closeDelim):
                 nest -= 1
                 # try closing more
                 last = end.end()
-                end = closeRE.search(text, end.end())
+                end = closeSearch(end.end())
                 if not end:     # unbalanced
                     if spans:
                         span = (spans[0][0], last)
@@ -2070,13 +3141,12 @@ def dropNested(text, openDelim, closeDelim):
                 spans.append((start.start(), end.end()))
                 # advance start, find next close
                 start = next
-                end = closeRE.search(text, next.end())
+                end = closeSearch(next.end())
                 break           # { }
         if next != start:
             # { { }
             nest += 1
-    # collect text outside partitions
-    return dropSpans(spans, text)
+    return spans
 
 
 def dropSpans(spans, text):
@@ -2084,19 +3154,228 @@ def dropSpans(spans, text):
     Drop from text the blocks identified in :param spans:, possibly nested.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
         if offset <= s:         # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return ''.join(res)
 
 
-# ----------------------------------------------------------------------
-# WikiLinks
+def selectSpans(spans):
+    """
+    :return: the spans that dropSpans() drops, i.e. those not starting
+    within a previous one, in order.
+    """
+    selected = []
+    offset = 0
+    for s, e in sorted(spans):
+        if offset <= s:
+            selected.append((s, e))
+            offset = e
+    return selected
+
+
+class TagMatch(object):
+    """
+    A match of a tag pattern, at its position in the text left by the
+    previous drops, with the methods of a re match used by nestedSpans().
+    """
+
+    __slots__ = ('s', 'e')
+
+    def __init__(self, s, e):
+        self.s = s
+        self.e = e
+
+    def start(self):
+        return self.s
+
+    def end(self):
+        return self.e
+
+
+class TagStripper(object):
+    """
+    Drops from a text what Extractor.clean() used to drop in a pass for each
+    pattern: HTML comments, self-closing tags and ignored tags, then each of
+    the discarded elements with dropNested().
+    A single scan tries at each '<' only the patterns of the tag name that
+    follows. The drops are then replayed on the matches found, and applied
+    in one go. When dropping an element might join the text around it into
+    a new tag, the elements left are dropped one by one as before, so the
+    result is always the same.
+    """
+
+    # each '<', and the ASCII name of the tag that may follow
+    tagStartRE = re.compile(r'<(!--)?\s*/?\s*([A-Za-z0-9_]*)')
+    # the tag name at the start of a tag pattern
+    patternNameRE = re.compile(r'<(?:\\s\*)?/?(?:\\s\*)?([A-Za-z0-9_]+)')
+
+    def __init__(self, ignoredTagPatterns, discardElements):
+        """
+        :param ignoredTagPatterns: the (left, right) patterns of the ignored tags.
+        :param discardElements: the tags of the elements to discard, in order.
+        """
+        self.patterns = []      # all the patterns
+        self.byName = {}        # tag name -> indexes of its patterns
+        self.anyName = []       # indexes of the patterns to try at every '<'
+        self.comment = self.add(comment, False)
+        # patterns whose matches are dropped together, before the elements
+        self.spanPatterns = [self.comment]
+        for pattern in selfClosing_tag_patterns:
+            self.spanPatterns.append(self.add(pattern))
+        for left, right in ignoredTagPatterns:
+            self.spanPatterns.append(self.add(left))
+            self.spanPatterns.append(self.add(right))
+        # (open, close) pattern indexes of the discarded elements
+        self.tags = list(discardElements)
+        self.elements = [(self.add(re.compile(r'<\s*%s\b[^>/]*>' % tag, re.IGNORECASE)),
+                          self.add(re.compile(r'<\s*/\s*%s>' % tag, re.IGNORECASE)))
+                         for tag in self.tags]
+        # element tags match up to their first '>'
+        self.safe = not any('<' in tag or '>' in tag for tag in self.tags)
+        self.all = list(range(len(self.patterns)))
+
+    def add(self, pattern, byName=True):
+        index = len(self.patterns)
+        self.patterns.append(pattern)
+        m = self.patternNameRE.match(pattern.pattern) if byName else None
+        if m and pattern.pattern[m.end():m.end() + 2] in (r'\b', '>'):
+            self.byName.setdefault(m.group(1).lower(), []).append(index)
+        elif byName:
+            self.anyName.append(index)
+        return index
+
+    def scan(self, text):
+        """
+        :return: for each pattern, the (start, end) of its match at each '<'
+        of :param text:.
+        """
+        patterns = self.patterns
+        matches = [[] for _ in patterns]
+        for m in self.tagStartRE.finditer(text):
+            follow = text[m.end():m.end() + 1]
+            if follow > '\x7f':
+                # case insensitive non ASCII names
+                candidates = self.all
+            else:
+                candidates = self.byName.get(m.group(2).lower(), []) + self.anyName
+                if m.group(1):
+                    candidates.append(self.comment)
+            pos = m.start()
+            for i in candidates:
+                match = patterns[i].match(text, pos)
+                if match:
+                    matches[i].append((pos, match.end()))
+        return matches
+
+    def strip(self, text):
+        """
+        :return: :param text: without comments, self-closing and ignored tags,
+        and discarded elements.
+        """
+        matches = self.scan(text)
+
+        # the spans of each pattern, as they are found by finditer()
+        spans = []
+        for i in self.spanPatterns:
+            last = 0
+            for s, e in matches[i]:
+                if s >= last:
+                    spans.append((s, e))
+                    last = e
+        dropped = selectSpans(spans)
+
+        changed = True          # whether dropped changed since the last element
+        for k, (open, close) in enumerate(self.elements):
+            if changed:
+                if not self.safe or self.joinsTags(text, dropped):
+                    return self.dropElements(dropSpans(list(dropped), text), k)
+                starts = [s for s, e in dropped]
+                shifts = []     # length dropped up to each drop
+                shift = 0
+                for s, e in dropped:
+                    shift += e - s
+                    shifts.append(shift)
+                changed = False
+            # the matches left in the text, at their positions after the drops
+            startOrigin = {}
+            endOrigin = {}
+            visible = []
+            for i in (open, close):
+                found = []
+                for s, e in matches[i]:
+                    j = bisect.bisect_right(starts, s) - 1
+                    if j >= 0 and s < dropped[j][1]:
+                        continue    # dropped
+                    if j + 1 < len(starts) and starts[j + 1] < e:
+                        continue    # cut by a drop
+                    shift = shifts[j] if j >= 0 else 0
+                    startOrigin[s - shift] = s
+                    endOrigin[e - shift] = e
+                    found.append(TagMatch(s - shift, e - shift))
+                visible.append(found)
+            opens, closes = visible
+            if not opens:
+                continue
+            spans = nestedSpans(self.searcher(opens), self.searcher(closes))
+            if spans:
+                spans = [(startOrigin[s], endOrigin[e]) for s, e in selectSpans(spans)]
+                dropped = selectSpans(dropped + spans)
+                changed = True
+        return dropSpans(list(dropped), text)
+
+    @staticmethod
+    def searcher(matches):
+        starts = [m.s for m in matches]
+        def search(pos):
+            i = bisect.bisect_left(starts, pos)
+            return matches[i] if i < len(matches) else None
+        return search
+
+    @staticmethod
+    def joinsTags(text, dropped):
+        """
+        :return: whether a drop in :param dropped: follows an open '<', so that
+        a tag might span it once the text around it is joined.
+        """
+        inside = False
+        kept = 0
+        for s, e in dropped:
+            lt = text.rfind('<', kept, s)
+            gt = text.rfind('>', kept, s)
+            if lt != gt:
+                inside = lt > gt
+            if inside:
+                return True
+            kept = e
+        return False
+
+    def dropElements(self, text, first=0):
+        for tag in self.tags[first:]:
+            text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        return text
+
+
+tagStrippers = {}               # per ignored tags and discarded elements
+
+def tagStripper():
+    """
+    :return: the TagStripper of the current options.
+    """
+    key = (tuple(options.ignored_tag_patterns), tuple(options.discardElements))
+    stripper = tagStrippers.get(key)
+    if stripper is None:
+        stripper = tagStrippers[key] = TagStripper(*key)
+    return stripper
+
+
+# ----------------------------------------------------------------------
+# WikiLinks
 
 # May be nested [[File:..|..[[..]]..|..]], [[Category:...]], etc.
 # Also: [[Help:IPA for Catalan|[andora]]]
@@ -2114,8 +3393,9 @@ def replaceInternalLinks(text):
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
-    for s, e in findBalanced(text):
+    res = []
+    index = BraceIndex(text)
+    for s, e in index.links(0, len(text)):
         m = tailRE.match(text, e)
         if m:
             trail = m.group(0)
@@ -2133,15 +3413,18 @@ def replaceInternalLinks(text):
             title = inner[:pipe].rstrip()
             # find last |
             curp = pipe + 1
-            for s1, e1 in findBalanced(inner):
+            for s1, e1 in index.links(s + 2, e - 2):
                 last = inner.rfind('|', curp, s1)
                 if last >= 0:
                     pipe = last  # advance
                 curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
 # the official version is a method in class Parser, similar to this:
@@ -2445,16 +3728,16 @@ wgUrlProtocols = [
 EXT_LINK_URL_CLASS = r'[^][<>"\x00-\x20\x7F\s]'
 ANCHOR_CLASS = r'[^][\x00-\x08\x0a-\x1F]'
 ExtLinkBracketedRegex = re.compile(
-    '\[(((?i)' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
+    '\[((' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
     r'\s*((?:' + ANCHOR_CLASS + r'|\[\[' + ANCHOR_CLASS + r'+\]\])' + r'*?)\]',
-    re.S | re.U)
+    re.I | re.S | re.U)
 # A simpler alternative:
 # ExtLinkBracketedRegex = re.compile(r'\[(.*?)\](?!])')
 
 EXT_IMAGE_REGEX = re.compile(
     r"""^(http://|https://)([^][<>"\x00-\x20\x7F\s]+)
-    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.((?i)gif|png|jpg|jpeg)$""",
-    re.X | re.S | re.U)
+    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.(gif|png|jpg|jpeg)$""",
+    re.I | re.X | re.S | re.U)
 
 
 def replaceExternalLinks(text):
@@ -2653,6 +3936,25 @@ def compact(text):
     return page
 
 
+def compactPlain(text):
+    """
+    The paragraphs of :param text: that compact() keeps as text, for plain
+    mode: it drops section titles, lists, indented and preformatted lines
+    and residuals of tables, without tracking sections nor lists.
+    """
+    page = []
+    for line in text.split('\n'):
+        if (not line or line[0] in ' :*#;{|' or line[-1] == '}' or
+                (line[0] == '(' and line[-1] == ')') or
+                not line.strip('.-') or section.match(line)):
+            continue
+        if line.startswith('++'):
+            # page title
+            line = line[2:-2]
+        page.append(line)
+    return page
+
+
 def handle_unicode(entity):
     numeric_code = int(entity[2:-1])
     if numeric_code >= 0x10000: return ''
@@ -2670,15 +3972,18 @@ class NextFile(object):
 
     filesPerDir = 100
 
-    def __init__(self, path_name):
+    def __init__(self, path_name, start=0):
+        """
+        :param path_name: the output directory.
+        :param start: the number of the first file, counting from 0.
+        """
         self.path_name = path_name
-        self.dir_index = -1
-        self.file_index = -1
+        self.index = start - 1
+        self.dir_index, self.file_index = divmod(self.index, NextFile.filesPerDir)
 
     def __next__(self):
-        self.file_index = (self.file_index + 1) % NextFile.filesPerDir
-        if self.file_index == 0:
-            self.dir_index += 1
+        self.index += 1
+        self.dir_index, self.file_index = divmod(self.index, NextFile.filesPerDir)
         dirname = self._dirname()
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
@@ -2695,17 +4000,56 @@ class NextFile(object):
         return '%s/wiki_%02d' % (self._dirname(), self.file_index)
 
 
+def gzip_compress(data):
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+
+# codec name -> (file suffix, compress function)
+outputCodecs = {
+    'bz2': ('.bz2', bz2.compress),
+    'gzip': ('.gz', gzip_compress),
+}
+if lzma:
+    outputCodecs['lzma'] = ('.xz', lzma.compress)
+
+
+def output_chunks(texts, compress=None, ids=None):
+    """
+    Encode the texts of consecutive pages for an OutputSplitter.
+    :param texts: the texts of the pages.
+    :param compress: the output codec, or None.
+    :param ids: the ids of the pages, to encode them as the records of a
+    ContainerSplitter instead.
+    :return: a list of (pages, size, data) chunks: one for each page, or a
+    single compressed member for all of them, of uncompressed size size.
+    """
+    data = [text.encode('utf-8') for text in texts]
+    if ids is not None:
+        return [(1, len(chunk), container_record(id, chunk, compress) if chunk else b'')
+                for id, chunk in zip(ids, data)]
+    if not compress:
+        return [(1, len(chunk), chunk) for chunk in data]
+    data = b''.join(data)
+    return [(len(texts), len(data), outputCodecs[compress][1](data))]
+
+
 class OutputSplitter(object):
     """
     File-like object, that splits output to multiple files of a given max size.
+    Compressed output is appended as independent compressed members, which
+    standard tools decompress as a single stream: compression happens where
+    the members are produced, in the extract processes.
     """
 
-    def __init__(self, nextFile, max_file_size=0, compress=True):
+    def __init__(self, nextFile, max_file_size=0, compress=None):
         """
         :param nextFile: a NextFile object from which to obtain filenames
             to use.
         :param max_file_size: the maximum size of each file.
-        :para compress: whether to write data with bzip compression.
+        :param compress: the codec of the data written, from outputCodecs, or None.
         """
         self.nextFile = nextFile
         self.compress = compress
@@ -2713,22 +4057,100 @@ class OutputSplitter(object):
         self.file = self.open(next(self.nextFile))
 
     def reserve(self, size):
-        if self.file.tell() + size > self.max_file_size:
+        if self.size + size > self.max_file_size:
             self.close()
             self.file = self.open(next(self.nextFile))
 
-    def write(self, data):
-        self.reserve(len(data))
+    def write(self, data, size=None):
+        """
+        :param data: the bytes to write, compressed if the output is.
+        :param size: the uncompressed size of data, counted towards the max
+        file size.
+        """
+        if size is None:
+            size = len(data)
+        self.reserve(size)
         self.file.write(data)
+        self.size += size
+
+    def flush(self):
+        self.file.flush()
 
     def close(self):
         self.file.close()
 
     def open(self, filename):
+        self.size = 0           # uncompressed bytes written to the file
         if self.compress:
-            return bz2.BZ2File(filename + '.bz2', 'w')
-        else:
-            return open(filename, 'wb')
+            filename += outputCodecs[self.compress][0]
+        return open(filename, 'wb')
+
+
+# ----------------------------------------------------------------------
+# Article container: the records of the articles, with an index of their
+# offsets by page id, read by article_container.py, which describes it.
+
+containerMagic = b'WIKIART\x01'
+containerHeader = struct.Struct('<8s8s')     # magic, codec
+containerRecord = struct.Struct('<QI')       # page id, length of the data
+containerEntry = struct.Struct('<QQ')        # page id, offset of the record
+containerFooter = struct.Struct('<QQ8s')     # offset of the index, records, magic
+containerSuffix = '.wac'
+
+
+def container_record(id, data, compress=None):
+    """
+    :return: the container record of the page :param id: with text
+    :param data:, compressed with :param compress: if any.
+    """
+    if compress:
+        data = outputCodecs[compress][1](data)
+    return containerRecord.pack(int(id), len(data)) + data
+
+
+class ContainerSplitter(OutputSplitter):
+    """
+    OutputSplitter writing the records of output_chunks() into article
+    containers, each closed with the index of its records.
+    """
+
+    def write(self, data, size=None):
+        """
+        :param data: a container record, or nothing for a page without text.
+        :param size: the size of the text of the record.
+        """
+        if not data:
+            return
+        if size is None:
+            size = len(data)
+        self.reserve(size)
+        id, length = containerRecord.unpack_from(data)
+        self.index.append(containerEntry.pack(id, self.offset))
+        self.file.write(data)
+        self.offset += len(data)
+        self.size += size
+
+    def close(self):
+        self.file.write(b''.join(self.index))
+        self.file.write(containerFooter.pack(self.offset, len(self.index), containerMagic))
+        self.file.close()
+
+    def open(self, filename):
+        self.size = 0
+        self.index = []         # entries of the records written
+        file = open(filename + containerSuffix, 'wb')
+        file.write(containerHeader.pack(containerMagic, (self.compress or '').encode('ascii')))
+        self.offset = containerHeader.size
+        return file
+
+
+def open_output(nextFile, max_file_size=0, compress=None):
+    """
+    :return: the OutputSplitter of the output format, a ContainerSplitter
+    if options.container.
+    """
+    splitter = ContainerSplitter if options.container else OutputSplitter
+    return splitter(nextFile, max_file_size, compress)
 
 
 # ----------------------------------------------------------------------
@@ -2739,54 +4161,112 @@ tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*?>(?:([^<]*)(<.*?>)?)?')
 keyRE = re.compile(r'key="(\d*)"')
 catRE = re.compile(r'\[\[Category:([^\|]+).*\]\].*')  # capture the category name [[Category:Category name|Sortkey]]"
 
-def load_templates(file, output_file=None):
+def template_pages(input):
+    """
+    Scans :param input: for template and module pages.
+    :return: (id, title, ns, page) of each, with page a list of lines.
+    """
+    for page_count, page_data in enumerate(pages_from(input, templateKeys)):
+        id, revid, title, ns, catSet, page = page_data
+        if ns in templateKeys:
+            yield id, title, ns, page
+        if page_count and page_count % 100000 == 0:
+            logging.info("Preprocessed %d pages", page_count)
+
+
+def load_templates(file, output_file=None, process_count=1, parts=None):
     """
     Load templates from :param file:.
     :param output_file: file where to save templates and modules.
+    :param process_count: number of processes cleaning up the definitions.
+    :param parts: the parts of a split dump, each scanned by its own
+    process instead of :param file:.
+    Definitions are added in dump order, so the templates and redirects are
+    the same whatever the number of processes.
     """
     options.templatePrefix = options.templateNamespace + ':'
     options.modulePrefix = options.moduleNamespace + ':'
 
     if output_file:
         output = codecs.open(output_file, 'wb', 'utf-8')
-    for page_count, page_data in enumerate(pages_from(file)):
-        id, revid, title, ns,catSet, page = page_data
+    if process_count > 1:
+        pool = Pool(process_count)
+        if parts:
+            pages = itertools.chain.from_iterable(pool.imap(part_template_pages, parts))
+        else:
+            pages = pooled_template_pages(file, pool, process_count)
+    else:
+        pool = None
+        pages = ((id, title, ns, page, template_definition(''.join(page)))
+                 for id, title, ns, page in template_pages(file))
+    for id, title, ns, page, definition in pages:
         if not output_file and (not options.templateNamespace or
                                 not options.moduleNamespace):  # do not know it yet
             # reconstruct templateNamespace and moduleNamespace from the first title
-            if ns in templateKeys:
-                colon = title.find(':')
-                if colon > 1:
-                    if ns == '10':
-                        options.templateNamespace = title[:colon]
-                        options.templatePrefix = title[:colon + 1]
-                    elif ns == '828':
-                        options.moduleNamespace = title[:colon]
-                        options.modulePrefix = title[:colon + 1]
-        if ns in templateKeys:
-            text = ''.join(page)
-            define_template(title, text)
-            # save templates and modules to file
-            if output_file:
-                output.write('<page>\n')
-                output.write('   <title>%s</title>\n' % title)
-                output.write('   <ns>%s</ns>\n' % ns)
-                output.write('   <id>%s</id>\n' % id)
-                output.write('   <text>')
-                for line in page:
-                    output.write(line)
-                output.write('   </text>\n')
-                output.write('</page>\n')
-        if page_count and page_count % 100000 == 0:
-            logging.info("Preprocessed %d pages", page_count)
+            colon = title.find(':')
+            if colon > 1:
+                if ns == '10':
+                    options.templateNamespace = title[:colon]
+                    options.templatePrefix = title[:colon + 1]
+                elif ns == '828':
+                    options.moduleNamespace = title[:colon]
+                    options.modulePrefix = title[:colon + 1]
+        add_template(title, definition)
+        # save templates and modules to file
+        if output_file:
+            output.write('<page>\n')
+            output.write('   <title>%s</title>\n' % title)
+            output.write('   <ns>%s</ns>\n' % ns)
+            output.write('   <id>%s</id>\n' % id)
+            output.write('   <text>')
+            for line in page:
+                output.write(line)
+            output.write('   </text>\n')
+            output.write('</page>\n')
+    if pool:
+        pool.close()
+        pool.join()
     if output_file:
         output.close()
         logging.info("Saved %d templates to '%s'", len(options.templates), output_file)
 
 
-def pages_from(input):
+def pooled_template_pages(file, pool, process_count, batch_size=1000):
+    """
+    Scans :param file: for template pages, while the processes of
+    :param pool: clean up their definitions in batches.
+    :return: (id, title, ns, page, definition) of each page, in order.
+    """
+    def batches():
+        batch = []
+        for page_data in template_pages(file):
+            batch.append(page_data)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # a few batches in flight keep the processes busy while bounding memory
+    pending = collections.deque()
+    for batch in batches():
+        texts = [''.join(page) for id, title, ns, page in batch]
+        pending.append((batch, pool.apply_async(template_definitions, (texts,))))
+        if len(pending) > 2 * process_count:
+            batch, result = pending.popleft()
+            for page_data, definition in zip(batch, result.get()):
+                yield page_data + (definition,)
+    for batch, result in pending:
+        for page_data, definition in zip(batch, result.get()):
+            yield page_data + (definition,)
+
+
+def pages_from(input, namespaces=None):
     """
     Scans input extracting pages.
+    :param namespaces: keys of the namespaces of the pages to read the text
+    of, None for all: the text of the other pages is skipped without being
+    decoded, and they are returned with no lines.
     :return: (id, revid, title, namespace key, page), page is a list of lines.
     """
     # we collect individual lines, since str.join() is significantly faster
@@ -2799,13 +4279,14 @@ def pages_from(input):
     inText = False
     redirect = False
     title = None
+    input = iter(input)  # the text of skipped pages is consumed apart
     for line in input:
         if not isinstance(line, text_type): line = line.decode('utf-8')
         if '<' not in line:  # faster than doing re.search()
             if inText:
                 page.append(line)
                 # extract categories
-                if line.lstrip().startswith('[[Category:'):
+                if '[[Category:' in line and line.lstrip().startswith('[[Category:'):
                     mCat = catRE.search(line)
                     if mCat:
                         catSet.add(mCat.group(1))
@@ -2832,6 +4313,16 @@ def pages_from(input):
             if m.lastindex == 3 and line[m.start(3)-2] == '/': # self closing
                 # <text xml:space="preserve" />
                 continue
+            # <ns> and <redirect> precede <revision>
+            if redirect or namespaces is not None and ns not in namespaces:
+                if m.lastindex != 4:
+                    for line in input:
+                        if isinstance(line, text_type):
+                            if '</text>' in line:
+                                break
+                        elif b'</text>' in line:
+                            break
+                continue
             inText = True
             line = line[m.start(3):m.end(3)]
             page.append(line)
@@ -2854,23 +4345,32 @@ def pages_from(input):
             page = []
 
 
-def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+def expand_dump_parts(inputs):
     """
-    :param input_file: name of the wikipedia dump file; '-' to read from stdin
-    :param template_file: optional file with template definitions.
-    :param out_file: directory where to store extracted data, or '-' for stdout
-    :param file_size: max size of each extracted file, or None for no max (one file)
-    :param file_compress: whether to compress files with bzip.
-    :param process_count: number of extraction processes to spawn.
+    Expand the input arguments into the ordered list of dump parts.
+    :param inputs: file names or glob patterns, e.g. a single
+    enwiki-latest-pages-articles.xml.bz2 or the split parts
+    'enwiki-latest-pages-articles*.xml-p*.bz2'.
+    Parts are sorted by their numeric components, so that pages-articles10
+    follows pages-articles9 also when the shell expanded the pattern.
     """
+    def natural_key(name):
+        return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+    parts = []
+    for name in inputs:
+        matches = glob.glob(name) if re.search(r'[*?[]', name) else None
+        if matches:
+            parts.extend(matches)
+        else:
+            parts.append(name)  # let open() report a missing file
+    return sorted(parts, key=natural_key)
 
-    if input_file == '-':
-        input = sys.stdin
-    else:
-        input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
 
-    # collect siteinfo
+def read_siteinfo(input):
+    """
+    Collect the <siteinfo> of a dump, consuming :param input: up to its end.
+    """
     for line in input:
         # When an input file is .bz2 or .gz, line can be a bytes even in Python 3.
         if not isinstance(line, text_type): line = line.decode('utf-8')
@@ -2899,160 +4399,1021 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         elif tag == '/siteinfo':
             break
 
+
+class PipelineCounters(object):
+    """
+    Progress of each process of the pipeline, shared for telemetry. Each
+    counter is only updated by one process.
+    """
+
+    def __init__(self, worker_count, part_count):
+        # pages and UTF-8 bytes read by the mapper of each dump part
+        self.mapper_pages = Array('l', part_count, lock=False)
+        self.mapper_bytes = Array('l', part_count, lock=False)
+        # pages extracted and seconds waited for jobs by each extract process
+        self.worker_pages = Array('l', worker_count, lock=False)
+        self.worker_idle = Array('d', worker_count, lock=False)
+        # pages and (compressed) bytes written by the reducer
+        self.reducer_pages = Value('l', 0, lock=False)
+        self.reducer_bytes = Value('l', 0, lock=False)
+
+
+class SyncQueue(object):
+    """
+    A queue with a single reader, where put() sends its item before it
+    returns, instead of leaving it to a thread. The extract processes put
+    their output in it: one that dies while extracting a page cannot leave
+    behind an item partly sent, nor the queue locked for the others.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = Pipe(duplex=False)
+        self.lock = Lock()
+        # the reader must not wait for the lock of the writers to count
+        self.size = Value('l', 0)
+
+    def put(self, item):
+        with self.size.get_lock():
+            self.size.value += 1
+        with self.lock:
+            self.writer.send(item)
+
+    def get(self, timeout=None):
+        """
+        :raise queue.Empty: if no item comes within :param timeout: seconds.
+        """
+        if timeout is not None and not self.reader.poll(timeout):
+            raise queue.Empty
+        item = self.reader.recv()
+        with self.size.get_lock():
+            self.size.value -= 1
+        return item
+
+    def get_nowait(self):
+        return self.get(0)
+
+    def qsize(self):
+        return self.size.value
+
+
+def queue_depth(queue):
+    """:return: the approximate size of :param queue:, or None if unknown."""
+    if queue is None:
+        return None
+    try:
+        return queue.qsize()
+    except NotImplementedError:  # macOS
+        return None
+
+
+class TelemetryWriter(threading.Thread):
+    """
+    Appends to a JSONL file a snapshot of the pipeline every interval:
+    the depth of the queues, the bytes spooled by the reducer, and the
+    throughput since the previous snapshot of the mappers, of each extract
+    process with its idle share, and of the reducer. The queues hold
+    batches of pages.
+    """
+
+    def __init__(self, path, interval, counters, jobs_queue, output_queue, spool_bytes):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.counters = counters
+        self.jobs_queue = jobs_queue
+        self.output_queue = output_queue
+        self.spool_bytes = spool_bytes
+        self.stopped = threading.Event()
+        self.start_time = default_timer()
+
+    def sample(self):
+        counters = self.counters
+        return {
+            'time': default_timer(),
+            'mapper_pages': list(counters.mapper_pages),
+            'mapper_bytes': list(counters.mapper_bytes),
+            'worker_pages': list(counters.worker_pages),
+            'worker_idle': list(counters.worker_idle),
+            'reducer_pages': counters.reducer_pages.value,
+            'reducer_bytes': counters.reducer_bytes.value,
+        }
+
+    def snapshot(self, previous, current):
+        elapsed = max(current['time'] - previous['time'], 1e-6)
+
+        def rate(key, i=None):
+            if i is None:
+                return round((current[key] - previous[key]) / elapsed, 1)
+            return round((current[key][i] - previous[key][i]) / elapsed, 1)
+
+        return {
+            'time': round(current['time'] - self.start_time, 1),
+            'jobs_queue': queue_depth(self.jobs_queue),
+            'output_queue': queue_depth(self.output_queue),
+            'spool_bytes': self.spool_bytes.value,
+            'mappers': [{'pages': current['mapper_pages'][i],
+                         'pages_per_s': rate('mapper_pages', i),
+                         'bytes_per_s': rate('mapper_bytes', i)}
+                        for i in range(len(current['mapper_pages']))],
+            'workers': [{'pages': current['worker_pages'][i],
+                         'pages_per_s': rate('worker_pages', i),
+                         'idle': min(1.0, round(rate('worker_idle', i), 3))}
+                        for i in range(len(current['worker_pages']))],
+            # no reducer in unordered mode
+            'reducer': {'pages': current['reducer_pages'],
+                        'pages_per_s': rate('reducer_pages'),
+                        'bytes_per_s': rate('reducer_bytes')} if self.output_queue else None,
+        }
+
+    def run(self):
+        with open(self.path, 'w') as file:
+            previous = self.sample()
+            stopping = False
+            while not stopping:
+                stopping = self.stopped.wait(self.interval)
+                current = self.sample()
+                file.write(json.dumps(self.snapshot(previous, current)) + '\n')
+                file.flush()
+                previous = current
+
+    def stop(self):
+        """Writes a last snapshot and waits for the thread to end."""
+        self.stopped.set()
+        self.join()
+
+
+class Supervisor(threading.Thread):
+    """
+    Hands the jobs of the mappers to the extract processes, through a queue
+    for each, and keeps each job until its output is delivered: received by
+    the reducer, or written by its extract process in unordered mode.
+    An extract process that dies is restarted, and its undelivered jobs are
+    handed out again. A page on which extract processes died maxPageCrashes
+    times is skipped: it gets no output.
+    Each extract process publishes in progress[4 * i:4 * i + 4] the page
+    number of its job, the index in the job of the page it extracts or -1,
+    and the number of jobs it is done with.
+    """
+
+    maxPageCrashes = 3
+    # jobs given to an extract process at once: the one being extracted and
+    # the next ones, waiting in its queue
+    maxRunning = 2
+    # seconds without jobs done after which the pages in progress are logged
+    stallWarning = 600
+
+    def __init__(self, jobs_queue, done_queue, start_worker, worker_count, unordered):
+        """
+        :param jobs_queue: the jobs of the mappers, then None.
+        :param done_queue: where the extract processes put their index when
+        done with a job, and the reducer (None, page_num) for each job it gets.
+        :param start_worker: function(i, restarts, queue) starting the extract
+        process i, taking its jobs from queue, after restarts deaths.
+        :param unordered: whether the extract processes write their output.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs_queue = jobs_queue
+        self.done_queue = done_queue
+        self.start_worker = start_worker
+        self.unordered = unordered
+        self.progress = Array('l', 4 * worker_count, lock=False)
+        self.workers = [None] * worker_count
+        self.queues = [None] * worker_count
+        self.restarts = [0] * worker_count
+        # page numbers of the jobs each process is not done with, in order
+        self.running = [collections.deque() for _ in range(worker_count)]
+        # jobs done by each process, as far as we know
+        self.seen = [0] * worker_count
+        # (process, job) of the undelivered jobs, by page number
+        self.jobs = {}
+        self.retry = []
+        self.crashes = collections.Counter()  # by page id
+        self.skipped = []                     # (id, title) of the pages skipped
+        self.quitting = set()                 # processes told to quit
+        self.dead_queues = []                 # queues of dead processes
+        self.stopping = False
+
+    def start_workers(self):
+        for i in range(len(self.workers)):
+            self.restart(i)
+
+    def restart(self, i):
+        self.progress[4 * i:4 * i + 4] = [0, 0, -1, 0]
+        self.running[i].clear()
+        self.seen[i] = 0
+        if self.queues[i]:
+            # the queue of a dead process may be unusable: keep it open
+            # while it sends the jobs it buffered, without waiting for it
+            self.queues[i].cancel_join_thread()
+            self.dead_queues.append(self.queues[i])
+        self.queues[i] = Queue()
+        self.workers[i] = self.start_worker(i, self.restarts[i], self.queues[i])
+
+    def give(self, i, job):
+        page_num = job[0]
+        self.jobs[page_num] = (i, job)
+        self.running[i].append(page_num)
+        self.queues[i].put(job)
+
+    def sync(self, i):
+        """Takes into account the jobs done by process i."""
+        done = self.progress[4 * i + 3]
+        while self.seen[i] < done:
+            page_num = self.running[i].popleft()
+            self.seen[i] += 1
+            if self.unordered:
+                self.jobs.pop(page_num, None)
+
+    def recover(self, i):
+        """Restarts the dead extract process i, handing its jobs out again."""
+        worker = self.workers[i]
+        self.sync(i)
+        part, first, current = self.progress[4 * i:4 * i + 3]
+        owner, job = self.jobs.get((part, first), (None, None))
+        if current >= 0 and owner == i:
+            id, revid, title, page = job[1][current]
+            self.crashes[id] += 1
+            logging.error('Extract process %d died (exit code %s) on page %s %s',
+                          i, worker.exitcode, id, title)
+            if self.crashes[id] >= self.maxPageCrashes:
+                logging.error('Skipping page %s %s: extract processes died on it %d times',
+                              id, title, self.crashes[id])
+                self.skipped.append((id, title))
+                job[1][current] = (id, revid, title, None)
+        else:
+            logging.error('Extract process %d died (exit code %s)', i, worker.exitcode)
+        # its output may be lost too for the jobs it is done with
+        lost = sorted(page_num for page_num, (owner, job) in self.jobs.items() if owner == i)
+        self.retry.extend(self.jobs.pop(page_num)[1] for page_num in lost)
+        self.retry.sort(key=lambda job: job[0], reverse=True)
+        self.restarts[i] += 1
+        self.restart(i)
+        if i in self.quitting:
+            self.queues[i].put(None)
+
+    def check_workers(self):
+        for i, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            self.sync(i)
+            if worker.exitcode is None:
+                continue
+            if worker.exitcode == 0 and i in self.quitting:
+                worker.join()
+                self.workers[i] = None
+                self.quitting.discard(i)
+            else:
+                self.recover(i)
+
+    def idle_worker(self):
+        """:return: the extract process with the fewest jobs, if it can take one."""
+        i = min(range(len(self.workers)), key=lambda i: len(self.running[i]))
+        return i if len(self.running[i]) < self.maxRunning else None
+
+    def run(self):
+        finished = False        # got all the jobs of the mappers
+        last_done = default_timer()
+        while not self.stopping:
+            self.check_workers()
+            i = self.idle_worker()
+            if i is not None and self.retry:
+                # the earliest first: the reducer waits for it
+                self.give(i, self.retry.pop())
+                continue
+            if finished and not self.jobs and not self.retry:
+                if not any(self.workers):
+                    break
+                for i, worker in enumerate(self.workers):
+                    if worker is not None and i not in self.quitting:
+                        self.quitting.add(i)
+                        self.queues[i].put(None)
+                for worker in self.workers:
+                    if worker is not None:
+                        worker.join(1)
+                continue
+            try:
+                if i is not None and not finished:
+                    job = self.jobs_queue.get(timeout=1)
+                    if job is None:
+                        finished = True
+                    else:
+                        self.give(i, job)
+                    continue
+                message = self.done_queue.get(timeout=1)
+            except queue.Empty:
+                if self.jobs and default_timer() - last_done > self.stallWarning:
+                    self.warn_stall()
+                    last_done = default_timer()
+                continue
+            last_done = default_timer()
+            # take all the messages before blocking again
+            while message is not None:
+                if isinstance(message, tuple):
+                    # delivered to the reducer
+                    self.jobs.pop(message[1], None)
+                try:
+                    message = self.done_queue.get_nowait()
+                except queue.Empty:
+                    message = None
+
+    def stop(self):
+        """Terminates the extract processes, without restarting them."""
+        self.stopping = True
+        if self.is_alive():
+            self.join()
+        for worker in self.workers:
+            if worker is not None:
+                worker.terminate()
+                worker.join()
+        # nothing reads the jobs left in the queues: do not wait at exit to
+        # send them
+        for jobs in [self.jobs_queue] + self.queues:
+            jobs.cancel_join_thread()
+
+    def warn_stall(self):
+        logging.warning('No job done for %ds', self.stallWarning)
+        for i in range(len(self.workers)):
+            part, first, current = self.progress[4 * i:4 * i + 3]
+            owner, job = self.jobs.get((part, first), (None, None))
+            if current >= 0 and owner == i:
+                id, revid, title, page = job[1][current]
+                logging.warning('Extract process %d is on page %s %s', i, id, title)
+
+    def report(self):
+        restarts = sum(self.restarts)
+        if restarts:
+            logging.warning('Restarted extract processes %d times', restarts)
+        if self.skipped:
+            logging.warning('Skipped %d pages on which extract processes died: %s', len(self.skipped),
+                            ', '.join('%s %s' % page for page in self.skipped))
+
+
+# ----------------------------------------------------------------------
+# Checkpoints
+
+def checkpoint_path(out_file):
+    # next to the output directory, whose files are all articles
+    return out_file.rstrip(os.sep) + '.checkpoint'
+
+
+def run_settings(input_files, file_size, file_compress):
+    """
+    :return: the settings on which the output files of a run depend, that a
+    resumed run must share.
+    """
+    return {
+        'input': [[os.path.abspath(name), os.path.getsize(name)] for name in input_files],
+        'options': extraction_fingerprint(),
+        'filter_disambig_pages': options.filter_disambig_pages,
+        'filter_category_include': sorted(options.filter_category_include),
+        'filter_category_exclude': sorted(options.filter_category_exclude),
+        'file_size': file_size,
+        'file_compress': file_compress,
+        'container': options.container,
+    }
+
+
+def save_checkpoint(path, settings, part, page, file):
+    """
+    Records that the output files before the file number :param file: hold
+    the pages before page number :param page: of dump part :param part:.
+    """
+    checkpoint = dict(settings, part=part, page=page, file=file)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    # atomically
+    getattr(os, 'replace', os.rename)(tmp_path, path)
+
+
+def load_checkpoint(path, settings):
+    """
+    :return: the (part, page, file) of the checkpoint at :param path:, where
+    to resume a run with :param settings:.
+    """
+    if not os.path.exists(path):
+        logging.warning("No checkpoint '%s': starting from the first page", path)
+        return 0, 0, 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    for key, value in settings.items():
+        if checkpoint.get(key) != value:
+            raise ValueError("cannot resume from '%s': the run had another %s" % (path, key))
+    return checkpoint['part'], checkpoint['page'], checkpoint['file']
+
+
+def process_dump(input_files, template_file, out_file, file_size, file_compress,
+                 process_count, template_store=None, unordered=False, page_store=None,
+                 resume=False):
+    """
+    :param input_files: names of the wikipedia dump files, i.e. either a
+    single dump or the parts of a split dump in order; ['-'] to read from stdin
+    :param template_file: optional file with template definitions.
+    :param out_file: directory where to store extracted data, or '-' for stdout
+    :param file_size: max size of each extracted file, or None for no max (one file)
+    :param file_compress: the codec of the files from outputCodecs, or None.
+    :param process_count: number of extraction processes to spawn.
+    :param template_store: optional compiled template store, used if it
+    exists and else created from the template definitions.
+    :param unordered: whether each extract process writes its own files, in
+    the order it extracts pages, instead of going through the reducer.
+    :param page_store: optional store of the pages extracted by previous
+    runs, whose text is reused for unchanged revisions, and updated.
+    :param resume: whether to resume an interrupted run, from its checkpoint,
+    recorded by the reducer each time it starts an output file.
+    """
+
+    process_count = max(1, process_count)
+    # temporary store of the templates shared by the extract processes
+    shared_store = None
+    supervisor = None
+    reduce = None
+
+    if input_files == ['-']:
+        input = sys.stdin
+    else:
+        # the parts are read back to back when scanning the whole dump
+        input = fileinput.FileInput(input_files, openhook=fileinput.hook_compressed)
+
+    # collect siteinfo
+    read_siteinfo(input)
+    if page_store:
+        # the urls of the pages depend on the siteinfo
+        open_page_store(page_store)
+
     if options.expand_templates:
         # preprocess
         template_load_start = default_timer()
-        if template_file:
-            if os.path.exists(template_file):
-                logging.info("Loading template definitions from: %s", template_file)
-                # can't use with here:
-                file = fileinput.FileInput(template_file,
-                                           openhook=fileinput.hook_compressed)
-                load_templates(file)
-                file.close()
-            else:
-                if input_file == '-':
-                    # can't scan then reset stdin; must error w/ suggestion to specify template_file
-                    raise ValueError("to use templates with stdin dump, must supply explicit template-file")
-                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-                load_templates(input, template_file)
-                input.close()
-                input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        if template_store and os.path.exists(template_store):
+            logging.info("Using compiled template store: %s", template_store)
+            open_template_store(template_store)
+        elif template_file and os.path.exists(template_file):
+            logging.info("Loading template definitions from: %s", template_file)
+            # can't use with here:
+            file = fileinput.FileInput(template_file,
+                                       openhook=fileinput.hook_compressed)
+            load_templates(file, process_count=process_count)
+            file.close()
+        elif template_file or template_store:
+            if input_files == ['-']:
+                # can't scan then reset stdin; must error w/ suggestion to specify template_file
+                raise ValueError("to use templates with stdin dump, must supply explicit template-file")
+            logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", ' '.join(input_files))
+            parts = input_files if len(input_files) > 1 else None
+            load_templates(input, template_file, process_count, parts)
+            input.close()
+            input = fileinput.FileInput(input_files, openhook=fileinput.hook_compressed)
+        if template_store and not isinstance(options.templates, TemplateStore):
+            save_template_store(template_store)
+            open_template_store(template_store)
+        elif options.templates and not isinstance(options.templates, TemplateStore):
+            shared_store = share_templates()
         template_load_elapsed = default_timer() - template_load_start
         logging.info("Loaded %d templates in %.1fs", len(options.templates), template_load_elapsed)
 
-    # process pages
-    logging.info("Starting page extraction from %s.", input_file)
-    extract_start = default_timer()
+    # the temporary store is removed however the extraction ends
+    try:
+        # where to start: (part, page, file)
+        start = (0, 0, 0)
+        checkpoint = None
+        if out_file != '-' and input_files != ['-'] and not unordered:
+            settings = run_settings(input_files, file_size, file_compress)
+            checkpoint = (checkpoint_path(out_file), settings)
+            if resume:
+                start = load_checkpoint(checkpoint[0], settings)
+                logging.info("Resuming from page %d of part %d, writing from file %d",
+                             start[1], start[0], start[2])
+
+        # process pages
+        logging.info("Starting page extraction from %s.", ' '.join(input_files))
+        extract_start = default_timer()
+
+        # Parallel Map/Reduce:
+        # - pages to be processed are dispatched to workers
+        # - a reduce process collects the results, sort them and print them.
+        # In unordered mode the workers print them.
+
+        maxsize = 10 * process_count
+        # output queue
+        output_queue = None if unordered else SyncQueue()
+
+        if out_file == '-':
+            out_file = None
+            if file_compress:
+                logging.warn("writing to stdout, so no output compression (use an external tool)")
+                file_compress = None
+
+        worker_count = process_count
+
+        # Pages are numbered (part, n) within each dump part. A part's length is
+        # only known once its mapper is done: it becomes the page numbering offset
+        # of the following part, so output order and file naming do not depend on
+        # which part is read faster.
+        part_count = len(input_files)
+        part_sizes = Array('i', [-1] * part_count, lock=False)
+        # part being written by the reducer, and pages written from it
+        current_part = Value('i', start[0], lock=False)
+        written_pages = Value('i', start[1], lock=False)
+        # totals of keepPage() across mappers
+        page_totals = Array('l', 3)
+
+        # load balancing: the mappers block while the pages waiting in the
+        # reducer for their turn exceed max_spool_bytes, until it notifies
+        # spool_changed
+        max_spool_bytes = 64 * 1024 * 1024
+        spool_bytes = Value('l', 0, lock=False)
+        spool_changed = Condition()
+        # time spent by the mappers blocked
+        stall_time = Value('d', 0.0)
+        # progress of each process, sampled for telemetry
+        counters = PipelineCounters(worker_count, part_count) if options.telemetry_file else None
+
+        # jobs done by the workers, and received by the reducer
+        done_queue = SyncQueue()
+
+        if not unordered:
+            # reduce job that sorts and prints output
+            reduce = Process(target=reduce_process,
+                             args=(options, output_queue, part_count, spool_bytes,
+                                   current_part, written_pages, spool_changed,
+                                   out_file, file_size, file_compress, counters,
+                                   done_queue, checkpoint, start))
+            reduce.start()
+
+        # initialize jobs queue
+        jobs_queue = Queue(maxsize=maxsize)
+        # counters of the workers, sent when they are done
+        stats_queue = SyncQueue()
+        if counters:
+            telemetry = TelemetryWriter(options.telemetry_file, options.telemetry_interval,
+                                        counters, jobs_queue, output_queue, spool_bytes)
+
+        def start_worker(i, restarts, worker_queue):
+            worker_output = None
+            if unordered:
+                # each worker writes its own file sequence, and a new one when
+                # restarted
+                name = 'W%02d.%d' % (i, restarts) if restarts else 'W%02d' % i
+                worker_output = os.path.join(out_file, name)
+            extractor = Process(target=extract_process,
+                                args=(options, i, worker_queue, output_queue, stats_queue,
+                                      worker_output, file_size, file_compress, counters,
+                                      done_queue, supervisor.progress))
+            extractor.daemon = True  # only live while parent process lives
+            extractor.start()
+            return extractor
+
+        # start worker processes
+        logging.info("Using %d extract processes.", worker_count)
+        supervisor = Supervisor(jobs_queue, done_queue, start_worker, worker_count, unordered)
+        supervisor.start_workers()
+        supervisor.start()
+
+        flow = (spool_bytes, max_spool_bytes, current_part, written_pages,
+                spool_changed, stall_time)
+        if counters:
+            telemetry.start()
+        if part_count == 1:
+            # Mapper process
+            part_sizes[0] = map_pages(0, input, jobs_queue, output_queue, flow, page_totals,
+                                      counters, start[1])
+            input.close()
+        else:
+            # each part gets its own reader and mapper
+            input.close()
+            logging.info("Using %d mapper processes, one per dump part.", part_count)
+            mappers = []
+            for part, part_file in enumerate(input_files):
+                if part < start[0]:
+                    # written by the run resumed
+                    part_sizes[part] = 0
+                    continue
+                skip = start[1] if part == start[0] else 0
+                mapper = Process(target=map_process,
+                                 args=(options, part, part_file, jobs_queue, output_queue,
+                                       flow, part_sizes, page_totals, counters, skip))
+                mapper.daemon = True
+                mapper.start()
+                mappers.append(mapper)
+            for m in mappers:
+                m.join()
+        page_num = sum(part_sizes) - start[1]
+
+        # signal termination
+        jobs_queue.put(None)
+        # collect the counters of the workers, then wait for them to terminate
+        stats = {}
+        for _ in range(worker_count):
+            merge_stats(stats, stats_queue.get())
+        supervisor.join()
+
+        if not unordered:
+            # signal end of work to reduce process
+            output_queue.put(None)
+            # wait for it to finish
+            reduce.join()
+        if counters:
+            telemetry.stop()
+    finally:
+        if supervisor:
+            # no extract process may open the store once removed
+            supervisor.stop()
+        if reduce and reduce.is_alive():
+            # the run failed: the reducer would wait for the pages forever
+            reduce.terminate()
+            reduce.join()
+        if shared_store:
+            remove_template_store(shared_store)
+
+    extract_duration = default_timer() - extract_start
+    extract_rate = page_num / extract_duration
+    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
+                 process_count, page_num, extract_duration, extract_rate)
+    logging.info("total of page: %d, total of articl page: %d; total of used articl page: %d" % tuple(page_totals))
+    if stall_time.value:
+        logging.info("Mappers stalled %.1fs waiting for the reducer", stall_time.value)
+    report_stats(stats)
+    supervisor.report()
+
 
-    # Parallel Map/Reduce:
-    # - pages to be processed are dispatched to workers
-    # - a reduce process collects the results, sort them and print them.
+# max bytes of the pages sent to an extract process at once: long articles
+# make smaller batches
+maxBatchBytes = 1024 * 1024
+
+# pages from this size are sent to an extract process on their own, so that
+# the pages batched with them are not written after them
+largePageBytes = 256 * 1024
+
+def map_pages(part, input, jobs_queue, output_queue, flow, page_totals, counters=None, skip=0):
+    """
+    Dispatch to the extract processes the pages of a dump part that
+    keepPage() accepts, in batches of options.batch_size pages at most.
+    :param part: index of the dump part.
+    :param input: the lines of the dump part.
+    :param output_queue: where to tell the reducer where the part ends, if any.
+    :param flow: (spool_bytes, max_spool_bytes, current_part, written_pages,
+    spool_changed, stall_time) for blocking while the reducer is behind.
+    :param page_totals: shared page counts, incremented with those of keepPage().
+    :param counters: PipelineCounters where to count the pages read, if any.
+    :param skip: number of pages not to dispatch, written by a resumed run.
+    :return: the number of pages of the part, dispatched or skipped.
+    """
+    global g_page_total, g_page_articl_total, g_page_articl_used_total
+    spool_bytes, max_spool_bytes, current_part, written_pages, spool_changed, stall_time = flow
+
+    def must_wait(first):
+        # Only block while the reducer can make progress without us:
+        # a later part waits for its turn, while the part being written
+        # waits only if some of its pages are still pending.
+        if spool_bytes.value <= max_spool_bytes:
+            return False
+        if part > current_part.value:
+            return True
+        return first > written_pages.value
+
+    def dispatch(first, batch):
+        if must_wait(first):
+            stall_start = default_timer()
+            with spool_changed:
+                while must_wait(first):
+                    spool_changed.wait()
+            with stall_time.get_lock():
+                stall_time.value += default_timer() - stall_start
+        job = ((part, first), batch)
+        jobs_queue.put(job) # goes to any available extract_process
 
-    process_count = max(1, process_count)
-    maxsize = 10 * process_count
-    # output queue
-    output_queue = Queue(maxsize=maxsize)
-
-    if out_file == '-':
-        out_file = None
-
-    worker_count = process_count
-
-    # load balancing
-    max_spool_length = 10000
-    spool_length = Value('i', 0, lock=False)
-
-    # reduce job that sorts and prints output
-    reduce = Process(target=reduce_process,
-                     args=(options, output_queue, spool_length,
-                           out_file, file_size, file_compress))
-    reduce.start()
-
-    # initialize jobs queue
-    jobs_queue = Queue(maxsize=maxsize)
-
-    # start worker processes
-    logging.info("Using %d extract processes.", worker_count)
-    workers = []
-    for i in range(worker_count):
-        extractor = Process(target=extract_process,
-                            args=(options, i, jobs_queue, output_queue))
-        extractor.daemon = True  # only live while parent process lives
-        extractor.start()
-        workers.append(extractor)
-
-    # Mapper process
     page_num = 0
-    for page_data in pages_from(input):
+    batch = []                  # (id, revid, title, page) of pages from batch_start
+    batch_start = 0
+    batch_bytes = 0
+    for page_data in pages_from(input, articleKeys):
         id, revid, title, ns, catSet, page = page_data
+        page_bytes = sum(len(line) for line in page)
+        if counters:
+            counters.mapper_pages[part] += 1
+            counters.mapper_bytes[part] += sum(len(line.encode('utf-8'))
+                                               for line in page)
         if keepPage(ns, catSet, page):
-            # slow down
-            delay = 0
-            if spool_length.value > max_spool_length:
-                # reduce to 10%
-                while spool_length.value > max_spool_length/10:
-                    time.sleep(10)
-                    delay += 10
-            if delay:
-                logging.info('Delay %ds', delay)
-            job = (id, revid, title, page, page_num)
-            jobs_queue.put(job) # goes to any available extract_process
+            if page_num < skip:
+                page_num += 1
+                batch_start = page_num
+                continue
+            if page_bytes >= largePageBytes and batch:
+                dispatch(batch_start, batch)
+                batch = []
+                batch_start = page_num
+                batch_bytes = 0
+            batch.append((id, revid, title, page))
+            batch_bytes += page_bytes
             page_num += 1
+            if (len(batch) >= options.batch_size or batch_bytes >= maxBatchBytes or
+                    page_bytes >= largePageBytes):
+                dispatch(batch_start, batch)
+                batch = []
+                batch_start = page_num
+                batch_bytes = 0
         page = None             # free memory
+    if batch:
+        dispatch(batch_start, batch)
+    batch = None
+    if output_queue:
+        # the page after the last one, with no text
+        output_queue.put(((part, page_num), None))
+
+    with page_totals.get_lock():
+        page_totals[0] += g_page_total
+        page_totals[1] += g_page_articl_total
+        page_totals[2] += g_page_articl_used_total
+    g_page_total = g_page_articl_total = g_page_articl_used_total = 0
+    return page_num
+
+
+def map_process(opts, part, input_file, jobs_queue, output_queue, flow, part_sizes, page_totals,
+                counters=None, skip=0):
+    """Read one part of a split dump and dispatch its pages to the extractors.
+    :param part: index of the part, numbering its pages.
+    :param input_file: name of the dump part.
+    :param part_sizes: where to publish the number of pages of the part.
+    :param skip: number of pages not to dispatch, written by a resumed run.
+    """
 
-    input.close()
-
-    # signal termination
-    for _ in workers:
-        jobs_queue.put(None)
-    # wait for workers to terminate
-    for w in workers:
-        w.join()
+    global options
+    options = opts
 
-    # signal end of work to reduce process
-    output_queue.put(None)
-    # wait for it to finish
-    reduce.join()
+    createLogger(options.quiet, options.debug, options.log_file)
 
-    extract_duration = default_timer() - extract_start
-    extract_rate = page_num / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, page_num, extract_duration, extract_rate)
-    logging.info("total of page: %d, total of articl page: %d; total of used articl page: %d" % (g_page_total, g_page_articl_total,g_page_articl_used_total))
+    input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+    # each part repeats the <siteinfo> header
+    read_siteinfo(input)
+    part_sizes[part] = map_pages(part, input, jobs_queue, output_queue, flow, page_totals,
+                                 counters, skip)
+    input.close()
+    logging.info("Read %d pages from part %d: %s", part_sizes[part], part, input_file)
 
 
 # ----------------------------------------------------------------------
 # Multiprocess support
 
 
-def extract_process(opts, i, jobs_queue, output_queue):
+# time an extract process has waited for jobs
+queue_wait = 0.0
+# pages extracted without templates by an extract process, over their budget
+page_timeouts = 0
+
+
+class PageTimeout(BaseException):
+    """
+    A page exceeded its CPU budget. Not an Exception, so that the handlers
+    of expansion errors let it through.
+    """
+
+
+def on_page_timeout(signum, frame):
+    if frame is not None and frame.f_code is extract_page.__code__:
+        # the extraction returned: the page is complete, only the timer
+        # was not disarmed yet
+        return
+    raise PageTimeout()
+
+
+def extract_page(id, revid, title, page, out):
+    """
+    Extract a page into :param out:, within options.page_budget seconds of
+    CPU when set: past them, the page is extracted again without expanding
+    templates, and its id is logged.
+    :return: whether the page was extracted in full, within its budget.
+    """
+    global page_timeouts
+    if not options.page_budget:
+        Extractor(id, revid, title, page).extract(out)
+        return True
+    signal.setitimer(signal.ITIMER_VIRTUAL, options.page_budget)
+    try:
+        Extractor(id, revid, title, page).extract(out)
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+        return True
+    except PageTimeout:
+        logging.warning('Page %s %s exceeded its budget of %gs of CPU: extracting it without templates',
+                        id, title, options.page_budget)
+    except:
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+        raise
+    page_timeouts += 1
+    out.truncate(0)
+    out.seek(0)
+    options.expand_templates = False
+    try:
+        Extractor(id, revid, title, page).extract(out)
+    finally:
+        options.expand_templates = True
+    return False
+
+
+def extract_process(opts, i, jobs_queue, output_queue, stats_queue,
+                    out_file=None, file_size=0, file_compress=None, counters=None,
+                    done_queue=None, progress=None):
     """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
     :param i: process id.
     :param jobs_queue: where to get jobs.
     :param output_queue: where to queue extracted text for output.
+    :param stats_queue: where to put the counters of the process when done.
+    :param out_file: directory where to write the text instead, unordered.
+    :param file_size: max file size.
+    :param file_compress: the output codec, or None.
+    :param counters: PipelineCounters where to count the pages extracted, if any.
+    :param done_queue: where to tell the Supervisor when done with a job.
+    :param progress: where to publish the progress of the process for the
+    Supervisor, as it describes.
     """
 
-    global options
+    global options, queue_wait
     options = opts
 
     createLogger(options.quiet, options.debug, options.log_file)
 
     out = StringIO()                 # memory buffer
-
+    if out_file:
+        output = open_output(NextFile(out_file), file_size, file_compress)
+    if options.page_budget:
+        signal.signal(signal.SIGVTALRM, on_page_timeout)
 
     while True:
-        job = jobs_queue.get()  # job is (id, title, page, page_num)
+        wait_start = default_timer()
+        job = jobs_queue.get()  # job is (page_num, [(id, revid, title, page)])
+        queue_wait += default_timer() - wait_start
+        if counters:
+            counters.worker_idle[i] = queue_wait
         if job:
-            id, revid, title, page, page_num = job
-            try:
-                e = Extractor(*job[:4]) # (id, revid, title, page)
-                page = None              # free memory
-                e.extract(out)
-                text = out.getvalue()
-            except:
-                text = ''
-                logging.exception('Processing page: %s %s', id, title)
-
-            output_queue.put((page_num, text))
-            out.truncate(0)
-            out.seek(0)
+            page_num, batch = job
+            job = None
+            ids = [page_data[0] for page_data in batch] if options.container else None
+            texts = []
+            if progress is not None:
+                progress[4 * i:4 * i + 2] = page_num
+            # texts of the unchanged pages, extracted by a previous run
+            stored = options.pageStore.lookup(batch) if options.pageStore else {}
+            while batch:
+                if progress is not None:
+                    progress[4 * i + 2] = len(texts)
+                id, revid, title, page = batch.pop(0)
+                if id in stored:
+                    texts.append(stored.pop(id))
+                    continue
+                if page is None:
+                    # skipped by the Supervisor
+                    texts.append('')
+                    continue
+                try:
+                    complete = extract_page(id, revid, title, page, out)
+                    page = None              # free memory
+                    text = out.getvalue()
+                    if options.pageStore and complete:
+                        options.pageStore.add(id, revid, text)
+                except:
+                    text = ''
+                    logging.exception('Processing page: %s %s', id, title)
+                texts.append(text)
+                out.truncate(0)
+                out.seek(0)
+
+            chunks = output_chunks(texts, file_compress, ids)
+            if counters:
+                counters.worker_pages[i] += len(texts)
+            texts = None
+            if out_file:
+                for pages, size, data in chunks:
+                    output.write(data, size)
+                # the job is done once written
+                output.flush()
+            else:
+                output_queue.put((page_num, chunks))
+            if progress is not None:
+                progress[4 * i + 2] = -1
+                progress[4 * i + 3] += 1
+                done_queue.put(i)
         else:
             logging.debug('Quit extractor')
             break
     out.close()
+    if out_file:
+        output.close()
+    if options.parsedTemplates:
+        options.parsedTemplates.flush()
+    if options.pageStore:
+        options.pageStore.flush()
+    stats_queue.put(extractor_stats())
+
+
+def extractor_stats():
+    """
+    :return: the counters of this extract process, merged at the end of the run.
+    """
+    stats = {'queue_wait': queue_wait, 'page_timeouts': page_timeouts}
+    if options.expansionCache is not None:
+        stats['expansion_cache'] = options.expansionCache.stats()
+    stats['expr_cache'] = exprCache.stats()
+    if options.stageTimes is not None:
+        stats['stage_times'] = options.stageTimes.stats()
+    if options.templateProfile is not None:
+        stats['template_profile'] = options.templateProfile.stats()
+    if options.pageStore:
+        stats['page_store'] = options.pageStore.stats()
+    return stats
+
+
+def report_stats(stats):
+    """
+    Logs the counters merged from the extract processes.
+    """
+    if stats.get('queue_wait'):
+        logging.info("Extract processes waited %.1fs for jobs", stats['queue_wait'])
+    if stats.get('page_timeouts'):
+        logging.info("%d pages exceeded their CPU budget, extracted without templates",
+                     stats['page_timeouts'])
+    cache = stats.get('expansion_cache')
+    if cache:
+        lookups = cache['hits'] + cache['misses']
+        logging.info("Template expansion cache: %d hits, %d misses (%.1f%% hit rate), %d not cacheable",
+                     cache['hits'], cache['misses'],
+                     100.0 * cache['hits'] / lookups if lookups else 0, cache['bypassed'])
+    cache = stats.get('expr_cache')
+    if cache and cache['hits'] + cache['misses']:
+        logging.info("Expression cache: %d hits, %d misses",
+                     cache['hits'], cache['misses'])
+    store = stats.get('page_store')
+    if store:
+        logging.info("Page store: %d unchanged pages reused, %d pages extracted",
+                     store['reused'], store['extracted'])
+    stages = stats.get('stage_times')
+    if stages is not None:
+        report_stage_times(stages)
+    profile = stats.get('template_profile')
+    if profile is not None:
+        report_template_profile(profile, options.template_profile)
+
+
+def report_template_profile(profile, top):
+    """
+    Logs the :param top: templates and parser functions of :param profile:
+    taking the most time, including the templates they expand.
+    """
+    names = sorted(profile, key=lambda name: profile[name]['inclusive'], reverse=True)
+    logging.info("Template profile: %d templates and parser functions, top %d:",
+                 len(profile), min(top, len(profile)))
+    logging.info("%10s %10s %10s %6s  %s", 'inclusive', 'exclusive', 'calls', 'limits', 'name')
+    for name in names[:top]:
+        entry = profile[name]
+        logging.info("%9.2fs %9.2fs %10d %6d  %s", entry['inclusive'], entry['exclusive'],
+                     entry['calls'], entry['limit_hits'], name)
+
+
+def report_stage_times(stages):
+    """
+    Logs the merged stage times, or writes them as JSON to
+    options.stage_times_file.
+    """
+    if options.stage_times_file:
+        with open(options.stage_times_file, 'w') as file:
+            json.dump(stages, file, indent=1, sort_keys=True)
+        logging.info("Stage times written to %s", options.stage_times_file)
+        return
+    total = sum(times['seconds'] for times in stages.values())
+    for stage in ('transform', 'wiki2text', 'clean', 'compact'):
+        times = stages.get(stage)
+        if not times:
+            continue
+        histogram = times['histogram']
+        logging.info("Stage %s: %d pages, %.1fs (%.1f%%), median < %dus, 90%% < %dus, 99%% < %dus",
+                     stage, times['count'], times['seconds'],
+                     100.0 * times['seconds'] / total if total else 0,
+                     histogram_percentile(histogram, 0.5),
+                     histogram_percentile(histogram, 0.9),
+                     histogram_percentile(histogram, 0.99))
 
 
 report_period = 10000           # progress report period
-def reduce_process(opts, output_queue, spool_length,
-                   out_file=None, file_size=0, file_compress=True):
+def reduce_process(opts, output_queue, part_count, spool_bytes,
+                   current_part, written_pages, spool_changed,
+                   out_file=None, file_size=0, file_compress=None, counters=None,
+                   done_queue=None, checkpoint=None, start=(0, 0, 0)):
     """Pull finished article text, write series of files (or stdout)
     :param opts: global parameters.
     :param output_queue: text to be output.
-    :param spool_length: spool length.
+    :param part_count: number of dump parts.
+    :param spool_bytes: where to publish the size of the pages waiting.
+    :param current_part: where to publish the dump part being written.
+    :param written_pages: where to publish the pages written from it.
+    :param spool_changed: condition to notify the mappers of the progress.
     :param out_file: filename where to print.
     :param file_size: max file size.
-    :param file_compress: whether to compress output.
+    :param file_compress: the codec of the chunks output, or None.
+    :param counters: PipelineCounters where to count the pages written, if any.
+    :param done_queue: where to tell the Supervisor which pages are received.
+    :param checkpoint: (path, settings) of the checkpoint to save each time an
+    output file is started, if any.
+    :param start: the (part, page, file) to start from.
     """
 
     global options
@@ -3061,45 +5422,97 @@ def reduce_process(opts, output_queue, spool_length,
     createLogger(options.quiet, options.debug, options.log_file)
 
     if out_file:
-        nextFile = NextFile(out_file)
-        output = OutputSplitter(nextFile, file_size, file_compress)
+        nextFile = NextFile(out_file, start[2])
+        output = open_output(nextFile, file_size, file_compress)
     else:
         output = sys.stdout if PY2 else sys.stdout.buffer
-        if file_compress:
-            logging.warn("writing to stdout, so no output compression (use an external tool)")
 
     interval_start = default_timer()
-    # FIXME: use a heap
-    spool = {}        # collected pages
-    next_page = 0     # sequence numbering of page
+    spool = []        # heap of collected pages
+    spool_size = 0    # bytes in spool
+    max_spool_size = 0
+    part_ends = {}    # number of pages of the parts read so far
+    received = set()  # page numbers of the spool
+    part = start[0]   # dump part being written
+    next_page = start[1]  # sequence numbering of page within the part
+    page_count = 0    # pages written from all parts
+    reported = 0      # page_count at the last progress report
+    queue_wait = 0.0  # time spent waiting for pages
+    finished = False
     while True:
-        if next_page in spool:
-            output.write(spool.pop(next_page).encode('utf-8'))
-            next_page += 1
-            # tell mapper our load:
-            spool_length.value = len(spool)
-            # progress report
-            if next_page % report_period == 0:
-                interval_rate = report_period / (default_timer() - interval_start)
-                logging.info("Extracted %d articles (%.1f art/s)",
-                             next_page, interval_rate)
-                interval_start = default_timer()
+        if spool and spool[0][0] == (part, next_page):
+            page_num, chunks = heapq.heappop(spool)
+            received.discard(page_num)
+            for pages, size, data in chunks:
+                spool_size -= len(data)
+                if out_file:
+                    file_index = nextFile.index
+                    output.write(data, size)
+                    if checkpoint and nextFile.index != file_index:
+                        # the pages before are in complete files
+                        save_checkpoint(checkpoint[0], checkpoint[1], part, next_page,
+                                        nextFile.index)
+                else:
+                    output.write(data)
+                next_page += pages
+                page_count += pages
+                if counters:
+                    counters.reducer_pages.value += pages
+                    counters.reducer_bytes.value += len(data)
+                # progress report
+                if page_count - reported >= report_period:
+                    interval_rate = (page_count - reported) / (default_timer() - interval_start)
+                    logging.info("Extracted %d articles (%.1f art/s)",
+                                 page_count, interval_rate)
+                    interval_start = default_timer()
+                    reported = page_count
+        elif part_ends.get(part) == next_page and part + 1 < part_count:
+            # the part is complete: its size is the offset of the next one
+            part += 1
+            next_page = 0
+        elif finished:
+            if spool:
+                logging.error('Missing pages, %d left unwritten', len(spool))
+            break
         else:
-            # mapper puts None to signal finish
+            # tell mappers our load before waiting for more pages
+            with spool_changed:
+                spool_bytes.value = spool_size
+                current_part.value = part
+                written_pages.value = next_page
+                spool_changed.notify_all()
+            wait_start = default_timer()
+            # main process puts None to signal finish
             pair = output_queue.get()
+            queue_wait += default_timer() - wait_start
             if not pair:
-                break
-            page_num, text = pair
-            spool[page_num] = text
-            # tell mapper our load:
-            spool_length.value = len(spool)
-            # FIXME: if an extractor dies, process stalls; the other processes
-            # continue to produce pairs, filling up memory.
+                finished = True
+                continue
+            # the output chunks of a batch of pages from page_num
+            page_num, chunks = pair
+            if chunks is None:
+                # a mapper is done with a part
+                part_ends[page_num[0]] = page_num[1]
+                continue
+            if done_queue:
+                done_queue.put((None, page_num))
+            if page_num < (part, next_page) or page_num in received:
+                # extracted again after its process died
+                continue
+            received.add(page_num)
+            heapq.heappush(spool, (page_num, chunks))
+            spool_size += sum(len(data) for pages, size, data in chunks)
+            max_spool_size = max(max_spool_size, spool_size)
             if len(spool) > 200:
-                logging.debug('Collected %d, waiting: %d, %d', len(spool),
-                              next_page, next_page == page_num)
+                logging.debug('Collected %d, waiting: %s, %s', len(spool),
+                              (part, next_page), (part, next_page) == page_num)
     if output != sys.stdout:
         output.close()
+    if checkpoint and not spool and os.path.exists(checkpoint[0]):
+        # complete
+        os.remove(checkpoint[0])
+    logging.info("Reducer waited %.1fs for pages, buffering up to %d bytes",
+                 queue_wait, max_spool_size)
 
 
 # ----------------------------------------------------------------------
@@ -3112,8 +5525,8 @@ def main():
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=__doc__)
-    parser.add_argument("input",
-                        help="XML wiki dump file")
+    parser.add_argument("input", nargs='+',
+                        help="XML wiki dump file, or the parts of a split dump (a list or glob)")
     groupO = parser.add_argument_group('Output')
     groupO.add_argument("-o", "--output", default="text",
                         help="directory for extracted files (or '-' for dumping to stdout)")
@@ -3121,9 +5534,22 @@ def main():
                         help="maximum bytes per output file (default %(default)s)",
                         metavar="n[KMG]")
     groupO.add_argument("-c", "--compress", action="store_true",
-                        help="compress output files using bzip")
+                        help="compress output files (using bzip unless --codec)")
+    groupO.add_argument("--codec", default="bz2", choices=sorted(outputCodecs),
+                        help="compression codec of output files (default %(default)s)")
     groupO.add_argument("--json", action="store_true",
                         help="write output in json format instead of the default one")
+    groupO.add_argument("--plain_tokens", action="store_true",
+                        help="write only the text of the body of each page, for counting words: no document"
+                             " wrapper, title, sections, lists or placeholders")
+    groupO.add_argument("--container", action="store_true",
+                        help="write each output file as an article container (.wac), whose articles"
+                             " can be read by page id or in parallel: see article_container.py")
+    groupO.add_argument("--unordered", action="store_true",
+                        help="each process writes its own files, in no particular article order")
+    groupO.add_argument("--resume", action="store_true",
+                        help="resume an interrupted run from the last output file it started,"
+                             " recorded in OUTPUT.checkpoint")
 
 
     groupP = parser.add_argument_group('Processing')
@@ -3139,6 +5565,12 @@ def main():
                         help="accepted namespaces in links")
     groupP.add_argument("--templates",
                         help="use or create file containing templates")
+    groupP.add_argument("--template_store",
+                        help="use or create a compiled (SQLite) store of the cleaned templates, "
+                             "much faster to load than --templates")
+    groupP.add_argument("--incremental", metavar="file",
+                        help="keep the extracted pages in a SQLite store, and reuse those whose revision"
+                             " is unchanged in the next runs (template changes are not seen)")
     groupP.add_argument("--no_templates", action="store_false",
                         help="Do not expand templates")
     groupP.add_argument("-r", "--revision", action="store_true", default=options.print_revision,
@@ -3153,9 +5585,16 @@ def main():
                         help="comma separated list of elements that will be removed from the article text")
     groupP.add_argument("--keep_tables", action="store_true", default=options.keep_tables,
                         help="Preserve tables in the output article text (default=%(default)s)")
+    groupP.add_argument("--expansion_cache", type=int, default=10000, metavar="n",
+                        help="memoize up to n template expansions in each process, 0 to disable (default=%(default)s)")
     default_process_count = max(1, cpu_count() - 1)
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    parser.add_argument("--batch_size", type=int, default=options.batch_size, metavar="n",
+                        help="max pages sent to a process at once, fewer when they exceed 1MB (default %(default)s)")
+    parser.add_argument("--page_budget", type=float, default=options.page_budget, metavar="seconds",
+                        help="seconds of CPU to extract a page, past which it is extracted without"
+                             " templates, 0 for no limit (default %(default)s)")
 
     groupS = parser.add_argument_group('Special')
     groupS.add_argument("-q", "--quiet", action="store_true",
@@ -3166,6 +5605,18 @@ def main():
                         help="analyze a file containing a single article (debug option)")
     groupS.add_argument("--log_file",
                         help="path to save the log info")
+    groupS.add_argument("--stage_times", action="store_true",
+                        help="time the stages of the extraction of each page, and report them at the end")
+    groupS.add_argument("--stage_times_json", metavar="file",
+                        help="time the stages as --stage_times, writing the histograms as JSON to file")
+    groupS.add_argument("--telemetry", metavar="file",
+                        help="write snapshots of the queues and of the throughput of each process to a"
+                             " JSONL file")
+    groupS.add_argument("--telemetry_interval", type=float, default=options.telemetry_interval,
+                        metavar="seconds", help="period of the telemetry snapshots (default %(default)s)")
+    groupS.add_argument("--template_profile", type=int, default=0, metavar="n",
+                        help="time the expansion of each template and parser function, and report the n"
+                             " taking the most time at the end")
     groupS.add_argument("-v", "--version", action="version",
                         version='%(prog)s ' + version,
                         help="print program version")
@@ -3183,10 +5634,32 @@ def main():
     options.min_text_length = args.min_text_length
     if args.html:
         options.keepLinks = True
+    options.plain_tokens = args.plain_tokens
+    options.container = args.container
+    if args.plain_tokens:
+        if args.html or args.json or args.links or args.sections or args.lists:
+            logging.warning('--plain_tokens ignores --html, --json, --links, --sections and --lists')
+        options.toHTML = options.write_json = False
+        options.keepLinks = options.keepSections = options.keepLists = False
 
     options.expand_templates = args.no_templates
+    options.batch_size = max(1, args.batch_size)
+    if args.page_budget > 0 and not hasattr(signal, 'setitimer'):
+        logging.warning('--page_budget needs interval timers, not available here')
+    elif args.page_budget > 0 and options.expand_templates:
+        options.page_budget = args.page_budget
+    if args.expansion_cache > 0:
+        options.expansionCache = LRUCache(args.expansion_cache)
     options.filter_disambig_pages = args.filter_disambig_pages
     options.keep_tables = args.keep_tables
+    if args.stage_times or args.stage_times_json:
+        options.stageTimes = StageTimes()
+        options.stage_times_file = args.stage_times_json
+    options.telemetry_file = args.telemetry
+    options.telemetry_interval = args.telemetry_interval
+    if args.template_profile > 0:
+        options.templateProfile = TemplateProfile()
+        options.template_profile = args.template_profile
 
     try:
         power = 'kmg'.find(args.bytes[-1].lower()) + 1
@@ -3226,7 +5699,10 @@ def main():
     options.log_file = args.log_file
     createLogger(options.quiet, options.debug, options.log_file)
 
-    input_file = args.input
+    input_files = expand_dump_parts(args.input)
+    if '-' in input_files and len(input_files) > 1:
+        logging.error('Cannot read stdin together with other dump parts')
+        return
 
     if not options.keepLinks:
         ignoreTag('a')
@@ -3236,19 +5712,33 @@ def main():
     # templateCache = manager.dict()
 
     if args.article:
-        if args.templates:
+        if args.template_store and os.path.exists(args.template_store):
+            open_template_store(args.template_store)
+        elif args.templates:
             if os.path.exists(args.templates):
                 with open(args.templates) as file:
                     load_templates(file)
 
-        file = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        file = fileinput.FileInput(input_files, openhook=fileinput.hook_compressed)
         for page_data in pages_from(file):
             id, revid, title, ns,catSet, page = page_data
             Extractor(id, revid, title, page).extract(sys.stdout)
         file.close()
+        if options.parsedTemplates:
+            options.parsedTemplates.flush()
+        report_stats(extractor_stats())
         return
 
     output_path = args.output
+    if args.unordered and output_path == '-':
+        logging.error('Unordered output needs an output directory')
+        return
+    if args.container and output_path == '-':
+        logging.error('Container output needs an output directory')
+        return
+    if args.resume and (args.unordered or output_path == '-' or input_files == ['-']):
+        logging.error('Only runs reading files and writing ordered files to a directory can be resumed')
+        return
     if output_path != '-' and not os.path.isdir(output_path):
         try:
             os.makedirs(output_path)
@@ -3278,8 +5768,10 @@ def main():
             logging.info("Including categories:")
             logging.info(str(len(options.filter_category_include)))
 
-    process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes)
+    file_compress = args.codec if args.compress else None
+    process_dump(input_files, args.templates, output_path, file_size,
+                 file_compress, args.processes, args.template_store,
+                 args.unordered, args.incremental, args.resume)
 
 def createLogger(quiet, debug, log_file):
     logger = logging.getLogger()
@@ -0,0 +1,165 @@
+"""
+Reader of the article containers written by WikiExtractor --container.
+
+A container holds the extracted articles of one output file as records that can be
+read one at a time, by page id or by byte range, without scanning the file:
+
+    header   8s magic, 8s codec ("", "bz2", "gzip" or "lzma"), NUL padded
+    records  <QI page id, length of the data, then the data: the UTF-8 text of
+             the article, compressed with the codec if any
+    index    <QQ page id, offset of its record, for each record in file order
+    footer   <QQ8s offset of the index, number of records, magic
+
+The records are in the order of the articles, so their offsets increase, and a
+byte range of the file holds the records that start in it. Consumers can split
+the containers into shards of about the same size and read them in parallel.
+A container whose writer was interrupted has no footer: its records are found by
+scanning them from the header instead.
+"""
+
+import bisect
+import bz2
+import gzip
+import lzma
+import os
+import struct
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+MAGIC = b"WIKIART\x01"
+HEADER = struct.Struct("<8s8s")
+RECORD = struct.Struct("<QI")
+ENTRY = struct.Struct("<QQ")
+FOOTER = struct.Struct("<QQ8s")
+
+DECOMPRESS: Dict[str, Callable[[bytes], bytes]] = {
+    "": lambda data: data,
+    "bz2": bz2.decompress,
+    "gzip": gzip.decompress,
+    "lzma": lzma.decompress,
+}
+
+
+class Shard(NamedTuple):
+    """The records of a container starting in a byte range."""
+
+    path: str
+    start: int
+    end: int
+
+
+def is_container(path: str) -> bool:
+    """Tell whether the file is an article container."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class ArticleContainer:
+    """Random access to the articles of a container file."""
+
+    def __init__(self, path: str) -> None:
+        """Open the container and load its index."""
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            magic, codec = HEADER.unpack(self._file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an article container")
+            codec_name = codec.rstrip(b"\0").decode("ascii")
+            if codec_name not in DECOMPRESS:
+                raise ValueError(f"{path} has unknown codec {codec_name}")
+            self.codec = codec_name
+            self._decompress = DECOMPRESS[codec_name]
+            self._ids, self._offsets, self.records_end = self._load_index()
+        except BaseException:
+            self._file.close()
+            raise
+        self._positions = {page_id: i for i, page_id in enumerate(self._ids)}
+
+    def _load_index(self) -> Tuple[List[int], List[int], int]:
+        """Return the ids and offsets of the records, and where the records end."""
+        size = os.fstat(self._file.fileno()).st_size
+        if size >= HEADER.size + FOOTER.size:
+            self._file.seek(size - FOOTER.size)
+            index_offset, count, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+            index_end = index_offset + count * ENTRY.size
+            if magic == MAGIC and index_end + FOOTER.size == size:
+                self._file.seek(index_offset)
+                index = self._file.read(count * ENTRY.size)
+                ids = [page_id for page_id, offset in ENTRY.iter_unpack(index)]
+                offsets = [offset for page_id, offset in ENTRY.iter_unpack(index)]
+                return ids, offsets, index_offset
+        return self._scan(size)
+
+    def _scan(self, size: int) -> Tuple[List[int], List[int], int]:
+        """Find the complete records of a container without footer."""
+        ids: List[int] = []
+        offsets: List[int] = []
+        offset = HEADER.size
+        self._file.seek(offset)
+        while offset + RECORD.size <= size:
+            page_id, length = RECORD.unpack(self._file.read(RECORD.size))
+            if offset + RECORD.size + length > size:
+                break
+            ids.append(page_id)
+            offsets.append(offset)
+            offset += RECORD.size + length
+            self._file.seek(offset)
+        return ids, offsets, offset
+
+    def close(self) -> None:
+        """Close the container file."""
+        self._file.close()
+
+    def __enter__(self) -> "ArticleContainer":
+        """Return the container, closed on exit."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the container."""
+        self.close()
+
+    def __len__(self) -> int:
+        """Return the number of articles."""
+        return len(self._ids)
+
+    def __contains__(self, page_id: int) -> bool:
+        """Tell whether the container holds the article with the page id."""
+        return page_id in self._positions
+
+    def __getitem__(self, page_id: int) -> str:
+        """Return the text of the article with the page id."""
+        return self.read_record(self._offsets[self._positions[page_id]])[1]
+
+    def ids(self) -> List[int]:
+        """Return the page ids of the articles, in file order."""
+        return list(self._ids)
+
+    def read_record(self, offset: int) -> Tuple[int, str]:
+        """Return the page id and text of the record at the offset."""
+        self._file.seek(offset)
+        page_id, length = RECORD.unpack(self._file.read(RECORD.size))
+        return page_id, self._decompress(self._file.read(length)).decode("utf-8")
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        """Yield the page id and text of each article, in file order."""
+        return self.read_range(HEADER.size, self.records_end)
+
+    def read_range(self, start: int, end: int) -> Iterator[Tuple[int, str]]:
+        """Yield the page id and text of the records starting in [start, end)."""
+        first = bisect.bisect_left(self._offsets, start)
+        last = bisect.bisect_left(self._offsets, end)
+        for offset in self._offsets[first:last]:
+            yield self.read_record(offset)
+
+
+def shards(path: str, count: int) -> List[Shard]:
+    """Split a container into count byte ranges of about the same size."""
+    size = os.path.getsize(path)
+    bounds = [HEADER.size + (size - HEADER.size) * i // count for i in range(count)]
+    return [Shard(path, start, end) for start, end in zip(bounds, bounds[1:] + [size])]
+
+
+def read_shard(shard: Shard) -> Iterator[Tuple[int, str]]:
+    """Yield the page id and text of each article of the shard."""
+    with ArticleContainer(shard.path) as container:
+        yield from container.read_range(shard.start, shard.end)
@@ -0,0 +1,200 @@
+"""
+Benchmarks of WikiExtractor on pathological pages.
+
+Each case builds wikitext out of n copies of a unit, such as a link or a template
+call, and times one stage of the extractor on it for growing n. The time per unit
+stays flat when the stage scales linearly. Since the units are independent, the
+output for n units must also be the output for one unit repeated n times, which
+checks that the output is unchanged. The baseline_expressions case evaluates #expr
+as WikiExtractor did before its expression parser, on the pages of the expressions
+case.
+
+Run from the repository root:
+
+    python -m corpora.wikipedia.extractor_benchmark [case ...]
+"""
+
+import argparse
+import math
+import re
+import timeit
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from corpora.wikipedia import WikiExtractor as wx
+
+
+class Case(NamedTuple):
+    """A unit of wikitext and the extractor stage timed on its repetitions."""
+
+    unit: str
+    stage: Callable[[str], str]
+    # whether the output for n units must be the output for one unit repeated
+    repeatable: bool = True
+
+
+def _extractor() -> wx.Extractor:
+    return wx.Extractor("1", "1", "Benchmark", [])
+
+
+def _transform(text: str) -> str:
+    return _extractor().transform(text)
+
+
+def _wiki2text(text: str) -> str:
+    return _extractor().wiki2text(text)
+
+
+def _drop_comments(text: str) -> str:
+    return wx.dropSpans([m.span() for m in wx.comment.finditer(text)], text)
+
+
+def _strip_tags(text: str) -> str:
+    return wx.tagStripper().strip(text)
+
+
+def _extract(text: str) -> str:
+    out = wx.StringIO()
+    wx.Extractor("1", "1", "Benchmark", [text]).extract(out)
+    return out.getvalue()
+
+
+# The names that #expr could use before compileExpr, when it ran eval()
+_BASELINE_NAMES = {
+    name: getattr(math, name)
+    for name in ("floor", "ceil", "pi", "e", "trunc", "exp", "sin", "cos", "tan")
+}
+_BASELINE_NAMES.update(asin=math.asin, acos=math.acos, atan=math.atan, ln=math.log)
+
+
+def _baseline_expr(extr: wx.Extractor, expr: str) -> str:
+    """Evaluate #expr as before compileExpr: rewritten into Python for eval()."""
+    try:
+        expr = extr.expand(expr)
+        expr = re.sub("(?<![!<>])=", "==", expr)
+        expr = re.sub("mod", "%", expr)
+        # \b is a backspace, as it was: div and round are never rewritten
+        expr = re.sub("\bdiv\b", "/", expr)
+        expr = re.sub("\bround\b", "|ROUND|", expr)
+        return str(eval(expr, dict(_BASELINE_NAMES)))
+    except Exception:
+        return '<span class="error">%s</span>' % expr
+
+
+def _transform_expressions(text: str) -> str:
+    # each run starts without cached results, as a new extract process does
+    wx.exprCache.entries.clear()
+    return _transform(text)
+
+
+def _transform_baseline_expressions(text: str) -> str:
+    functions = {name: wx.parserFunctions[name] for name in ("#expr", "#ifexpr")}
+    wx.parserFunctions.update({"#expr": _baseline_expr, "#ifexpr": lambda *args: ""})
+    try:
+        return _transform(text)
+    finally:
+        wx.parserFunctions.update(functions)
+
+
+def _extract_plain(text: str) -> str:
+    wx.options.plain_tokens = True
+    try:
+        return _extract(text)
+    finally:
+        wx.options.plain_tokens = False
+
+
+EXPRESSIONS = "{{#expr: (2 + 3) * 4 / 7 round 2}} {{#expr: 2^10 mod 7 - 1}} and "
+
+CASES: Dict[str, Case] = {
+    "links": Case("[[Target page|a label]]s and ", wx.replaceInternalLinks),
+    "templates": Case("{{echo|word}} and ", _transform),
+    "nested_templates": Case("{{echo|{{echo|{{echo|word}}}}}} and ", _transform),
+    "deep_templates": Case("{{echo|" * 20 + "word" + "}}" * 20 + " and ", _transform),
+    "infobox": Case("{{infobox|name=Word|type=noun|origin=Latin}} and ", _transform),
+    "expressions": Case(EXPRESSIONS, _transform_expressions),
+    "baseline_expressions": Case(EXPRESSIONS, _transform_baseline_expressions),
+    "nowiki": Case("<nowiki>{{echo|raw}}</nowiki> {{echo|word}} ", _transform),
+    "comments": Case("<!-- a comment --> word ", _drop_comments),
+    "tags": Case(
+        '<ref name="a">cite</ref> <div>box <b>bold</b></div> <!-- c --> <br/> ',
+        _strip_tags,
+    ),
+    "wiki2text": Case(
+        "'''bold''' [[Link]] "
+        '&lt;syntaxhighlight lang="c"&gt;x&lt;/syntaxhighlight&gt; ',
+        _wiki2text,
+    ),
+    "article": Case(
+        "[[Target page|a label]] {{echo|word}} <!-- comment --> '''bold''' ",
+        _extract,
+        repeatable=False,
+    ),
+    "plain_article": Case(
+        "[[Target page|a label]] {{echo|word}} <!-- comment --> '''bold''' ",
+        _extract_plain,
+        repeatable=False,
+    ),
+}
+
+
+def _setup() -> None:
+    """Configure the extractor as main() does, with the templates of the cases."""
+    wx.options.templateNamespace = "Template"
+    wx.options.templatePrefix = "Template:"
+    wx.options.moduleNamespace = "Module"
+    wx.options.modulePrefix = "Module:"
+    wx.define_template("Template:Echo", ["{{{1}}}"])
+    wx.define_template(
+        "Template:Infobox",
+        [
+            "'''{{{name|{{PAGENAME}}}}}''' ({{{type|}}}) "
+            "{{{plural|}}}{{{origin|unknown}}}{{{date|}}}{{{ref|}}}"
+        ],
+    )
+    for tag in ("b", "i", "span", "a"):
+        wx.ignoreTag(tag)
+
+
+def run_case(name: str, sizes: List[int], repeat: int) -> None:
+    """Time a case on each of the sizes, printing the time per unit."""
+    case = CASES[name]
+    expected: Optional[str] = case.stage(case.unit) if case.repeatable else None
+    for n in sizes:
+        text = case.unit * n
+        seconds = min(timeit.repeat(lambda: case.stage(text), number=1, repeat=repeat))
+        if expected is None:
+            check = "-"
+        else:
+            check = "same" if case.stage(text) == expected * n else "DIFFERENT"
+        print(
+            f"{name:18} {n:8} {seconds:9.4f}s {seconds / n * 1e6:8.2f}us/unit  {check}"
+        )
+
+
+def main() -> None:
+    """Run the benchmark cases given on the command line, or all of them."""
+    parser = argparse.ArgumentParser(description="WikiExtractor benchmarks")
+    parser.add_argument(
+        "cases", nargs="*", help=f"Which cases to run: {', '.join(CASES)} (default all)"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="Comma-separated numbers of units per page",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of each size, keeping the best"
+    )
+    args = parser.parse_args()
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    _setup()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    for name in args.cases or CASES:
+        run_case(name, sizes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
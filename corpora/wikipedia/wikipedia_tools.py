@@ -1,13 +1,21 @@
 import argparse
 import collections
+import multiprocessing
 import os
 import re
-from typing import List
+from typing import Iterator, List
 
 import tqdm
 
+try:
+    from corpora.wikipedia import article_container
+except ImportError:  # Run as a script, from its own directory on sys.path
+    import article_container
+
 FILE_IGNORE_PATTERN = r"(</?doc.*?>|-)"
 WORD_IGNORE_PATTERN = r"[^A-Z]"
+# Containers are counted in byte ranges of about this size, in parallel
+SHARD_BYTES = 64 * 1024 * 1024
 
 
 def count_words(args: argparse.Namespace) -> None:
@@ -16,11 +24,14 @@ def count_words(args: argparse.Namespace) -> None:
         print("Processing Wikipedia...")
 
     # Read wikipedia data in from files, track word counts
-    input_files = _find_input_files(args.input)
-    input_files_iter = tqdm.tqdm(input_files) if not args.quiet else input_files
+    shards = _find_shards(_find_input_files(args.input))
     word_counts = collections.Counter()
-    for input_file in input_files_iter:
-        word_counts += _count_words_in_file(input_file)
+    with multiprocessing.Pool(args.processes) as pool:
+        shard_counts = pool.imap(_count_words_in_shard, shards)
+        if not args.quiet:
+            shard_counts = tqdm.tqdm(shard_counts, total=len(shards))
+        for counts in shard_counts:
+            word_counts += counts
     del word_counts[""]
 
     # Output the word counts to a file
@@ -40,14 +51,40 @@ def _find_input_files(top: str) -> List[str]:
     return input_files
 
 
+def _find_shards(input_files: List[str]) -> List[article_container.Shard]:
+    """Split the article containers into shards, other files are a shard each."""
+    shards = []
+    for input_file in input_files:
+        size = os.path.getsize(input_file)
+        if article_container.is_container(input_file):
+            count = max(1, -(-size // SHARD_BYTES))
+            shards.extend(article_container.shards(input_file, count))
+        else:
+            shards.append(article_container.Shard(input_file, 0, size))
+    return shards
+
+
+def _count_words_in_shard(shard: article_container.Shard) -> collections.Counter:
+    """Return a Counter with the word counts from the given shard."""
+    if not article_container.is_container(shard.path):
+        return _count_words_in_file(shard.path)
+    word_counts: collections.Counter = collections.Counter()
+    for page_id, text in article_container.read_shard(shard):
+        word_counts.update(_words(text))
+    return word_counts
+
+
 def _count_words_in_file(input_file: str) -> collections.Counter:
     """Return a Counter with the word counts from the given file."""
     with open(input_file) as f:
         contents = f.read()
+    return collections.Counter(_words(contents))
+
+
+def _words(contents: str) -> Iterator[str]:
+    """Yield the words of extracted text, in capitals without other characters."""
     cleaned = re.sub(FILE_IGNORE_PATTERN, " ", contents)
-    return collections.Counter(
-        re.sub(WORD_IGNORE_PATTERN, "", word.upper()) for word in cleaned.split()
-    )
+    return (re.sub(WORD_IGNORE_PATTERN, "", word.upper()) for word in cleaned.split())
 
 
 def _output_word_counts(word_counts: collections.Counter, output_file: str) -> None:
@@ -85,6 +122,13 @@ if __name__ == "__main__":
         default="wordcounts.txt",
         help="Specifies the location to output the results",
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes counting words in parallel",
+    )
     args = parser.parse_args()
 
     # Call the correct subcommand
@@ -0,0 +1,86 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from corpora.wikipedia import WikiExtractor, article_container
+
+PAGES = [
+    ("12", "First article text.\n"),
+    ("7", ""),  # pages without text have no record
+    ("3051", "Second article, with ünïcode.\n"),
+    ("42", "Third article.\n" * 100),
+]
+
+
+def _write_container(directory, pages=PAGES, compress=None):
+    """Write the pages as WikiExtractor --container does, return the file."""
+    output = WikiExtractor.ContainerSplitter(
+        WikiExtractor.NextFile(directory), 1 << 20, compress
+    )
+    ids = [page_id for page_id, text in pages]
+    texts = [text for page_id, text in pages]
+    for count, size, data in WikiExtractor.output_chunks(texts, compress, ids):
+        output.write(data, size)
+    output.close()
+    return os.path.join(directory, "AA", "wiki_00.wac")
+
+
+class TestArticleContainer(unittest.TestCase):
+    """Tests for the article containers written by WikiExtractor."""
+
+    def test_read_by_id(self):
+        """Test reading the articles by page id, and in file order."""
+        with TemporaryDirectory() as directory:
+            path = _write_container(directory)
+            self.assertTrue(article_container.is_container(path))
+            with article_container.ArticleContainer(path) as container:
+                self.assertEqual(container.ids(), [12, 3051, 42])
+                self.assertEqual(len(container), 3)
+                self.assertNotIn(7, container)
+                self.assertEqual(container[3051], "Second article, with ünïcode.\n")
+                self.assertEqual(list(container), [(int(i), t) for i, t in PAGES if t])
+
+    def test_compressed_records(self):
+        """Test reading the records compressed with each codec."""
+        for codec in WikiExtractor.outputCodecs:
+            with TemporaryDirectory() as directory:
+                path = _write_container(directory, compress=codec)
+                with article_container.ArticleContainer(path) as container:
+                    self.assertEqual(container.codec, codec)
+                    self.assertEqual(container[42], "Third article.\n" * 100)
+
+    def test_shards(self):
+        """Test that shards hold each record once, in order."""
+        pages = [(str(i), f"Article {i}.\n" * (i % 7)) for i in range(1, 200)]
+        with TemporaryDirectory() as directory:
+            path = _write_container(directory, pages)
+            with article_container.ArticleContainer(path) as container:
+                expected = list(container)
+            for count in (1, 2, 5, 64):
+                records = [
+                    record
+                    for shard in article_container.shards(path, count)
+                    for record in article_container.read_shard(shard)
+                ]
+                self.assertEqual(records, expected)
+
+    def test_interrupted_container(self):
+        """Test that the complete records of a container without footer are read."""
+        with TemporaryDirectory() as directory:
+            path = _write_container(directory)
+            with article_container.ArticleContainer(path) as container:
+                records_end = container.records_end
+            with open(path, "r+b") as f:
+                f.truncate(records_end - 1)
+            with article_container.ArticleContainer(path) as container:
+                self.assertEqual(container.ids(), [12, 3051])
+
+    def test_not_a_container(self):
+        """Test that other files are rejected."""
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "wiki_00")
+            with open(path, "w") as f:
+                f.write('<doc id="12">\nText\n</doc>\n')
+            self.assertFalse(article_container.is_container(path))
+            with self.assertRaises(ValueError):
+                article_container.ArticleContainer(path)
@@ -0,0 +1,1498 @@
+import bz2
+import glob
+import gzip
+import json
+import lzma
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from io import StringIO
+from unittest import mock
+
+from corpora.wikipedia import WikiExtractor
+
+SCRIPT = WikiExtractor.__file__
+ROOT = os.path.abspath(os.path.join(os.path.dirname(SCRIPT), "..", ".."))
+
+SITEINFO = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <base>https://en.wikipedia.org/wiki/Main_Page</base>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="10" case="first-letter">Template</namespace>
+      <namespace key="828" case="first-letter">Module</namespace>
+    </namespaces>
+  </siteinfo>
+"""
+
+TEMPLATES = [
+    ("Template:Bold", "'''{{{1}}}'''"),
+    ("Template:Greet", "Hello {{{name|{{{1|world}}}}}} from {{PAGENAME}}"),
+    ("Template:Half", "{{#expr: {{{1}}} / 2}}"),
+]
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu".split()
+
+
+def _article(n, paragraphs=1):
+    """Return the wikitext of article n, with templates, links and expressions."""
+    words = " ".join(WORDS[(n * 7 + i) % len(WORDS)] for i in range(12))
+    paragraph = (
+        "{{Bold|%s}} {{Greet|%d}} is [[Link %d|linked]]. Half of %d is {{Half|%d}}."
+        "\n\n%s.\n\n" % (words, n, n, n, n, words)
+    )
+    return paragraph * paragraphs
+
+
+def _pages(count=40, paragraphs=1, revisions=None):
+    """
+    Return the templates, then count articles, as (id, revision id, title,
+    namespace, wikitext). Articles have the revision 1 unless revisions gives another.
+    """
+    revisions = revisions or {}
+    pages = [(i + 1, 1, title, "10", text) for i, (title, text) in enumerate(TEMPLATES)]
+    for n in range(count):
+        id = 100 + n
+        text = _article(n, paragraphs)
+        pages.append((id, revisions.get(id, 1), "Article %d" % n, "0", text))
+    return pages
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _write_dump(path, pages):
+    """Write the pages as an XML dump, compressed with bzip2 if path ends in .bz2."""
+    xml = [SITEINFO]
+    for id, revid, title, ns, text in pages:
+        xml.append(
+            "  <page>\n    <title>%s</title>\n    <ns>%s</ns>\n    <id>%d</id>\n"
+            "    <revision>\n      <id>%d</id>\n"
+            '      <text xml:space="preserve">%s</text>\n    </revision>\n  </page>\n'
+            % (_escape(title), ns, id, revid, _escape(text))
+        )
+    xml.append("</mediawiki>\n")
+    data = "".join(xml).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(bz2.compress(data) if path.endswith(".bz2") else data)
+    return path
+
+
+def _extract(output, inputs, *args, code=None, env=None):
+    """
+    Run WikiExtractor with 2 extract processes, or the Python code calling its
+    main, writing to output. Return its log.
+    """
+    command = [sys.executable] + (["-c", code] if code else [SCRIPT])
+    result = subprocess.run(
+        command + ["-q", "--processes", "2", "-o", output] + list(args) + inputs,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return result.stderr
+
+
+DECOMPRESS = {".bz2": bz2.decompress, ".gz": gzip.decompress, ".xz": lzma.decompress}
+
+
+def _output(directory):
+    """Return the text of the output files, decompressed, in order of their names."""
+    texts = []
+    for path in sorted(
+        glob.glob(os.path.join(directory, "**", "wiki_*"), recursive=True)
+    ):
+        with open(path, "rb") as f:
+            data = f.read()
+        suffix = os.path.splitext(path)[1]
+        texts.append(DECOMPRESS.get(suffix, bytes)(data).decode("utf-8"))
+    return "".join(texts)
+
+
+def _documents(text):
+    """Return the documents of an output text."""
+    return re.findall(r"<doc .*?</doc>\n", text, re.S)
+
+
+def _slow(extractor, *args):
+    """Parser function running out of the CPU budget of the page."""
+    WikiExtractor.on_page_timeout(None, None)
+
+
+class TestPageBudget(unittest.TestCase):
+    """Tests for the CPU budget of the pages."""
+
+    def setUp(self):
+        """Give the pages a budget, and a parser function exceeding it."""
+        patches = [
+            mock.patch.object(WikiExtractor.options, "page_budget", 60),
+            mock.patch.dict(WikiExtractor.parserFunctions, {"#slow": _slow}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_timeout_in_parser_function(self):
+        """Test that running out of budget within a parser function is reported."""
+        out = StringIO()
+        timeouts = WikiExtractor.page_timeouts
+        with self.assertLogs(level="WARNING") as logs:
+            complete = WikiExtractor.extract_page(
+                "1", "1", "Slow", ["Slow page text. {{#if:1|{{#slow:}}}}\n"], out
+            )
+        # the page is extracted without templates, and not stored as complete
+        self.assertFalse(complete)
+        self.assertEqual(WikiExtractor.page_timeouts, timeouts + 1)
+        self.assertIn("exceeded its budget", logs.output[0])
+        self.assertIn("Slow page text.", out.getvalue())
+        self.assertTrue(WikiExtractor.options.expand_templates)
+
+    def test_timeout_after_extraction(self):
+        """Test that a page whose budget runs out once extracted is complete."""
+
+        def setitimer(which, seconds):
+            if not seconds:
+                # the budget runs out in extract_page, before it disarms the timer
+                WikiExtractor.on_page_timeout(None, sys._getframe(1))
+
+        out = StringIO()
+        timeouts = WikiExtractor.page_timeouts
+        with mock.patch.object(WikiExtractor.signal, "setitimer", setitimer):
+            complete = WikiExtractor.extract_page(
+                "4", "4", "Late", ["{{#if:1|Late}} page text.\n"], out
+            )
+        self.assertTrue(complete)
+        self.assertEqual(WikiExtractor.page_timeouts, timeouts)
+        self.assertIn("Late page text.", out.getvalue())
+
+    def test_page_within_budget(self):
+        """Test that a page within its budget is complete."""
+        out = StringIO()
+        complete = WikiExtractor.extract_page(
+            "2", "2", "Fast", ["{{#if:1|Fast}} page text.\n"], out
+        )
+        self.assertTrue(complete)
+        self.assertIn("Fast page text.", out.getvalue())
+
+
+class TestExpr(unittest.TestCase):
+    """Tests for the evaluation of #expr expressions."""
+
+    def test_rounding_operators(self):
+        """Test that floor, ceil and trunc give numbers the other operators take."""
+        self.assertEqual(WikiExtractor.evalExpr("floor 3 ^ floor 2"), "9")
+        self.assertEqual(WikiExtractor.evalExpr("ceil 2.1 mod 2"), "1")
+        self.assertEqual(WikiExtractor.evalExpr("trunc -2.7"), "-2")
+
+    def test_rounding_infinity(self):
+        """Test that floor, ceil and trunc leave infinity as is."""
+        self.assertEqual(WikiExtractor.evalExpr("floor 1e400"), "INF")
+        self.assertEqual(WikiExtractor.evalExpr("ceil -1e400"), "-INF")
+
+    def test_escaped_operators(self):
+        """Test that the operators escaped in the text of the dump are evaluated."""
+        self.assertEqual(WikiExtractor.evalExpr("1 &lt; 2"), "1")
+        self.assertEqual(WikiExtractor.evalExpr("3 &gt;= 4"), "0")
+        self.assertEqual(WikiExtractor.evalExpr("5 &amp;minus; 7 &amp;lt;&gt; 1"), "1")
+
+    def test_ifexpr_in_page(self):
+        """Test #ifexpr on escaped operators, and that its errors leave no text."""
+        out = StringIO()
+        WikiExtractor.extract_page(
+            "3",
+            "3",
+            "Expr",
+            [
+                "A {{#ifexpr: 3 &gt; 2 | big | small}} number.\n",
+                "An {{#ifexpr: 3 &amp; 2 | big | small}}error.\n",
+            ],
+            out,
+        )
+        self.assertIn("A big number.", out.getvalue())
+        self.assertIn("An error.", out.getvalue())
+
+    def test_cached(self):
+        """Test that values and errors are evaluated once."""
+        cache = WikiExtractor.LRUCache(10)
+        with mock.patch.object(WikiExtractor, "exprCache", cache), mock.patch.object(
+            WikiExtractor, "compileExpr", wraps=WikiExtractor.compileExpr
+        ) as compileExpr:
+            for _ in range(2):
+                self.assertEqual(WikiExtractor.evalExpr("6 * 7"), "42")
+                with self.assertRaises(WikiExtractor.ExprError):
+                    WikiExtractor.evalExpr("6 *")
+        self.assertEqual(compileExpr.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+
+class TestTemplateStore(unittest.TestCase):
+    """Tests for the lookups in a compiled template store."""
+
+    def setUp(self):
+        """Create a store with one template."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "templates.db")
+        self._execute("CREATE TABLE templates (title TEXT PRIMARY KEY, body TEXT)")
+        self._execute("INSERT INTO templates VALUES ('Template:A', 'a')")
+        self.store = WikiExtractor.TemplateStore(self.path, "templates")
+        self.addCleanup(lambda: self.store.db and self.store.db.close())
+
+    def _execute(self, statement):
+        """Change the database behind the back of the store."""
+        db = sqlite3.connect(self.path)
+        with db:
+            db.execute(statement)
+        db.close()
+
+    def test_missing_title_cached(self):
+        """Test that a missing title is looked up in the database once."""
+        self.assertNotIn("Template:B", self.store)
+        self._execute("INSERT INTO templates VALUES ('Template:B', 'b')")
+        self.assertNotIn("Template:B", self.store)
+        self.assertIsNone(self.store.get("Template:B"))
+        with self.assertRaises(KeyError):
+            self.store["Template:B"]
+
+    def test_deleted_body_not_cached(self):
+        """Test that a body is dropped from the cache once its template is parsed."""
+        self.assertEqual(self.store["Template:A"], "a")
+        del self.store["Template:A"]
+        self._execute("UPDATE templates SET body = 'new' WHERE title = 'Template:A'")
+        self.assertEqual(self.store["Template:A"], "new")
+
+
+class TestSharedTemplates(unittest.TestCase):
+    """Tests for the temporary store of templates shared by the extract processes."""
+
+    def setUp(self):
+        """Load a template in memory, and put temporary files in a directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patches = [
+            mock.patch.object(tempfile, "tempdir", self.directory),
+            mock.patch.object(WikiExtractor.options, "templates", {"Template:A": "a"}),
+            mock.patch.object(WikiExtractor.options, "redirects", {}),
+            mock.patch.object(WikiExtractor.options, "templateNamespace", "Template"),
+            mock.patch.object(WikiExtractor.options, "moduleNamespace", "Module"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_interrupted_share_removed(self):
+        """Test that a store interrupted while it is created is removed."""
+        with mock.patch.object(
+            WikiExtractor, "open_template_store", side_effect=KeyboardInterrupt
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                WikiExtractor.share_templates()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestDumpParts(unittest.TestCase):
+    """Tests for the extraction of split dumps."""
+
+    def test_natural_order(self):
+        """Test that the parts are in the order of their numbers."""
+        with tempfile.TemporaryDirectory() as directory:
+            names = [
+                "dump-articles%d.xml-p%dp%d.bz2" % (i, i, i + 9) for i in (1, 2, 10)
+            ]
+            for name in names:
+                open(os.path.join(directory, name), "w").close()
+            parts = WikiExtractor.expand_dump_parts([os.path.join(directory, "dump-*")])
+        self.assertEqual([os.path.basename(part) for part in parts], names)
+
+    def test_split_dump(self):
+        """Test that the parts of a dump are extracted as the whole dump."""
+        pages = _pages()
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml.bz2"), pages)
+            parts = [
+                _write_dump(os.path.join(directory, "dump%d.xml.bz2" % i), pages[i:j])
+                for i, j in ((0, 15), (15, 30), (30, None))
+            ]
+            outputs = []
+            for name, inputs in (("whole", [dump]), ("parts", parts)):
+                output = os.path.join(directory, name)
+                templates = output + ".templates"
+                _extract(output, inputs, "--templates", templates)
+                outputs.append(_output(output))
+        self.assertEqual(len(_documents(outputs[0])), 40)
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestTemplateStoreRuns(unittest.TestCase):
+    """Tests for runs compiling and using a template store."""
+
+    def test_store_runs(self):
+        """Test that runs creating and reusing a store extract as a template file."""
+        pages = _pages()
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            # the templates only come from the store
+            articles = _write_dump(
+                os.path.join(directory, "articles.xml"), pages[len(TEMPLATES) :]
+            )
+            store = os.path.join(directory, "templates.db")
+            outputs = []
+            for name, input, args in (
+                ("file", dump, ["--templates", os.path.join(directory, "templates")]),
+                ("created", dump, ["--template_store", store]),
+                ("reused", articles, ["--template_store", store]),
+            ):
+                output = os.path.join(directory, name)
+                _extract(output, [input], *args)
+                outputs.append(_output(output))
+            db = sqlite3.connect(store)
+            titles = [title for title, in db.execute("SELECT title FROM templates")]
+            db.close()
+        self.assertEqual(sorted(titles), sorted(title for title, text in TEMPLATES))
+        self.assertIn("Half of 3 is 1.5.", outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+
+class TestTemplatePass(unittest.TestCase):
+    """Tests for the collection of the template definitions."""
+
+    def test_processes(self):
+        """Test that the templates collected do not depend on the processes."""
+        pages = _pages(10)
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            parts = [
+                _write_dump(os.path.join(directory, "dump%d.xml" % i), pages[i:j])
+                for i, j in ((0, 2), (2, None))
+            ]
+            runs = []
+            for name, inputs, processes in (
+                ("one", [dump], "1"),
+                ("pool", [dump], "3"),
+                ("parts", parts, "3"),
+            ):
+                output = os.path.join(directory, name)
+                templates = output + ".templates"
+                _extract(
+                    output, inputs, "--templates", templates, "--processes", processes
+                )
+                with open(templates) as f:
+                    runs.append((f.read(), _output(output)))
+        self.assertIn("<title>Template:Half</title>", runs[0][0])
+        self.assertEqual(runs[1], runs[0])
+        self.assertEqual(runs[2], runs[0])
+
+
+class TestParsedTemplates(unittest.TestCase):
+    """Tests for the parsed templates persisted in a template store."""
+
+    def test_round_trip(self):
+        """Test that a parsed template is read back from the store as parsed."""
+        body = "{{{1|{{{name|x}}}}}} and {{{{{{p}}}|d}}} {{echo|{{{2}}}}}"
+        template = WikiExtractor.Template.parse(body)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "templates.db")
+            db = sqlite3.connect(path)
+            db.execute("CREATE TABLE parsed (title TEXT PRIMARY KEY, body BLOB)")
+            db.close()
+            # as parse_template() does, on a template not parsed yet
+            writer = WikiExtractor.ParsedTemplateStore(path)
+            self.assertIsNone(writer.get("Template:T"))
+            writer.add("Template:T", template)
+            writer.flush()
+            writer.db.close()
+            reader = WikiExtractor.ParsedTemplateStore(path)
+            loaded = reader.get("Template:T")
+            reader.db.close()
+        self.assertEqual(loaded.dump(), template.dump())
+        self.assertEqual(str(loaded), body)
+
+    def test_runs(self):
+        """Test that the templates parsed in a run are stored for the next ones."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            store = os.path.join(directory, "templates.db")
+            outputs = []
+            for name in ("first", "second"):
+                output = os.path.join(directory, name)
+                _extract(output, [dump], "--template_store", store)
+                outputs.append(_output(output))
+            db = sqlite3.connect(store)
+            parsed = [title for title, in db.execute("SELECT title FROM parsed")]
+            db.close()
+        self.assertEqual(sorted(parsed), sorted(title for title, text in TEMPLATES))
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestExpansionCache(unittest.TestCase):
+    """Tests for the memoized template expansions."""
+
+    def test_least_recently_used_evicted(self):
+        """Test that the cache evicts the entry used least recently."""
+        cache = WikiExtractor.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_page_dependent_expansions(self):
+        """Test that only the expansions not depending on the page are reused."""
+        cache = WikiExtractor.LRUCache(10)
+        patches = [
+            mock.patch.object(WikiExtractor.options, "expansionCache", cache),
+            mock.patch.object(WikiExtractor.options, "templates", dict(TEMPLATES)),
+            mock.patch.object(WikiExtractor.options, "templateCache", {}),
+            mock.patch.object(WikiExtractor.options, "redirects", {}),
+            mock.patch.object(WikiExtractor.options, "templatePrefix", "Template:"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        outputs = []
+        for title in ("First", "Second"):
+            out = StringIO()
+            WikiExtractor.extract_page(
+                "5", "5", title, ["{{Bold|x}} {{Greet|y}} {{Bold|x}}.\n"], out
+            )
+            outputs.append(out.getvalue())
+        self.assertIn("x Hello y from First x.", outputs[0])
+        self.assertIn("x Hello y from Second x.", outputs[1])
+        # {{Bold|x}} is expanded once, {{Greet|y}} on each page
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 3, "bypassed": 2})
+
+    def test_runs_without_cache(self):
+        """Test that a run without the cache extracts the same output."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            outputs = []
+            for name, size in (("cached", "1000"), ("uncached", "0")):
+                output = os.path.join(directory, name)
+                templates = output + ".templates"
+                _extract(
+                    output, [dump], "--templates", templates, "--expansion_cache", size
+                )
+                outputs.append(_output(output))
+        self.assertIn("Hello 3 from Article 3", outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+
+
+FAILING_READ = """
+import sys
+from corpora.wikipedia import WikiExtractor
+
+def map_pages(*args, **kwargs):
+    raise RuntimeError("unreadable dump")
+
+WikiExtractor.map_pages = map_pages
+sys.argv[0] = WikiExtractor.__file__
+WikiExtractor.main()
+"""
+
+
+class TestSharedTemplateRuns(unittest.TestCase):
+    """Tests for the runs sharing their templates in a temporary store."""
+
+    def setUp(self):
+        """Create a dump, and a directory for the temporary files of the runs."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.temporary = os.path.join(self.directory, "tmp")
+        os.mkdir(self.temporary)
+        self.env = dict(os.environ, TMPDIR=self.temporary)
+        self.dump = _write_dump(os.path.join(self.directory, "dump.xml"), _pages())
+
+    def test_store_removed(self):
+        """Test that a run removes the store it shares its templates in."""
+        outputs = []
+        for name, env in (("default", None), ("shared", self.env)):
+            output = os.path.join(self.directory, name)
+            templates = output + ".templates"
+            _extract(output, [self.dump], "--templates", templates, env=env)
+            outputs.append(_output(output))
+        self.assertEqual(os.listdir(self.temporary), [])
+        self.assertIn("Hello 3 from Article 3", outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+
+    def test_failed_run_store_removed(self):
+        """Test that a run failing once its templates are shared removes the store."""
+        output = os.path.join(self.directory, "failed")
+        templates = output + ".templates"
+        with self.assertRaisesRegex(AssertionError, "unreadable dump"):
+            _extract(
+                output,
+                [self.dump],
+                "--templates",
+                templates,
+                code=FAILING_READ,
+                env=self.env,
+            )
+        self.assertEqual(os.listdir(self.temporary), [])
+
+
+def _flow(spool_bytes=0, max_spool_bytes=10):
+    """Return the flow control arguments of map_pages(), with the reducer at 0."""
+    return (
+        multiprocessing.Value("l", spool_bytes, lock=False),
+        max_spool_bytes,
+        multiprocessing.Value("i", 0, lock=False),
+        multiprocessing.Value("i", 0, lock=False),
+        multiprocessing.Condition(),
+        multiprocessing.Value("d", 0.0),
+    )
+
+
+class TestReorder(unittest.TestCase):
+    """Tests for the reordering of the pages extracted, and its backpressure."""
+
+    def test_mapper_blocked(self):
+        """Test that a full spool blocks the mapper on the pages it is ahead."""
+        flow = _flow(spool_bytes=100)
+        spool_bytes, _, _, written_pages, spool_changed, stall_time = flow
+        jobs = queue.Queue()
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages(3))
+            with open(dump) as input, mock.patch.object(
+                WikiExtractor.options, "batch_size", 1
+            ):
+                mapper = threading.Thread(
+                    target=WikiExtractor.map_pages,
+                    args=(0, input, jobs, None, flow, multiprocessing.Array("l", 3)),
+                )
+                mapper.start()
+                # the reducer waits for the first page: it is dispatched
+                self.assertEqual(jobs.get(timeout=10)[0], (0, 0))
+                time.sleep(0.2)
+                self.assertTrue(jobs.empty())
+                with spool_changed:
+                    written_pages.value = 1
+                    spool_changed.notify_all()
+                self.assertEqual(jobs.get(timeout=10)[0], (0, 1))
+                with spool_changed:
+                    spool_bytes.value = 0
+                    spool_changed.notify_all()
+                mapper.join(10)
+        self.assertEqual(jobs.get_nowait()[0], (0, 2))
+        self.assertGreater(stall_time.value, 0.2)
+
+    def test_order(self):
+        """Test that pages extracted out of order are written in order."""
+        # long pages among short ones finish last
+        pages = _pages(30)
+        for i in range(len(TEMPLATES), len(pages), 7):
+            id, revid, title, ns, text = pages[i]
+            pages[i] = (id, revid, title, ns, text * 40)
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            outputs = []
+            for name, processes in (("one", "1"), ("pool", "3")):
+                output = os.path.join(directory, name)
+                templates = output + ".templates"
+                _extract(
+                    output,
+                    [dump],
+                    "--templates",
+                    templates,
+                    "--processes",
+                    processes,
+                    "--batch_size",
+                    "1",
+                )
+                outputs.append(_output(output))
+        ids = [int(id) for id in re.findall(r'<doc id="(\d+)"', outputs[1])]
+        self.assertEqual(ids, list(range(100, 130)))
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestUnordered(unittest.TestCase):
+    """Tests for the output written by each extract process, in no order."""
+
+    def test_same_documents(self):
+        """Test that the unordered output has the documents of the ordered one."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            outputs = []
+            for name, args in (("ordered", []), ("unordered", ["--unordered"])):
+                output = os.path.join(directory, name)
+                templates = output + ".templates"
+                _extract(
+                    output,
+                    [dump],
+                    "--templates",
+                    templates,
+                    "--processes",
+                    "3",
+                    "--batch_size",
+                    "1",
+                    *args
+                )
+                outputs.append(_output(output))
+            workers = sorted(os.listdir(os.path.join(directory, "unordered")))
+        self.assertEqual(workers, ["W00", "W01", "W02"])
+        documents = _documents(outputs[0])
+        self.assertEqual(len(documents), 40)
+        self.assertEqual(sorted(_documents(outputs[1])), sorted(documents))
+
+
+class TestBatches(unittest.TestCase):
+    """Tests for the batches of pages sent to and from the extract processes."""
+
+    def test_batch_bounds(self):
+        """Test that batches hold batch_size pages at most, and large pages alone."""
+        pages = _pages(10)
+        id, revid, title, ns, text = pages[len(TEMPLATES) + 5]
+        large = "Large page text. " * (WikiExtractor.largePageBytes // 16)
+        pages[len(TEMPLATES) + 5] = (id, revid, title, ns, large)
+        jobs = queue.Queue()
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            with open(dump) as input, mock.patch.object(
+                WikiExtractor.options, "batch_size", 4
+            ):
+                count = WikiExtractor.map_pages(
+                    0, input, jobs, None, _flow(), multiprocessing.Array("l", 3)
+                )
+        batches = []
+        while not jobs.empty():
+            (part, first), batch = jobs.get_nowait()
+            batches.append((first, [int(id) for id, revid, title, page in batch]))
+        self.assertEqual(count, 10)
+        self.assertEqual(
+            batches,
+            [
+                (0, [100, 101, 102, 103]),
+                (4, [104]),
+                (5, [105]),
+                (6, [106, 107, 108, 109]),
+            ],
+        )
+
+    def test_batch_sizes(self):
+        """Test that the output does not depend on the size of the batches."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            outputs = []
+            for size in ("1", "7", "100"):
+                output = os.path.join(directory, size)
+                templates = output + ".templates"
+                _extract(output, [dump], "--templates", templates, "--batch_size", size)
+                outputs.append(_output(output))
+        self.assertEqual(len(_documents(outputs[0])), 40)
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+
+class TestCompression(unittest.TestCase):
+    """Tests for the output compressed by the extract processes."""
+
+    def test_codecs(self):
+        """Test that the compressed members decompress to the uncompressed output."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            outputs = {}
+            suffixes = {}
+            for codec in (None, "bz2", "gzip", "lzma"):
+                output = os.path.join(directory, str(codec))
+                templates = output + ".templates"
+                args = ["--templates", templates, "--batch_size", "1"]
+                if codec:
+                    args += ["-c", "--codec", codec]
+                _extract(output, [dump], *args)
+                outputs[codec] = _output(output)
+                suffixes[codec] = {
+                    os.path.splitext(path)[1]
+                    for path in glob.glob(os.path.join(output, "*", "*"))
+                }
+        self.assertEqual(len(_documents(outputs[None])), 40)
+        for codec, suffix in (("bz2", ".bz2"), ("gzip", ".gz"), ("lzma", ".xz")):
+            self.assertEqual(suffixes[codec], {suffix})
+            self.assertEqual(outputs[codec], outputs[None])
+
+    def test_reproducible(self):
+        """Test that compressed output is the same from one run to the next."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            data = []
+            for name in ("first", "second"):
+                output = os.path.join(directory, name)
+                _extract(output, [dump], "-c", "--codec", "gzip")
+                with open(os.path.join(output, "AA", "wiki_00.gz"), "rb") as f:
+                    data.append(f.read())
+        self.assertEqual(data[1], data[0])
+
+
+def _patch_options(test, **values):
+    """Set options of WikiExtractor for the duration of a test."""
+    for name, value in values.items():
+        patch = mock.patch.object(WikiExtractor.options, name, value)
+        patch.start()
+        test.addCleanup(patch.stop)
+
+
+def _extract_text(title, text):
+    """Return the output of the Extractor for a page."""
+    out = StringIO()
+    WikiExtractor.Extractor("1", "1", title, text.splitlines(True)).extract(out)
+    return out.getvalue()
+
+
+PAGE = (
+    "Intro with [[Link|text]] and {{Bold|bold}}.\n\n== Section ==\n\n"
+    "* item [[one]]\n* item {{Pair|a}}\n\n"
+    "A <!-- comment --> paragraph with ''italic'' and [http://x.org ext].\n\n"
+    "=== Sub ===\n\n# first\n# second\n"
+)
+
+
+class TestStringAssembly(unittest.TestCase):
+    """Tests for the text assembled by the Extractor, as it was by concatenation."""
+
+    def setUp(self):
+        """Define the templates of the pages."""
+        _patch_options(
+            self,
+            templates={
+                "Template:Bold": "'''{{{1}}}'''",
+                "Template:Pair": "{{{1}}}-{{{2|two}}}",
+            },
+            templateCache={},
+            templatePrefix="Template:",
+        )
+
+    def test_page(self):
+        """Test the text of a page with templates, links and sections."""
+        self.assertEqual(
+            _extract_text("Page", PAGE),
+            '<doc id="1" url="?curid=1" title="Page">\nPage\n\n'
+            "Intro with text and bold.\n\n\nSection::::Section.\n"
+            'A paragraph with "italic" and ext.\n\n\n\n</doc>\n',
+        )
+
+    def test_page_with_lists_and_links(self):
+        """Test the text of a page keeping its lists and links."""
+        _patch_options(self, keepLists=True, keepLinks=True)
+        self.assertEqual(
+            _extract_text("Page", PAGE),
+            '<doc id="1" url="?curid=1" title="Page">\nPage\n\n'
+            'Intro with <a href="Link">text</a> and bold.\n\n'
+            "Section::::Section.\n"
+            'BULLET::::- item <a href="one">one</a>\nBULLET::::- item a-two\n\n'
+            'A paragraph with "italic" and <a href="http%3A//x.org">ext</a>.\n\n'
+            "Section::::Sub.\nBULLET::::1. first\nBULLET::::2. second\n\n\n</doc>\n",
+        )
+
+    def test_many_links_and_templates(self):
+        """Test pages with thousands of links or templates."""
+        for text, expected in (
+            ("[[Target %d|label %d]]", "label %d"),
+            ("{{Pair|%d}}", "%d-two"),
+        ):
+            page = " ".join(text % ((i,) * text.count("%")) for i in range(3000))
+            self.assertEqual(
+                _extract_text("Page", page + "\n"),
+                '<doc id="1" url="?curid=1" title="Page">\nPage\n\n%s\n\n\n</doc>\n'
+                % " ".join(expected % i for i in range(3000)),
+            )
+
+
+# text, cleaned with the default discarded elements, cleaned discarding ref and table
+CLEANED = [
+    (
+        'Keep <b>bold</b> and <span class="x">span</span> text.<br/> Next<br> line.',
+        "Keep bold and span text. Next<br> line.",
+        "Keep bold and span text. Next<br> line.",
+    ),
+    (
+        'A <ref name="r">cite <ref>inner</ref></ref> done <ref name="s"/> end.',
+        "A done end.",
+        "A done end.",
+    ),
+    (
+        "Table <table><tr><td>cell <table><tr><td>x</td></tr></table></td></tr>"
+        "</table> after.",
+        "Table after.",
+        "Table after.",
+    ),
+    (
+        "Open <div>never closed and <!-- a comment --> text.",
+        "Open <div>never closed and text.",
+        "Open <div>never closed and text.",
+    ),
+    (
+        "Mixed <gallery>\nFile:a.jpg\n</gallery> and <sup>1</sup>, <small>s</small>.",
+        "Mixed and , .",
+        "Mixed <gallery>\nFile:a.jpg\n</gallery> and <sup>1</sup>, <small>s</small>.",
+    ),
+    (
+        "Case <REF>upper</REF> and <Div Class=x>d</Div> and "
+        "&lt;b&gt;escaped&lt;/b&gt;.",
+        "Case and and <b>escaped</b>.",
+        "Case and <Div Class=x>d</Div> and <b>escaped</b>.",
+    ),
+    (
+        '<math>x^2</math> and <code>c</code> and <abbr title="t">ab</abbr>.',
+        "formula_1 and codice_1 and ab.",
+        "formula_1 and codice_1 and ab.",
+    ),
+    (
+        "unbalanced </ref> close and <ref>open",
+        "unbalanced </ref> close and <ref>open",
+        "unbalanced </ref> close and <ref>open",
+    ),
+    (
+        'Link <a href="x">anchor</a> and <i>it <b>nested</b></i> <B>up</B> <span>open',
+        "Link anchor and it nested up open",
+        "Link anchor and it nested up open",
+    ),
+]
+
+
+class TestTagStripper(unittest.TestCase):
+    """Tests for the single scan dropping tags and elements, as they were one by one."""
+
+    def setUp(self):
+        """Ignore some tags, as main() does."""
+        _patch_options(self, ignored_tag_patterns=[])
+        for tag in ("abbr", "b", "i", "span", "a"):
+            WikiExtractor.ignoreTag(tag)
+        self.extractor = WikiExtractor.Extractor("1", "1", "Page", [])
+
+    def test_default_elements(self):
+        """Test the text cleaned of the default discarded elements."""
+        for text, cleaned, _ in CLEANED:
+            self.assertEqual(self.extractor.clean(text), cleaned)
+
+    def test_discarded_elements(self):
+        """Test the text cleaned of other discarded elements."""
+        _patch_options(self, discardElements=["ref", "table"])
+        for text, _, cleaned in CLEANED:
+            self.assertEqual(self.extractor.clean(text), cleaned)
+
+
+# text, then the spans of its templates, tplargs and links, of its templates
+# (ldelim 2), of its tplargs (ldelim 3), and of its balanced links
+BRACES = [
+    (
+        "a {{b|{{c}}|d}} e {{{f|{{g}}}}} [[h|{{i}}]] j",
+        [(2, 15), (18, 31), (32, 43)],
+        [(2, 15), (18, 31), (36, 41)],
+        [(18, 31)],
+        [(32, 43)],
+    ),
+    (
+        "{{{{{x}}}}} and {{{{y}}}} and {{{z}}}}",
+        [(0, 11), (16, 25), (30, 37)],
+        [(0, 11), (16, 25), (30, 37)],
+        [(0, 11), (16, 25), (30, 37)],
+        [],
+    ),
+    (
+        "[[File:a.jpg|thumb|a [[link]] in [[caption|text]]]] after]] [[x]]",
+        [(0, 51), (60, 65)],
+        [],
+        [],
+        [(0, 51), (60, 65)],
+    ),
+    ("unclosed {{a|{{b}} and [[c", [], [], [], []),
+    (
+        "{{#if: {{{1|}}} | [[A|{{{1}}}]] | {{lc:B}} }}",
+        [(0, 45)],
+        [(0, 45)],
+        [(7, 15), (22, 29)],
+        [(18, 31)],
+    ),
+]
+
+
+class TestBraceIndex(unittest.TestCase):
+    """Tests for the templates and links found on an index of their braces."""
+
+    def test_matching_braces(self):
+        """Test that the spans found with an index are those found by scanning."""
+        prefix = "{{outer|[[ "
+        for text, braces, templates, tplargs, links in BRACES:
+            index = WikiExtractor.BraceIndex(prefix + text + " ]]}}")
+            for ldelim, spans in ((0, braces), (2, templates), (3, tplargs)):
+                self.assertEqual(
+                    list(WikiExtractor.findMatchingBraces(text, ldelim)), spans
+                )
+                self.assertEqual(
+                    list(
+                        WikiExtractor.findMatchingBraces(
+                            text, ldelim, index, len(prefix)
+                        )
+                    ),
+                    spans,
+                )
+            self.assertEqual(list(WikiExtractor.findBalanced(text)), links)
+            index = WikiExtractor.BraceIndex(text)
+            self.assertEqual(list(index.links(0, len(text))), links)
+
+    def test_split_parts(self):
+        """Test that the parts split with an index are those split by scanning."""
+        for text, parts in (
+            (
+                "a|b=[[c|d]]|{{e|f}}|g={{{h|i}}}",
+                ["a", "b=[[c|d]]", "{{e|f}}", "g={{{h|i}}}"],
+            ),
+            ("[[x|y]]|{{z|w=v}}=u|", ["[[x|y]]", "{{z|w=v}}=u", ""]),
+            ("{{a|b}}}|c", ["{{a|b}}}", "c"]),
+        ):
+            index = WikiExtractor.BraceIndex("{{T|" + text + "}}")
+            self.assertEqual(WikiExtractor.splitParts(text), parts)
+            self.assertEqual(WikiExtractor.splitParts(text, index, 4), parts)
+
+
+class TestSubstitutionPlan(unittest.TestCase):
+    """Tests for the substitution of template parameters from a compiled plan."""
+
+    def setUp(self):
+        """Create the extractor evaluating names and defaults."""
+        self.extractor = WikiExtractor.Extractor("1", "1", "Page", [])
+
+    def _subst(self, body, params):
+        return WikiExtractor.Template.parse(body).subst(params, self.extractor)
+
+    def test_plan(self):
+        """Test that literal names and defaults are evaluated once compiled."""
+        plan = WikiExtractor.Template.parse("a{{{1}}}b{{{x{{{n}}}|d}}}c").compile()
+        self.assertEqual([plan[0], plan[2], plan[4]], ["a", "b", "c"])
+        # the name and the default, evaluated when literal
+        self.assertEqual((plan[1][0], plan[1][2]), ("1", None))
+        self.assertEqual((plan[3][0], plan[3][2]), (None, "d"))
+
+    def test_substitutions(self):
+        """Test the substitutions of literal and evaluated names and defaults."""
+        for body, params, text in (
+            ("{{{1}}} and {{{name|default}}}", {"1": "one"}, "one and default"),
+            ("{{{1}}} and {{{name|default}}}", {"1": "1", "name": "N"}, "1 and N"),
+            ("{{{a|{{{b|{{{c|none}}}}}}}}}", {"c": "C"}, "C"),
+            ("{{{a|{{{b|{{{c|none}}}}}}}}}", {}, "none"),
+            ("{{{{{{p}}}}}}", {"p": "q", "q": "r"}, "r"),
+            ("x{{{p{{{n}}}|d}}}y", {"n": "2", "p2": "two"}, "xtwoy"),
+            ("{{{1|}}}|{{{2}}}", {}, "|"),
+            ("{{{1|{{lc:ABC}}}}}", {}, "abc"),
+            ("{{{ 1 |sp}}}", {"1": "x"}, "sp"),
+        ):
+            self.assertEqual(self._subst(body, params), text)
+
+    def test_recursion_limit(self):
+        """Test that defaults nested too deep are not substituted."""
+        levels = self.extractor.maxParameterRecursionLevels
+        for depth, text, errors in ((levels, "deep", 0), (levels + 1, "", 2)):
+            body = "{{{p|" * depth + "deep" + "}}}" * depth
+            self.assertEqual(self._subst(body, {}), text)
+            self.assertEqual(self.extractor.recursion_exceeded_3_errs, errors)
+
+
+class TestStageTimes(unittest.TestCase):
+    """Tests for the durations of the stages of extraction."""
+
+    def test_histograms(self):
+        """Test that durations are counted in the histograms merged from workers."""
+        workers = [WikiExtractor.StageTimes() for _ in range(2)]
+        for times, pages in zip(workers, (3, 2)):
+            for _ in range(pages):
+                self.assertEqual(times.time("clean", str.upper, "text"), "TEXT")
+        times = {}
+        for worker in workers:
+            WikiExtractor.merge_stats(times, {"stage_times": worker.stats()})
+        clean = times["stage_times"]["clean"]
+        self.assertEqual(clean["count"], 5)
+        self.assertEqual(sum(clean["histogram"].values()), 5)
+        # each duration is below the bound of its bucket, in microseconds
+        bound = WikiExtractor.histogram_percentile(clean["histogram"], 1.0)
+        self.assertLessEqual(clean["seconds"], 5 * bound / 1e6)
+
+    def test_json(self):
+        """Test the stage times written as JSON, and that they leave output as is."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            times = os.path.join(directory, "times.json")
+            outputs = []
+            for name, args in (
+                ("untimed", []),
+                ("timed", ["--stage_times_json", times]),
+            ):
+                output = os.path.join(directory, name)
+                _extract(output, [dump], "--templates", output + ".templates", *args)
+                outputs.append(_output(output))
+            with open(times) as f:
+                stages = json.load(f)
+        self.assertEqual(sorted(stages), ["clean", "compact", "transform", "wiki2text"])
+        for stage in stages.values():
+            self.assertEqual(stage["count"], 40)
+            self.assertEqual(sum(stage["histogram"].values()), 40)
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestTemplateProfile(unittest.TestCase):
+    """Tests for the time spent expanding each template and parser function."""
+
+    def test_profile(self):
+        """Test the calls, times and limits hit counted for each template."""
+        profile = WikiExtractor.TemplateProfile()
+        _patch_options(
+            self,
+            templates={
+                "Template:Outer": "[{{Inner|a}} {{Inner|b}}]",
+                "Template:Inner": "{{#if:{{{1}}}|<{{{1}}}>}}",
+                "Template:Loop": "x{{Loop}}",
+            },
+            templateCache={},
+            templatePrefix="Template:",
+            templateProfile=profile,
+        )
+        out = StringIO()
+        with self.assertLogs(level="WARNING"):
+            WikiExtractor.extract_page(
+                "1", "1", "Page", ["{{Outer}} {{Loop}} {{PAGENAME}} {{Missing}}\n"], out
+            )
+        self.assertIn("[<a> <b>]", out.getvalue())
+        stats = profile.stats()
+        # magic words and missing templates count as the page
+        self.assertEqual(
+            sorted(stats), ["#if", "Template:Inner", "Template:Loop", "Template:Outer"]
+        )
+        calls = {name: entry["calls"] for name, entry in stats.items()}
+        self.assertEqual(calls["Template:Outer"], 1)
+        self.assertEqual(calls["Template:Inner"], 2)
+        self.assertEqual(calls["#if"], 2)
+        self.assertEqual(stats["Template:Loop"]["limit_hits"], 1)
+        outer, inner = stats["Template:Outer"], stats["Template:Inner"]
+        self.assertAlmostEqual(
+            outer["inclusive"], outer["exclusive"] + inner["inclusive"]
+        )
+        self.assertLessEqual(inner["exclusive"], inner["inclusive"])
+
+        with self.assertLogs(level="INFO") as logs:
+            WikiExtractor.report_template_profile(stats, 2)
+        self.assertEqual(len(logs.output), 4)
+        self.assertIn("top 2", logs.output[0])
+
+
+class TestTelemetry(unittest.TestCase):
+    """Tests for the snapshots of the pipeline written as JSONL."""
+
+    def _snapshots(self, directory, inputs, *args):
+        """Extract with telemetry, and return the snapshots and the output."""
+        output = os.path.join(directory, "telemetry")
+        telemetry = output + ".jsonl"
+        _extract(
+            output,
+            inputs,
+            "--templates",
+            output + ".templates",
+            "--telemetry",
+            telemetry,
+            "--telemetry_interval",
+            "0.05",
+            *args
+        )
+        with open(telemetry) as f:
+            snapshots = [json.loads(line) for line in f]
+        return snapshots, _output(output)
+
+    def test_snapshots(self):
+        """Test the counters of the snapshots of a run reading a split dump."""
+        pages = _pages()
+        with tempfile.TemporaryDirectory() as directory:
+            parts = [
+                _write_dump(os.path.join(directory, "dump%d.xml" % i), pages[i:j])
+                for i, j in ((0, 20), (20, None))
+            ]
+            snapshots, output = self._snapshots(directory, parts)
+            plain = os.path.join(directory, "plain")
+            _extract(plain, parts, "--templates", plain + ".templates")
+            self.assertEqual(output, _output(plain))
+        self.assertEqual(
+            sorted(snapshots[0]),
+            [
+                "jobs_queue",
+                "mappers",
+                "output_queue",
+                "reducer",
+                "spool_bytes",
+                "time",
+                "workers",
+            ],
+        )
+        last = snapshots[-1]
+        self.assertEqual([mapper["pages"] for mapper in last["mappers"]], [20, 23])
+        self.assertEqual(len(last["workers"]), 2)
+        self.assertEqual(sum(worker["pages"] for worker in last["workers"]), 40)
+        self.assertEqual(last["reducer"]["pages"], 40)
+        for snapshot in snapshots:
+            for worker in snapshot["workers"]:
+                self.assertTrue(0 <= worker["idle"] <= 1)
+
+    def test_unordered(self):
+        """Test that the snapshots of an unordered run have no reducer."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            snapshots, output = self._snapshots(directory, [dump], "--unordered")
+        self.assertIsNone(snapshots[-1]["reducer"])
+        self.assertEqual(
+            sum(worker["pages"] for worker in snapshots[-1]["workers"]), 40
+        )
+
+
+class TestPlainTokens(unittest.TestCase):
+    """Tests for the extraction of the body text alone."""
+
+    def test_page(self):
+        """Test that a page is extracted without its title and formatting."""
+        _patch_options(
+            self,
+            templates={
+                "Template:Bold": "'''{{{1}}}'''",
+                "Template:Pair": "{{{1}}}-{{{2|two}}}",
+            },
+            templateCache={},
+            templatePrefix="Template:",
+            plain_tokens=True,
+        )
+        out = StringIO()
+        WikiExtractor.extract_page("1", "1", "Page", PAGE.splitlines(True), out)
+        self.assertEqual(
+            out.getvalue(),
+            "Intro with text and bold.\nA  paragraph with italic and ext.\n",
+        )
+
+    def test_run(self):
+        """Test that a run outputs the body lines of the documents."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), _pages())
+            outputs = []
+            for name, args in (("documents", []), ("plain", ["--plain_tokens"])):
+                output = os.path.join(directory, name)
+                _extract(output, [dump], "--templates", output + ".templates", *args)
+                outputs.append(_output(output))
+        lines = []
+        for document in _documents(outputs[0]):
+            # the body, without the tags and the title
+            lines += [line for line in document.splitlines()[2:-1] if line]
+        self.assertEqual(len(lines), 80)
+        self.assertEqual(outputs[1].splitlines(), lines)
+
+
+class TestIncremental(unittest.TestCase):
+    """Tests for the runs reusing the text of the pages extracted before."""
+
+    def setUp(self):
+        """Extract a dump into a page store, then change a page of it."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = os.path.join(self.directory, "pages.db")
+        pages = _pages()
+        dump = _write_dump(os.path.join(self.directory, "dump.xml"), pages)
+        self._run("first", dump, "--incremental", self.store)
+        # a page edited, one deleted and one created
+        id, revid, title, ns, text = pages[len(TEMPLATES) + 5]
+        pages[len(TEMPLATES) + 5] = (id, 2, title, ns, "Edited {{Bold|text}}.")
+        del pages[len(TEMPLATES) + 10]
+        pages.append((200, 1, "Article new", "0", _article(200)))
+        self.dump = _write_dump(os.path.join(self.directory, "changed.xml"), pages)
+
+    def _run(self, name, dump, *args):
+        """Extract dump, and return its output."""
+        output = os.path.join(self.directory, name)
+        _extract(output, [dump], "--templates", output + ".templates", *args)
+        return _output(output)
+
+    def test_rerun(self):
+        """Test that an incremental rerun extracts as a full run."""
+        incremental = self._run("incremental", self.dump, "--incremental", self.store)
+        full = self._run("full", self.dump)
+        self.assertIn("Edited text.", full)
+        self.assertIn("Hello 200 from Article new", full)
+        self.assertNotIn("Article 10", full)
+        self.assertEqual(incremental, full)
+        db = sqlite3.connect(self.store)
+        revids = dict(db.execute("SELECT id, revid FROM pages"))
+        db.close()
+        self.assertEqual(revids["105"], "2")
+        self.assertIn("200", revids)
+
+    def test_unchanged_reused(self):
+        """Test that the text of the unchanged pages is read from the store."""
+        db = sqlite3.connect(self.store)
+        with db:
+            for id, text in db.execute("SELECT id, text FROM pages").fetchall():
+                text = zlib.decompress(text).decode("utf-8")
+                text = text.replace("Hello", "Stored")
+                db.execute(
+                    "UPDATE pages SET text = ? WHERE id = ?",
+                    (zlib.compress(text.encode("utf-8")), id),
+                )
+        db.close()
+        output = self._run("incremental", self.dump, "--incremental", self.store)
+        self.assertIn("Stored 1 from Article 1", output)
+        self.assertIn("Hello 200 from Article new", output)
+        self.assertEqual(output.count("Stored"), 38)
+
+
+INTERRUPTED = """
+import os
+import signal
+import sys
+from corpora.wikipedia import WikiExtractor
+
+save_checkpoint = WikiExtractor.save_checkpoint
+
+def interrupt(path, settings, part, page, file):
+    # the whole run is killed once its third output file is started
+    save_checkpoint(path, settings, part, page, file)
+    if file == 2:
+        os.killpg(0, signal.SIGKILL)
+
+WikiExtractor.save_checkpoint = interrupt
+sys.argv[0] = WikiExtractor.__file__
+WikiExtractor.main()
+"""
+
+
+class TestResume(unittest.TestCase):
+    """Tests for the checkpoints of the runs, and the runs resumed from them."""
+
+    def test_checkpoint(self):
+        """Test that a checkpoint is only loaded with the settings it was saved with."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = WikiExtractor.checkpoint_path(os.path.join(directory, "out") + "/")
+            self.assertEqual(path, os.path.join(directory, "out.checkpoint"))
+            settings = {"file_size": 1024, "file_compress": None}
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(
+                    WikiExtractor.load_checkpoint(path, settings), (0, 0, 0)
+                )
+            WikiExtractor.save_checkpoint(path, settings, 1, 20, 3)
+            self.assertEqual(WikiExtractor.load_checkpoint(path, settings), (1, 20, 3))
+            with self.assertRaisesRegex(ValueError, "another file_compress"):
+                WikiExtractor.load_checkpoint(path, dict(settings, file_compress="bz2"))
+
+    def test_resumed_run(self):
+        """Test that an interrupted run, then resumed, extracts as a full run."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(
+                os.path.join(directory, "dump.xml"), _pages(300, paragraphs=20)
+            )
+            output = os.path.join(directory, "resumed")
+            args = ["-q", "--processes", "2", "-o", output, "-b", "200K"]
+            templates = ["--templates", output + ".templates"]
+            interrupted = subprocess.run(
+                [sys.executable, "-c", INTERRUPTED] + args + templates + [dump],
+                cwd=ROOT,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            self.assertEqual(interrupted.returncode, -9)
+            checkpoint = WikiExtractor.checkpoint_path(output)
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)["file"], 2)
+            first = os.path.join(output, "AA", "wiki_00")
+            written = os.stat(first).st_mtime_ns
+            # the templates are collected again, not read from the file written
+            templates = ["--templates", output + ".resumed.templates"]
+            _extract(output, [dump], "-b", "200K", "--resume", *templates)
+            # the files complete are not written again
+            self.assertEqual(os.stat(first).st_mtime_ns, written)
+            self.assertFalse(os.path.exists(checkpoint))
+            full = os.path.join(directory, "full")
+            _extract(full, [dump], "-b", "200K", "--templates", full + ".templates")
+            self.assertGreater(len(os.listdir(os.path.join(full, "AA"))), 3)
+            self.assertEqual(_output(output), _output(full))
+
+
+SPINNING = """
+import sys
+from corpora.wikipedia import WikiExtractor
+
+def spin(extractor, *args):
+    while True:
+        pass
+
+WikiExtractor.parserFunctions["#spin"] = spin
+sys.argv[0] = WikiExtractor.__file__
+WikiExtractor.main()
+"""
+
+
+class TestScheduling(unittest.TestCase):
+    """Tests for the runs with large pages and pages out of their CPU budget."""
+
+    def test_large_pages(self):
+        """Test that large pages, extracted on their own, are output in order."""
+        pages = _pages(20)
+        for i in (len(TEMPLATES) + 3, len(TEMPLATES) + 4, len(TEMPLATES) + 12):
+            id, revid, title, ns, text = pages[i]
+            size = WikiExtractor.largePageBytes // len(text) + 1
+            pages[i] = (id, revid, title, ns, text * size)
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            outputs = []
+            for name, processes in (("one", "1"), ("pool", "3")):
+                output = os.path.join(directory, name)
+                _extract(
+                    output,
+                    [dump],
+                    "--templates",
+                    output + ".templates",
+                    "--processes",
+                    processes,
+                    "-b",
+                    "10M",
+                )
+                outputs.append(_output(output))
+        ids = [int(id) for id in re.findall(r'<doc id="(\d+)"', outputs[1])]
+        self.assertEqual(ids, list(range(100, 120)))
+        self.assertEqual(outputs[1], outputs[0])
+
+    def test_page_budget(self):
+        """Test that a page out of its budget is extracted without templates."""
+        pages = _pages(10)
+        id, revid, title, ns, text = pages[len(TEMPLATES) + 5]
+        pages[len(TEMPLATES) + 5] = (id, revid, title, ns, text + "{{#spin:}}\n")
+        with tempfile.TemporaryDirectory() as directory:
+            dump = _write_dump(os.path.join(directory, "dump.xml"), pages)
+            logs = []
+            outputs = []
+            for name, args, code in (
+                ("budget", ["--page_budget", "0.2"], SPINNING),
+                ("templates", [], None),
+                ("no_templates", ["--no_templates"], None),
+            ):
+                output = os.path.join(directory, name)
+                templates = ["--templates", output + ".templates"]
+                logs.append(_extract(output, [dump], *templates, *args, code=code))
+                outputs.append(_documents(_output(output)))
+        self.assertIn("Page 105 Article 5 exceeded its budget", logs[0])
+        budget, templates, no_templates = outputs
+        self.assertEqual(budget[5], no_templates[5])
+        self.assertEqual(budget[:5] + budget[6:], templates[:5] + templates[6:])
+
+
+CRASHING = """
+import os
+import signal
+import sys
+from corpora.wikipedia import WikiExtractor
+
+extract = WikiExtractor.Extractor.extract
+
+def crash(self, out):
+    # the process dies on the page always, or only the first time
+    if self.id == os.environ.get("CRASH_ALWAYS"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    if self.id == os.environ.get("CRASH_ONCE"):
+        marker = os.environ["CRASH_MARKER"]
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            os.kill(os.getpid(), signal.SIGKILL)
+    return extract(self, out)
+
+WikiExtractor.Extractor.extract = crash
+sys.argv[0] = WikiExtractor.__file__
+WikiExtractor.main()
+"""
+
+
+class TestSupervisor(unittest.TestCase):
+    """Tests for the runs whose extract processes die."""
+
+    def setUp(self):
+        """Extract a dump without crashes."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.dump = _write_dump(os.path.join(self.directory, "dump.xml"), _pages())
+        self.documents = _documents(self._run("plain"))
+
+    def _run(self, name, **env):
+        """Extract the dump with the processes crashing as env says."""
+        output = os.path.join(self.directory, name)
+        self.log = _extract(
+            output,
+            [self.dump],
+            "--templates",
+            output + ".templates",
+            "--batch_size",
+            "4",
+            code=CRASHING,
+            env=dict(os.environ, **env),
+        )
+        return _output(output)
+
+    def test_crash_recovered(self):
+        """Test that the jobs of a process dying once are extracted again."""
+        marker = os.path.join(self.directory, "crashed")
+        output = self._run("crash", CRASH_ONCE="110", CRASH_MARKER=marker)
+        self.assertTrue(os.path.exists(marker))
+        self.assertIn("died (exit code -9) on page 110 Article 10", self.log)
+        self.assertEqual(_documents(output), self.documents)
+
+    def test_page_skipped(self):
+        """Test that a page on which processes die again and again is skipped."""
+        output = self._run("poison", CRASH_ALWAYS="110")
+        self.assertEqual(self.log.count("on page 110 Article 10"), 3)
+        self.assertIn("Skipped 1 pages on which extract processes died: 110", self.log)
+        self.assertEqual(_documents(output), self.documents[:10] + self.documents[11:])
+
+
+class TestPageReader(unittest.TestCase):
+    """Tests for the reading of the pages of the namespaces wanted."""
+
+    def setUp(self):
+        """Write a dump with templates, articles and a redirect."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pages = _pages(10, paragraphs=3)
+        pages.append((300, 1, "Redirect", "0", "#REDIRECT [[Article 1]]"))
+        self.dump = _write_dump(os.path.join(directory.name, "dump.xml"), pages)
+        with open(self.dump, "rb") as f:
+            dump = f.read()
+        # the redirect is marked before its revision
+        dump = dump.replace(
+            b"<id>300</id>\n", b'<id>300</id>\n    <redirect title="Article 1" />\n'
+        )
+        with open(self.dump, "wb") as f:
+            f.write(dump)
+
+    def _pages_from(self, mode, namespaces=None):
+        """Return the pages read from the dump opened in mode."""
+        with open(self.dump, mode) as f:
+            return list(WikiExtractor.pages_from(f, namespaces))
+
+    def test_pages_wanted(self):
+        """Test that the pages wanted are read as without namespaces."""
+        pages = self._pages_from("r")
+        # but the redirect
+        self.assertEqual(len(pages), len(TEMPLATES) + 10)
+        for mode in ("r", "rb"):
+            for namespaces in (WikiExtractor.articleKeys, WikiExtractor.templateKeys):
+                wanted = self._pages_from(mode, namespaces)
+                self.assertEqual([page[:5] for page in wanted], [p[:5] for p in pages])
+                for page, read in zip(wanted, pages):
+                    skipped = page[3] not in namespaces
+                    self.assertEqual(page[5], [] if skipped else read[5])
+        self.assertTrue(all(page[5] for page in pages))
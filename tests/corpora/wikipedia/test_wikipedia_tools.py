@@ -0,0 +1,36 @@
+import argparse
+import os
+import unittest
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from unittest import mock
+
+from corpora.wikipedia import wikipedia_tools
+
+from .test_article_container import _write_container
+
+
+class TestWikipediaTools(unittest.TestCase):
+    """Tests for the Wikipedia corpus tooling."""
+
+    def test_count_words_in_containers_and_files(self):
+        """Test counting the words of article containers, in shards, and of files."""
+        kinds = ["alpha", "beta", "gamma"]
+        pages = [
+            (str(i), f'<doc id="{i}">\n{kinds[i % 3]} word\n</doc>\n')
+            for i in range(90)
+        ]
+        with TemporaryDirectory() as directory, NamedTemporaryFile(mode="w+t") as o:
+            _write_container(os.path.join(directory, "data"), pages)
+            with open(os.path.join(directory, "data", "wiki_text"), "w") as f:
+                f.write('<doc id="100">\nmore words\n</doc>\n')
+            args = argparse.Namespace(
+                input=directory, output=o.name, quiet=True, processes=2
+            )
+            with mock.patch.object(wikipedia_tools, "SHARD_BYTES", 1000):
+                input_files = wikipedia_tools._find_input_files(directory)
+                self.assertGreater(len(wikipedia_tools._find_shards(input_files)), 3)
+                wikipedia_tools.count_words(args)
+            word_counts = o.read()
+        self.assertEqual(
+            word_counts, "WORD 90\nALPHA 30\nBETA 30\nGAMMA 30\nMORE 1\nWORDS 1\n"
+        )